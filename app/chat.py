@@ -1,17 +1,33 @@
 """Module for chat api"""
 
 import requests as re
-import xkcd
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import JSONResponse, Response
 
+from passwords.pw import api_version
+from pipeline.rag.admission import shared_admission
+from pipeline.rag.advanced import Prompt as AdvancedPrompt
+from pipeline.rag.common import (complete, GPT_DEPLOYMENT, LLM_TIMEOUT, RagContext,
+    run_cancellable, with_stats)
+from pipeline.rag.modular_rag import ModularRagPrompt
+from pipeline.rag.naive import Prompt as NaivePrompt
+from pipeline.resources import resources
+from pipeline.tracing import new_trace
 from .models import Prompt
 
 
 class Chat:
     """Chat class"""
 
-    def __init__(self):
+    def __init__(self, pipelines: dict | None = None):
+        """Create the chat router.
+
+        :param pipelines: RAG pipelines `Chat.prompt` dispatches to, by mode
+            ("naive", "advanced", "modular").
+        :type pipelines: dict | None
+        """
+        self.pipelines = pipelines or {}
+        self.admission = shared_admission()
         self.router = APIRouter()
         self.router.add_api_route(
             "/chat/hello", self.hello, methods=["GET"], tags=["Chat"]
@@ -33,6 +49,8 @@ class Chat:
         Check the headers of the response for more information.
 
         """
+        import xkcd
+
         meme = xkcd.getRandomComic()
 
         img = re.get(meme.getImageLink(), timeout=300).content
@@ -47,34 +65,58 @@ class Chat:
     async def hello(self, name: str):
         return JSONResponse({"mesage": f"Hello, {name}!"})
 
-    async def prompt(self, req: Prompt):
+    async def prompt(self, request: Request, req: Prompt):
         """## Prompt
         The prompt endpoint handles all API requests towards the RAG Pipeline. In the example JSON, I obtained short text passages from [elswhere.org](https://www.elsewhere.org/journal/pomo/).
         ### Parameters
         - `"prompt"`: Initial prompt. Max 2.000 characters.
-        - `"context"`: Additional context provided by the user as a list. (optional -->  meaning you can only pass on an empty list)
+        - `"context"`: Additional context provided by the user as a list. Only used in the "no-rag" mode. (optional -->  meaning you can only pass on an empty list)
         - `"rag_mode"`: Defines the RAG mode. valid options: "no-rag", "naive", "advanced", "modular"
         - `"advanced_stats"`: Defines advanced stats mode. If this mode is enabled, the server will respond with more statistics (default: false)
         - `"use_for_future_rag"`: Whether or not the request will be stored in the Vector database to optimise the search quality. The server will return additionally a unique `prompt_id` which can be referred to later.  (true/false)
 
+        Every RAG mode has its own concurrency limit and wait queue, cheap modes are admitted first. If all slots and the wait queue of a mode are taken, the server answers with `429 Too Many Requests` and a `Retry-After` header.
         """
-        match req.rag_mode.strip():
+        mode = req.rag_mode.strip()
+        match mode:
             case "no-rag":
-                # TODO: Add a direct pass-through to OpenAI
-                print("No Rag SELECTED")
+                return await self._no_rag(request, req)
             case "naive":
-                # TODO: Add a connection to `pipeline.rag.chunk` to chunk and do the rest
-                print("Naive SELECTED")
+                query = NaivePrompt(prompt=req.prompt, advanded_stats=req.advanded_stats)
+                return await self._pipeline(mode).query(request, query)
             case "advanced":
-                # TODO: Add a connection to chunk and Advanced RAG
-                print("Advanced SELECTED")
+                query = AdvancedPrompt(prompt=req.prompt, advanded_stats=req.advanded_stats)
+                return await self._pipeline(mode).wrapper(request, query)
             case "modular":
-                # TODO: Add a connection to Chunk and Modular RAG
-                print("Modular SELECTED")
+                query = ModularRagPrompt(prompt=req.prompt, advanded_stats=req.advanded_stats)
+                return await self._pipeline(mode).modular(request, query)
             case _:
                 raise HTTPException(
                     422,
                     f"Invalid Rag Mode. Valid RAG modes are ['no-rag', 'naive', 'advanced', 'modular']. Your selection was: {req.rag_mode}. Rag mode must be lower case and without any leading or tailing spaces.",
                 )
 
-        return req
+    def _pipeline(self, mode: str):
+        if mode not in self.pipelines:
+            raise HTTPException(503, f"The {mode} RAG pipeline is not available.")
+        return self.pipelines[mode]
+
+    async def _no_rag(self, request: Request, req: Prompt):
+        """Pass the prompt and the user's context directly to GPT-4o."""
+        ctx = RagContext(prompt=req.prompt, trace=new_trace(req.advanded_stats, "no-rag"))
+        messages = [{"role": "user", "content": req.prompt}]
+        if req.context:
+            messages.insert(0, {"role": "system", "content": "Context:\n" + "\n".join(
+                str(item) for item in req.context)})
+        client = resources.chat_client(api_version=api_version, azure_deployment=GPT_DEPLOYMENT)
+
+        with ctx.trace.span("admission"):
+            slot = await self.admission.acquire("no-rag")
+        try:
+            with ctx.trace.span("answer"):
+                ctx.answer = await run_cancellable(request, complete(client, ctx,
+                    model="gpt-4o-sweden", temperature=0.3, timeout=LLM_TIMEOUT,
+                    messages=messages, ))
+        finally:
+            slot.release()
+        return with_stats(ctx, {"query": req.prompt, "response": ctx.answer})
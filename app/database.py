@@ -1,15 +1,22 @@
 """API Router for the CouchDB interface"""
 
+import asyncio
 import hashlib
+import logging
+import os
 from typing import List
 
 from dotenv import dotenv_values
-from fastapi import APIRouter, Body, File, HTTPException, status, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Body, File, HTTPException, status, UploadFile
 from fastapi.responses import JSONResponse
 
-from pipeline import retriever
+from pipeline import retriever, upload
+from pipeline.metrics import process_alive
 from .models import UserCreation
 
+# Kind of the upload jobs in the job store
+UPLOAD_JOB = "upload"
+
 
 class DocumentDBRouter:
     """API Router for CouchDB functions"""
@@ -18,6 +25,8 @@ class DocumentDBRouter:
         self.router = APIRouter()
         self.doc_db = self._initialize_document_db()
         self.rag = rag
+        # Larger uploads are processed in the background and return a job
+        self.async_threshold = int(os.environ.get("UPLOAD_ASYNC_THRESHOLD", 8 * 1024 * 1024))
         self._register_routes()
 
     def _initialize_document_db(self):
@@ -33,6 +42,9 @@ class DocumentDBRouter:
         self.router.add_api_route("/files/upload_pdfs/", self.upload_files, methods=["POST"],
             tags=["Files"], deprecated=True,
         )
+        self.router.add_api_route("/files/upload_jobs/{job_id}", self.get_upload_job,
+            methods=["GET"], tags=["Files"],
+        )
         self.router.add_api_route(
             "/files/list_files", self.list_files, methods=["GET"], tags=["Files"]
         )
@@ -56,6 +68,47 @@ class DocumentDBRouter:
                 detail="Currently running an indexing job. Please wait a few minutes.",
             )
 
+    async def start(self):
+        """Clean up after crashed workers, called by the lifespan handler."""
+        await asyncio.to_thread(self._recover_uploads)
+
+    def _recover_uploads(self):
+        """Fail the upload jobs of exited workers and remove their temporary files.
+
+        The temporary file of an upload only exists in the worker which received
+        it, so these jobs cannot be resumed.
+        """
+        for job in self.rag.jobs.unfinished_jobs([UPLOAD_JOB]):
+            pid = job["params"].get("pid")
+            if pid == os.getpid() or (pid is not None and process_alive(pid)):
+                continue
+            logging.warning(f"Upload job {job['id']} was interrupted, marking it as failed")
+            self.rag.jobs.finish_job(job["id"], "The upload was interrupted by a restart of the "
+                                                "server. Please upload the file again.")
+        if removed := upload.remove_stale():
+            logging.info(f"Removed {removed} temporary files of interrupted uploads")
+
+    async def _store_upload(self, spooled: upload.SpooledUpload) -> dict:
+        """Extract, compress and store a spooled upload; removes its temporary file."""
+        try:
+            doc_info = await upload.prepare(spooled)
+            return await asyncio.to_thread(self.doc_db.store_document, doc_info)
+        finally:
+            await asyncio.to_thread(spooled.close)
+
+    async def _upload_job(self, job_id: str, spooled: upload.SpooledUpload):
+        jobs = self.rag.jobs
+        jobs.start_job(job_id)
+        try:
+            res = await self._store_upload(spooled)
+        except Exception as e:
+            logging.error(f"Upload job {job_id} failed: {e!r}")
+            jobs.document_done(job_id, spooled.document_id, failed=True)
+            jobs.finish_job(job_id, getattr(e, "detail", None) or repr(e))
+            return
+        jobs.document_done(job_id, spooled.document_id)
+        jobs.finish_job(job_id, stats=res)
+
     async def upload_files(self, files: List[UploadFile]):
         """## Bulk upload of PDF files
         This API endpoint has been deprecated to prevent unwanted change within the datastructure. Once the university project is graded, this endpoint becomes active.
@@ -64,9 +117,9 @@ class DocumentDBRouter:
         Uploads files to the couch db
         """
         self._check_bg_task()
-        return [self.doc_db.add_document(file) for file in files]
+        return [await self._store_upload(await upload.spool(file)) for file in files]
 
-    async def upload_file(self, file: UploadFile = File(...)):
+    async def upload_file(self, background_tasks: BackgroundTasks, file: UploadFile = File(...)):
         """
         ## Upload File
 
@@ -75,11 +128,13 @@ class DocumentDBRouter:
         Handles the uploading of a PDF file. Validates the file type, extracts content,
         stores it in CouchDB, and returns the checksum.
 
+        Files larger than `UPLOAD_ASYNC_THRESHOLD` bytes (default: 8 MiB) are processed in the background. The response has the status code 202 and contains the `job_id`, whose state is returned by `/files/upload_jobs/{job_id}`.
+
         ### Parameters:
         - `file` (UploadFile): The PDF file to be uploaded.
 
         ### Returns:
-        - `JSONResponse`: A response with the document's details and checksum.
+        - `JSONResponse`: A response with the document's details and checksum, or the upload job.
 
         ### Raises:
         - `HTTPException`: If the file is not a PDF.
@@ -92,8 +147,37 @@ class DocumentDBRouter:
                 detail="Only PDF files are allowed.",
             )
 
-        res = self.doc_db.add_document(file)
-        return JSONResponse(content=res, status_code=status.HTTP_200_OK)
+        spooled = await upload.spool(file)
+        if spooled.size > self.async_threshold:
+            job_id = self.rag.jobs.create_job(UPLOAD_JOB, [spooled.document_id],
+                                              {"size": spooled.size, "pid": os.getpid()})
+            background_tasks.add_task(self._upload_job, job_id, spooled)
+            return JSONResponse(
+                content={"job_id": job_id, "document_id": spooled.document_id,
+                         "checksum": spooled.checksum, "status": "queued"},
+                status_code=status.HTTP_202_ACCEPTED,
+            )
+
+        res = await self._store_upload(spooled)
+        return JSONResponse(content={**res, "checksum": spooled.checksum},
+                            status_code=status.HTTP_200_OK)
+
+    async def get_upload_job(self, job_id: str):
+        """
+        ## Get Upload Job
+
+        Returns the state of an upload which is processed in the background. Once the job is `completed`, `params.stats` contains the details of the stored document; failed jobs contain the `error`.
+
+        ### Raises:
+        - `HTTPException`: If the job does not exist.
+        """
+        job = self.rag.jobs.get_job(job_id)
+        if job is None or job["kind"] != UPLOAD_JOB:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Upload job not found. Your job ID was: {job_id}",
+            )
+        return JSONResponse(content=job, status_code=status.HTTP_200_OK)
 
     async def list_files(self):
         """
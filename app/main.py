@@ -1,17 +1,48 @@
 """Main module. Here will be the entry point of the application."""
 
+from contextlib import asynccontextmanager
+
 import dotenv
 import uvicorn
 from fastapi import FastAPI
 
 from pipeline.rag import AdvancedRAG, ModularRag, NaiveRagGPT4
+from pipeline.resources import resources
 from .chat import Chat
 from .database import DocumentDBRouter
+from .middleware import LoggingMiddleware, MetricsMiddleware, ProfilingMiddleware
+from .monitoring import Monitoring
 from .rag_api import RagApi
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the background services of the worker and close the shared clients on shutdown."""
+    app.state.resources = resources
+    await rapi.start()
+    await db.start()
+    await monitoring.start()
+    if request_log is not None:
+        request_log.writer.start()
+    try:
+        yield
+    finally:
+        if request_log is not None:
+            await request_log.writer.aclose()
+        await monitoring.stop()
+        await rapi.stop()
+        await resources.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(MetricsMiddleware())
 #
-cht = Chat()
+monitoring = Monitoring()
+if monitoring.profiling_token:
+    app.middleware("http")(ProfilingMiddleware(monitoring.profiling_token))
+request_log = LoggingMiddleware(app) if monitoring.request_logging else None
+if request_log is not None:
+    app.middleware("http")(request_log)
 #
 rapi = RagApi()
 gpt4 = NaiveRagGPT4()
@@ -19,6 +50,7 @@ adv = AdvancedRAG()
 #
 db = DocumentDBRouter(rapi)
 mod = ModularRag()
+cht = Chat({"naive": gpt4, "advanced": adv, "modular": mod})
 #
 app.include_router(cht.router)
 #
@@ -28,6 +60,7 @@ app.include_router(rapi.router)
 app.include_router(gpt4.router)
 app.include_router(adv.router)
 app.include_router(mod.router)
+app.include_router(monitoring.router)
 
 if __name__ == "__main__":
     dotenv.load_dotenv("../.env")
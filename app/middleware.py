@@ -1,53 +1,289 @@
+import asyncio
+import hmac
+import logging
+import os
+import random
 import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
 
-from passwords.pw import influx_token, influx_url, org
+from pipeline.cache_store import CacheStore, shared_store
+from pipeline.metrics import HTTP_SECONDS
+from .profiler import SamplingProfiler
 
 
-class LoggingTimeSeries:
+class MetricsSink(ABC):
+    """Destination of the request metrics.
+
+    `write` receives a batch of records (dictionaries) and is called in a
+    worker thread, so it may block.
+    """
+
+    @abstractmethod
+    def write(self, records: list):
+        """Write a batch of records."""
+
+    def close(self):
+        pass
+
+
+class LoggingTimeSeries(MetricsSink):
+    """Writes request metrics to InfluxDB, one point per request."""
+
     def __init__(self):
+        from influxdb_client import InfluxDBClient
+        from influxdb_client.client.write_api import SYNCHRONOUS
+
+        from passwords.pw import influx_token, influx_url, org
+
+        self.org = org
         self.write_client = InfluxDBClient(url=influx_url, token=influx_token, org=org)
+        # Called from the background flusher only, never on the request path
         self.write_api = self.write_client.write_api(write_options=SYNCHRONOUS)
         self.bucket = "rag-performance-monitor"
 
-    def add_request(self, title: str, request_type: str, body: str):
-        point = (
-            Point("_measurement").tag("title", title).tag("type", request_type).field("body", body))
-        self.write_api.write(bucket=self.bucket, org=org, record=point)
+    def write(self, records: list):
+        from influxdb_client import Point
+
+        points = []
+        for record in records:
+            point = (Point("_measurement").tag("title", record["title"])
+                     .tag("method", record["method"]).tag("path", record["path"])
+                     .field("status_code", record["status_code"])
+                     .field("duration_ms", record["duration_ms"])
+                     .time(record["time_ns"]))
+            if record.get("request_body") is not None:
+                point = point.field("request_body", record["request_body"])
+            if record.get("response_size") is not None:
+                point = point.field("response_size", record["response_size"])
+            points.append(point)
+        self.write_api.write(bucket=self.bucket, org=self.org, record=points)
+
+    def close(self):
+        self.write_client.close()
+
+
+class MetricsWriter:
+    """Buffers metric records and writes them to a sink in the background.
+
+    `add` never blocks: records are appended to a bounded buffer, and if the
+    buffer is full (the sink is slow or down) new records are dropped and
+    counted. A background task writes batches whenever `batch_size` records
+    are waiting or `flush_interval` seconds have passed. Failed batches are
+    dropped, too, so the memory stays bounded.
+    """
+
+    def __init__(self, sink: MetricsSink, batch_size: int | None = None,
+                 flush_interval: float | None = None, max_buffer: int | None = None,
+                 sample_rate: float | None = None, max_body: int | None = None):
+        """Create the writer.
+
+        :param sink: Destination of the records.
+        :type sink: MetricsSink
+        :param batch_size: Records per write (`METRICS_BATCH_SIZE`, default 500).
+        :type batch_size: int | None
+        :param flush_interval: Maximum seconds a record waits (`METRICS_FLUSH_INTERVAL`, default 1).
+        :type flush_interval: float | None
+        :param max_buffer: Maximum number of buffered records (`METRICS_BUFFER_SIZE`, default 10000).
+        :type max_buffer: int | None
+        :param sample_rate: Share of the requests which are recorded (`METRICS_SAMPLE_RATE`, default 1).
+        :type sample_rate: float | None
+        :param max_body: Request bodies are truncated to this many characters (`METRICS_MAX_BODY`,
+            default 1024). 0 omits the bodies.
+        :type max_body: int | None
+        """
+        self.sink = sink
+        self.batch_size = int(os.environ.get("METRICS_BATCH_SIZE", 500)) \
+            if batch_size is None else batch_size
+        self.flush_interval = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1.0)) \
+            if flush_interval is None else flush_interval
+        self.max_buffer = int(os.environ.get("METRICS_BUFFER_SIZE", 10000)) \
+            if max_buffer is None else max_buffer
+        self.sample_rate = float(os.environ.get("METRICS_SAMPLE_RATE", 1.0)) \
+            if sample_rate is None else sample_rate
+        self.max_body = int(os.environ.get("METRICS_MAX_BODY", 1024)) \
+            if max_body is None else max_body
+        self.buffer = deque()
+        self.counters = {"written": 0, "dropped": 0, "failed": 0, "sampled_out": 0}
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+
+    def sampled(self) -> bool:
+        """Decide whether the current request is recorded."""
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            return True
+        self.counters["sampled_out"] += 1
+        return False
+
+    def truncate(self, body: str | None) -> str | None:
+        """Cut a body to `max_body` characters."""
+        if body is None or self.max_body <= 0:
+            return None
+        return body if len(body) <= self.max_body else body[:self.max_body] + "…"
+
+    def add(self, record: dict):
+        """Buffer a record without blocking; drops it if the buffer is full."""
+        if len(self.buffer) >= self.max_buffer:
+            self.counters["dropped"] += 1
+            return
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        """Start the background flusher, called once by the lifespan handler."""
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
 
-    def add_response(self, title: str, response_type: str, status_code: int, body: str):
-        point = (Point("_measurement").tag("title", title).tag("type", response_type).field(
-            "status_code", status_code).field("body", body))
-        self.write_api.write(bucket=self.bucket, org=org, record=point)
+    async def flush(self):
+        """Write every buffered record, one batch at a time."""
+        while self.buffer:
+            batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            try:
+                await asyncio.to_thread(self.sink.write, batch)
+                self.counters["written"] += len(batch)
+            except Exception as e:
+                self.counters["failed"] += len(batch)
+                logging.warning(f"Failed to write {len(batch)} metric records: {e!r}")
+
+    async def aclose(self):
+        """Stop the flusher, write the remaining records and close the sink."""
+        if self._task is not None:
+            # Woken up instead of cancelled, so a batch being written is not lost
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        await asyncio.to_thread(self.sink.close)
+
+    def stats(self) -> dict:
+        """Return the number of written, dropped, failed and sampled out records."""
+        return {**self.counters, "buffered": len(self.buffer)}
 
 
 class LoggingMiddleware:
-    def __init__(self, app: FastAPI):
+    """HTTP middleware recording method, path, status, duration, the (truncated)
+    request body and the size of the response.
+
+    Register with `app.middleware("http")(LoggingMiddleware(app))` and start and
+    close its `writer` in the lifespan handler. The records are handed to the
+    `MetricsWriter`, so nothing is written on the request path. A record is
+    added once the response body has been sent, so the duration of streamed
+    responses is complete as well.
+    """
+
+    def __init__(self, app: FastAPI, writer: MetricsWriter | None = None):
         self.app = app
-        self.logger = LoggingTimeSeries()
+        self.writer = writer or MetricsWriter(LoggingTimeSeries())
 
     async def __call__(self, request: Request, call_next):
-        start_time = time.time()
+        if not self.writer.sampled():
+            return await call_next(request)
+
+        start_time = time.perf_counter()
 
         # Process the request
-        request_body = await request.body()
-        self.logger.add_request("API Call", "request", request_body.decode("utf-8"))
+        request_body = None
+        if self.writer.max_body > 0:
+            request_body = self.writer.truncate(
+                (await request.body()).decode("utf-8", errors="replace")
+            )
 
         # Process the response
         response = await call_next(request)
 
         # Skip logging for HTML responses (like /docs and /redoc)
-        if isinstance(response, HTMLResponse):
+        if response.headers.get("content-type", "").startswith("text/html"):
+            return response
+
+        # `call_next` always returns a streaming response, so the body is
+        # measured while it is sent instead of being read here
+        body = response.body_iterator
+
+        async def measured():
+            size = 0
+            try:
+                async for chunk in body:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                self.writer.add({
+                    "title": "API Call",
+                    "method": request.method,
+                    "path": request.url.path,
+                    "status_code": response.status_code,
+                    "duration_ms": (time.perf_counter() - start_time) * 1000,
+                    "time_ns": time.time_ns(),
+                    "request_body": request_body,
+                    "response_size": size,
+                })
+
+        response.body_iterator = measured()
+        return response
+
+
+class MetricsMiddleware:
+    """HTTP middleware observing the duration of every request per route template.
+
+    Register with `app.middleware("http")(MetricsMiddleware())`.
+    """
+
+    async def __call__(self, request: Request, call_next):
+        start_time = time.perf_counter()
+        status_code = 500
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
             return response
+        finally:
+            route = request.scope.get("route")
+            HTTP_SECONDS.observe(time.perf_counter() - start_time, method=request.method,
+                                 route=getattr(route, "path", "unmatched"), status=status_code)
 
-        # Log other response types
-        response_body = (response.body.decode("utf-8") if isinstance(response,
-                                                                     JSONResponse) else "Non-JSON response")
-        self.logger.add_response("API Call", "response", response.status_code, response_body)
 
-        # Return the original response
+class ProfilingMiddleware:
+    """HTTP middleware profiling single requests on demand.
+
+    Requests carrying the profiling token in the `X-Profile` header (or the
+    `profile` query parameter) are run under a `SamplingProfiler` until the
+    response starts. The profiler samples every thread of the worker, so
+    concurrent requests show up as well. The collapsed stacks are kept in the
+    shared cache store and the response gets an `X-Profile-Id` header to fetch
+    them from `/admin/profile/{id}`.
+    Only registered if `PROFILING_TOKEN` is set.
+    """
+
+    def __init__(self, token: str, store: CacheStore | None = None):
+        self.token = token
+        self.store = store
+        self.ttl = float(os.environ.get("PROFILING_TTL", 3600))
+
+    async def __call__(self, request: Request, call_next):
+        token = request.headers.get("X-Profile") or request.query_params.get("profile")
+        if not token or not hmac.compare_digest(token, self.token):
+            return await call_next(request)
+
+        with SamplingProfiler() as profiler:
+            response = await call_next(request)
+        profile_id = uuid.uuid4().hex
+        store = self.store or shared_store()
+        await asyncio.to_thread(store.put, "profile", profile_id, profiler.collapsed(),
+                                ttl=self.ttl, limit=100)
+        response.headers["X-Profile-Id"] = profile_id
         return response
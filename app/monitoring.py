@@ -0,0 +1,101 @@
+"""API Router for the monitoring endpoints"""
+
+import asyncio
+import hmac
+import logging
+import os
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from pipeline import metrics
+from pipeline.cache_store import shared_store
+from .profiler import SamplingProfiler
+
+
+class Monitoring:
+    """Exposes the metrics of all workers of the host and the profiler"""
+
+    def __init__(self):
+        self.router = APIRouter()
+        self.router.add_api_route("/metrics", self.metrics, methods=["GET"], tags=["Monitoring"],
+            response_class=PlainTextResponse, )
+        self.router.add_api_route("/admin/profile", self.profile, methods=["POST"],
+            tags=["Monitoring"], response_class=PlainTextResponse, include_in_schema=False, )
+        self.router.add_api_route("/admin/profile/{profile_id}", self.get_profile,
+            methods=["GET"], tags=["Monitoring"], response_class=PlainTextResponse,
+            include_in_schema=False, )
+        self.snapshot_interval = float(os.environ.get("METRICS_SNAPSHOT_INTERVAL", 5))
+        # Profiling is disabled unless a token is configured
+        self.profiling_token = os.environ.get("PROFILING_TOKEN") or None
+        self.max_profile_seconds = float(os.environ.get("PROFILING_MAX_SECONDS", 60))
+        # Request records are sent to InfluxDB only if enabled
+        self.request_logging = os.environ.get("REQUEST_LOGGING", "0").lower() in ("1", "true", "yes")
+        self._snapshots = None
+
+    async def start(self):
+        """Start writing snapshots of this worker's metrics, called by the lifespan handler."""
+        self._snapshots = asyncio.create_task(self._write_snapshots())
+
+    async def stop(self):
+        """Stop writing snapshots; the last one is written on the way out."""
+        if self._snapshots is not None:
+            self._snapshots.cancel()
+            try:
+                await self._snapshots
+            except asyncio.CancelledError:
+                pass
+            self._snapshots = None
+        await asyncio.to_thread(metrics.write_snapshot)
+
+    async def _write_snapshots(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await asyncio.to_thread(metrics.write_snapshot)
+            except OSError as e:
+                logging.warning(f"Failed to write the metrics snapshot: {e!r}")
+
+    async def metrics(self):
+        """## Metrics
+        Counters and latency histograms in the Prometheus text format, summed over all workers of the server:
+
+        - `rag_http_request_duration_seconds`: requests per method, route and status.
+        - `rag_stage_duration_seconds`: stages of the RAG pipelines and of indexing jobs.
+        - `rag_external_call_duration_seconds`: embedding, Qdrant, LLM and CouchDB calls.
+        - `rag_cache_requests_total`: hits and misses of the response, LLM and embedding caches.
+        - `rag_indexed_total`: indexed documents, chunks and tokens.
+
+        Percentiles are computed in Prometheus, e.g. `histogram_quantile(0.95, sum by (le, route) (rate(rag_http_request_duration_seconds_bucket[5m])))`. Other workers report with a delay of up to `METRICS_SNAPSHOT_INTERVAL` seconds (default: 5).
+        """
+        snapshots = await asyncio.to_thread(metrics.collect)
+        return PlainTextResponse(metrics.render(metrics.merge(snapshots)),
+                                 media_type="text/plain; version=0.0.4")
+
+    def _authorise(self, token: str | None):
+        if self.profiling_token is None:
+            raise HTTPException(404, detail="Not Found")
+        if not token or not hmac.compare_digest(token, self.profiling_token):
+            raise HTTPException(403, detail="Invalid profiling token.")
+
+    async def profile(self, seconds: float = Query(10, gt=0),
+                      x_profile: str | None = Header(None)):
+        """## Profile this worker
+        Samples the Python stacks of every thread of the worker which handles the request for `seconds` seconds (at most `PROFILING_MAX_SECONDS`) and returns them in the collapsed format understood by `flamegraph.pl` and speedscope.
+
+        Requires `PROFILING_TOKEN` to be set on the server and sent in the `X-Profile` header.
+        """
+        self._authorise(x_profile)
+        with SamplingProfiler() as profiler:
+            await asyncio.sleep(min(seconds, self.max_profile_seconds))
+        return PlainTextResponse(profiler.collapsed())
+
+    async def get_profile(self, profile_id: str, x_profile: str | None = Header(None)):
+        """## Profile of a single request
+        Returns the collapsed stacks of a request which was sent with the `X-Profile` header (or the `profile` query parameter). Its ID is returned in the `X-Profile-Id` response header.
+        """
+        self._authorise(x_profile)
+        collapsed = await asyncio.to_thread(shared_store().get, "profile", profile_id)
+        if collapsed is None:
+            raise HTTPException(404, detail="Profile not found or expired.")
+        return PlainTextResponse(collapsed)
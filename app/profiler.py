@@ -0,0 +1,90 @@
+"""Sampling profiler for live workers.
+
+The profiler runs in its own thread and periodically records the Python
+stack of every other thread (`sys._current_frames`). Stacks of idle threads
+(the event loop waiting in `select`, idle thread pool workers) are skipped.
+The result is in the collapsed format of `flamegraph.pl` and speedscope:
+one line per distinct stack, frames separated by `;`, followed by the
+number of samples.
+
+Nothing is sampled unless a profiler is running.
+"""
+
+import os
+import sys
+import threading
+from collections import Counter
+
+# Innermost frames of threads which are waiting for work
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+def _idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads of the process while it is running.
+
+    Use as a context manager or with `start` and `stop`.
+    """
+
+    def __init__(self, interval: float | None = None):
+        """Create a profiler.
+
+        :param interval: Seconds between two samples (`PROFILING_INTERVAL`, default 0.005).
+        :type interval: float | None
+        """
+        self.interval = float(os.environ.get("PROFILING_INTERVAL", 0.005)) \
+            if interval is None else interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        """Stop sampling and return the number of samples per collapsed stack."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.samples
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or _idle(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """Return the samples in the collapsed stack format, most frequent first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -5,4 +5,5 @@ from . import collection, embedding, vector
 __all__ = ["vector", "collection", "embedding", "retriever"]
 Vectorstore = vector.Vectorstore
 Collection = collection.Collection
+IndexTarget = collection.IndexTarget
 Embedding = embedding.Embedding
@@ -0,0 +1,431 @@
+"""Key-value and vector storage shared by the caches of all workers."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+def _normalize(vector) -> "np.ndarray":
+    import numpy as np
+
+    vector = np.array(vector, dtype=np.float32)
+    vector /= max(np.linalg.norm(vector), 1e-12)
+    return vector
+
+
+class CacheStore(ABC):
+    """Interface of the cache backends.
+
+    Entries live in a namespace and are addressed by a key. Besides a JSON
+    serializable value an entry may carry a vector; `nearest` finds the most
+    similar vector of a namespace (and partition). Namespaces can be bounded
+    with `limit`, the least recently used entries are evicted first.
+    """
+
+    @abstractmethod
+    def get(self, namespace: str, key: str):
+        """Return the value of an entry or `None`."""
+
+    @abstractmethod
+    def get_vector(self, namespace: str, key: str) -> "np.ndarray | None":
+        """Return the (normalized) vector of an entry or `None`."""
+
+    @abstractmethod
+    def put(self, namespace: str, key: str, value=None, vector=None, partition: str = "",
+            ttl: float | None = None, limit: int | None = None):
+        """Store an entry.
+
+        :param namespace: Namespace of the entry, e.g. `response:naive`.
+        :type namespace: str
+        :param key: Key of the entry within the namespace.
+        :type key: str
+        :param value: JSON serializable value.
+        :param vector: Vector for similarity lookups. Stored normalized.
+        :param partition: Only entries of the same partition are compared by `nearest`.
+        :type partition: str
+        :param ttl: Lifetime of the entry in seconds.
+        :type ttl: float | None
+        :param limit: Maximum number of entries of the namespace.
+        :type limit: int | None
+        """
+
+    @abstractmethod
+    def nearest(self, namespace: str, vector, partition: str = "", threshold: float = -1.0
+                ) -> tuple | None:
+        """Return `(key, value, similarity)` of the most similar entry above `threshold`."""
+
+    @abstractmethod
+    def clear(self, namespace: str):
+        """Remove every entry of a namespace."""
+
+    @abstractmethod
+    def count(self, namespace: str) -> int:
+        """Return the number of entries of a namespace."""
+
+
+class MemoryCacheStore(CacheStore):
+    """Cache store of a single process."""
+
+    def __init__(self):
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, namespace: str, key: str) -> dict | None:
+        entries = self._namespaces.get(namespace, {})
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] is not None and entry["expires_at"] < time.time():
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return entry
+
+    def get(self, namespace: str, key: str):
+        with self._lock:
+            entry = self._entry(namespace, key)
+        return entry["value"] if entry else None
+
+    def get_vector(self, namespace: str, key: str) -> "np.ndarray | None":
+        with self._lock:
+            entry = self._entry(namespace, key)
+        return entry["vector"] if entry else None
+
+    def put(self, namespace: str, key: str, value=None, vector=None, partition: str = "",
+            ttl: float | None = None, limit: int | None = None):
+        with self._lock:
+            entries = self._namespaces.setdefault(namespace, OrderedDict())
+            entries[key] = {
+                "value": value,
+                "vector": None if vector is None else _normalize(vector),
+                "partition": partition,
+                "expires_at": None if ttl is None else time.time() + ttl,
+            }
+            entries.move_to_end(key)
+            while limit is not None and len(entries) > limit:
+                entries.popitem(last=False)
+
+    def nearest(self, namespace: str, vector, partition: str = "", threshold: float = -1.0
+                ) -> tuple | None:
+        import numpy as np
+
+        now = time.time()
+        with self._lock:
+            candidates = [
+                (key, entry) for key, entry in self._namespaces.get(namespace, {}).items()
+                if entry["partition"] == partition and entry["vector"] is not None
+                and (entry["expires_at"] is None or entry["expires_at"] >= now)
+            ]
+        if not candidates:
+            return None
+        scores = np.stack([entry["vector"] for _, entry in candidates]) @ _normalize(vector)
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        key, entry = candidates[best]
+        with self._lock:
+            if key in self._namespaces.get(namespace, {}):
+                self._namespaces[namespace].move_to_end(key)
+        return key, entry["value"], float(scores[best])
+
+    def clear(self, namespace: str):
+        with self._lock:
+            self._namespaces.pop(namespace, None)
+
+    def count(self, namespace: str) -> int:
+        return len(self._namespaces.get(namespace, {}))
+
+
+class SQLiteCacheStore(CacheStore):
+    """Cache store shared by every process of a host.
+
+    Keys and values are kept in a SQLite database in WAL mode. Vectors are kept
+    in a fixed size float32 arena (a memory mapped file next to the database)
+    and referenced by their slot, which keeps the rows small and lets all
+    workers share the same pages. Unused slots are listed in `free_slots`.
+
+    Lookups only read: the access times used for the LRU eviction are
+    collected in memory and written with the next `put` (or once
+    `TOUCH_BATCH` of them are pending), so readers never take the write lock.
+    Every row carries a digest of its vector; vectors are only used if they
+    still match it, because the arena is rewritten outside of the transactions
+    of the readers.
+    """
+
+    # Pending access times which are written without waiting for a `put`
+    TOUCH_BATCH = 256
+
+    def __init__(self, path: str | None = None, dimensions: int = 1536,
+                 capacity: int | None = None):
+        """Open (and create if necessary) the store.
+
+        :param path: Directory of the store (`CACHE_PATH`, default `../data/cache`).
+        :type path: str | None
+        :param dimensions: Number of dimensions of the stored vectors.
+        :type dimensions: int
+        :param capacity: Maximum number of vectors (`CACHE_VECTOR_CAPACITY`, default 16384).
+        :type capacity: int | None
+        """
+        import numpy as np
+
+        self.path = path or os.environ.get("CACHE_PATH", "../data/cache")
+        self.dimensions = dimensions
+        self.capacity = int(os.environ.get("CACHE_VECTOR_CAPACITY", 16384)) \
+            if capacity is None else capacity
+        os.makedirs(self.path, exist_ok=True)
+        self._local = threading.local()
+        self._touched = {}
+        self._touch_lock = threading.Lock()
+
+        con = self._connect()
+        con.execute("PRAGMA journal_mode=WAL")
+        con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                partition TEXT NOT NULL DEFAULT '',
+                value TEXT,
+                slot INTEGER UNIQUE,
+                expires_at REAL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE INDEX IF NOT EXISTS entries_used ON entries (namespace, used_at);
+            CREATE INDEX IF NOT EXISTS entries_partition ON entries (namespace, partition);
+            CREATE INDEX IF NOT EXISTS entries_slot_used ON entries (used_at)
+                WHERE slot IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires_at)
+                WHERE expires_at IS NOT NULL;
+            CREATE TABLE IF NOT EXISTS arena (
+                dimensions INTEGER NOT NULL,
+                capacity INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS free_slots (slot INTEGER PRIMARY KEY);
+            CREATE TRIGGER IF NOT EXISTS entries_free_slot AFTER DELETE ON entries
+                WHEN OLD.slot IS NOT NULL
+            BEGIN
+                INSERT OR IGNORE INTO free_slots VALUES (OLD.slot);
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_move_slot AFTER UPDATE OF slot ON entries
+                WHEN OLD.slot IS NOT NULL AND NEW.slot IS NOT OLD.slot
+            BEGIN
+                INSERT OR IGNORE INTO free_slots VALUES (OLD.slot);
+            END;
+            """
+        )
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT dimensions, capacity FROM arena").fetchone()
+            if row is None:
+                con.execute("INSERT INTO arena VALUES (?, ?)", (self.dimensions, self.capacity))
+            else:
+                self.dimensions, self.capacity = row
+            if con.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # Once, for a new store or one created before the digests and the free list
+                columns = [row[1] for row in con.execute("PRAGMA table_info(entries)")]
+                if "digest" not in columns:
+                    con.execute("ALTER TABLE entries ADD COLUMN digest TEXT")
+                con.execute(
+                    "WITH RECURSIVE slots(slot) AS (SELECT 0 UNION ALL SELECT slot + 1 FROM slots "
+                    "WHERE slot + 1 < ?) INSERT OR IGNORE INTO free_slots SELECT slot FROM slots "
+                    "WHERE slot NOT IN (SELECT slot FROM entries WHERE slot IS NOT NULL)",
+                    (self.capacity,),
+                )
+                con.execute("PRAGMA user_version = 1")
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+        arena = os.path.join(self.path, "vectors.f32")
+        size = self.capacity * self.dimensions * 4
+        with open(arena, "ab") as file:
+            if file.tell() < size:
+                file.truncate(size)
+        self.vectors = np.memmap(arena, dtype=np.float32, mode="r+",
+                                 shape=(self.capacity, self.dimensions))
+
+    def _connect(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(os.path.join(self.path, "cache.sqlite3"), timeout=30,
+                                  isolation_level=None)
+            self._local.con = con
+        return con
+
+    @staticmethod
+    def _digest(vector: "np.ndarray") -> str:
+        return hashlib.blake2b(vector.tobytes(), digest_size=16).hexdigest()
+
+    def _vector(self, slot: int, digest: str | None) -> "np.ndarray | None":
+        """Copy the vector of a slot if it still belongs to the row with `digest`."""
+        import numpy as np
+
+        vector = np.array(self.vectors[slot])
+        return vector if digest is not None and self._digest(vector) == digest else None
+
+    def _touch(self, namespace: str, key: str):
+        with self._touch_lock:
+            self._touched[(namespace, key)] = time.time()
+            flush = len(self._touched) >= self.TOUCH_BATCH
+        if flush:
+            con = self._connect()
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                self._flush_touches(con)
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+
+    def _flush_touches(self, con: sqlite3.Connection):
+        """Write the pending access times, within the caller's write transaction."""
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+        con.executemany(
+            "UPDATE entries SET used_at = MAX(used_at, ?) WHERE namespace = ? AND key = ?",
+            [(used_at, namespace, key) for (namespace, key), used_at in touched.items()],
+        )
+
+    def _row(self, con: sqlite3.Connection, namespace: str, key: str):
+        row = con.execute(
+            "SELECT value, slot, expires_at, digest FROM entries WHERE namespace = ? AND key = ?",
+            (namespace, key),
+        ).fetchone()
+        if row is None or row[2] is not None and row[2] < time.time():
+            # Expired entries are removed by the next `put`
+            return None
+        self._touch(namespace, key)
+        return row
+
+    def get(self, namespace: str, key: str):
+        row = self._row(self._connect(), namespace, key)
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def get_vector(self, namespace: str, key: str) -> "np.ndarray | None":
+        row = self._row(self._connect(), namespace, key)
+        return self._vector(row[1], row[3]) if row and row[1] is not None else None
+
+    def _free_slot(self, con: sqlite3.Connection) -> int:
+        row = con.execute("SELECT slot FROM free_slots LIMIT 1").fetchone()
+        if row is None:
+            # Arena is full, evict the least recently used vector
+            con.execute(
+                "DELETE FROM entries WHERE rowid = (SELECT rowid FROM entries "
+                "WHERE slot IS NOT NULL ORDER BY used_at LIMIT 1)"
+            )
+            row = con.execute("SELECT slot FROM free_slots LIMIT 1").fetchone()
+        con.execute("DELETE FROM free_slots WHERE slot = ?", (row[0],))
+        return row[0]
+
+    def put(self, namespace: str, key: str, value=None, vector=None, partition: str = "",
+            ttl: float | None = None, limit: int | None = None):
+        if vector is not None and len(vector) != self.dimensions:
+            raise ValueError(
+                f"Vector has {len(vector)} dimensions, the arena stores {self.dimensions}"
+            )
+        vector = None if vector is None else _normalize(vector)
+        now = time.time()
+        con = self._connect()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            self._flush_touches(con)
+            con.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries "
+                "WHERE expires_at < ? LIMIT 64)", (now,)
+            )
+            row = con.execute(
+                "SELECT slot, digest FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+            slot, digest = row if row else (None, None)
+            if vector is not None:
+                if slot is None:
+                    slot = self._free_slot(con)
+                # Written before the row which references the slot is committed;
+                # readers notice the mismatch with the old digest.
+                self.vectors[slot] = vector
+                digest = self._digest(vector)
+            con.execute(
+                "INSERT INTO entries (namespace, key, partition, value, slot, expires_at, "
+                "used_at, digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET partition = excluded.partition, "
+                "value = excluded.value, slot = excluded.slot, expires_at = excluded.expires_at, "
+                "used_at = excluded.used_at, digest = excluded.digest",
+                (namespace, key, partition, json.dumps(value, ensure_ascii=False), slot,
+                 None if ttl is None else now + ttl, now, digest),
+            )
+            if limit is not None and row is None:
+                con.execute(
+                    "DELETE FROM entries WHERE namespace = ? AND key IN (SELECT key FROM entries "
+                    "WHERE namespace = ? ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (namespace, namespace, limit),
+                )
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def nearest(self, namespace: str, vector, partition: str = "", threshold: float = -1.0
+                ) -> tuple | None:
+        import numpy as np
+
+        con = self._connect()
+        rows = con.execute(
+            "SELECT key, value, slot, digest FROM entries WHERE namespace = ? AND partition = ? "
+            "AND slot IS NOT NULL AND (expires_at IS NULL OR expires_at >= ?)",
+            (namespace, partition, time.time()),
+        ).fetchall()
+        if not rows:
+            return None
+        query = _normalize(vector)
+        scores = self.vectors[[row[2] for row in rows]] @ query
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        key, value, slot, digest = rows[best]
+        # The slot may have been evicted and rewritten since the rows were read
+        current = con.execute(
+            "SELECT value, digest FROM entries WHERE namespace = ? AND key = ? AND slot = ?",
+            (namespace, key, slot),
+        ).fetchone()
+        candidate = self._vector(slot, digest) if current and current[1] == digest else None
+        if candidate is None:
+            return None
+        similarity = float(candidate @ query)
+        if similarity < threshold:
+            return None
+        self._touch(namespace, key)
+        value = current[0]
+        return key, json.loads(value) if value is not None else None, similarity
+
+    def clear(self, namespace: str):
+        self._connect().execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+
+    def count(self, namespace: str) -> int:
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM entries WHERE namespace = ?", (namespace,)
+        ).fetchone()[0]
+
+
+@lru_cache(maxsize=None)
+def shared_store() -> CacheStore:
+    """Return the cache store of this process.
+
+    `CACHE_BACKEND=sqlite` (default) shares the cache between all workers of a
+    host, `CACHE_BACKEND=memory` keeps it in the process.
+    """
+    if os.environ.get("CACHE_BACKEND", "sqlite") == "memory":
+        return MemoryCacheStore()
+    return SQLiteCacheStore()
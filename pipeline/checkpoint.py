@@ -0,0 +1,198 @@
+"""Module which keeps track of the indexing state of the documents."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class IndexCheckpoint:
+    """Stores per-document checkpoints and the last processed CouchDB sequence.
+
+    A document only has to be indexed again if its revision, its checksum or the
+    indexing configuration (embedding model, collection, chunk size) changed.
+
+    Every change of the indexed content increments the generation of the
+    collection, which lets caches detect that their entries are outdated.
+    """
+
+    def __init__(self, path: str | None = None):
+        """Open (and create if necessary) the checkpoint database.
+
+        :param path: Path to the SQLite file. Defaults to the `INDEX_STATE_PATH`
+            environment variable or `../data/index_state.sqlite3`.
+        :type path: str | None
+        """
+        self.path = path or os.environ.get(
+            "INDEX_STATE_PATH", "../data/index_state.sqlite3"
+        )
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as con:
+            con.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    collection TEXT NOT NULL,
+                    document_id TEXT NOT NULL,
+                    rev TEXT,
+                    checksum TEXT,
+                    config TEXT NOT NULL,
+                    chunks INTEGER NOT NULL DEFAULT 0,
+                    indexed_at REAL NOT NULL,
+                    PRIMARY KEY (collection, document_id)
+                );
+                CREATE TABLE IF NOT EXISTS sequences (
+                    collection TEXT PRIMARY KEY,
+                    last_seq TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS generations (
+                    collection TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL
+                );
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        return con
+
+    @staticmethod
+    def fingerprint(config: dict) -> str:
+        """Return a stable hash of an indexing configuration.
+
+        :param config: Settings which influence the produced vectors.
+        :type config: dict
+        :return: Hex digest of the configuration.
+        :rtype: str
+        """
+        return hashlib.sha3_256(
+            json.dumps(config, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    @staticmethod
+    def _bump_generation(con: sqlite3.Connection, collection: str):
+        con.execute(
+            "INSERT INTO generations (collection, generation) VALUES (?, 1) "
+            "ON CONFLICT(collection) DO UPDATE SET generation = generation + 1",
+            (collection,),
+        )
+
+    def get_generation(self, collection: str) -> int:
+        """Return a counter which changes whenever the content of a collection changes."""
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT generation FROM generations WHERE collection = ?", (collection,)
+            ).fetchone()
+        return row["generation"] if row else 0
+
+    def get_sequence(self, collection: str) -> str:
+        """Return the last CouchDB sequence processed for a collection."""
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT last_seq FROM sequences WHERE collection = ?", (collection,)
+            ).fetchone()
+        return row["last_seq"] if row else "0"
+
+    def set_sequence(self, collection: str, last_seq: str):
+        """Persist the last CouchDB sequence processed for a collection."""
+        with self._connect() as con:
+            con.execute(
+                "INSERT INTO sequences (collection, last_seq) VALUES (?, ?) "
+                "ON CONFLICT(collection) DO UPDATE SET last_seq = excluded.last_seq",
+                (collection, str(last_seq)),
+            )
+
+    def get_document(self, collection: str, document_id: str) -> dict | None:
+        """Return the checkpoint of a document or `None` if it was never indexed."""
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT * FROM documents WHERE collection = ? AND document_id = ?",
+                (collection, document_id),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def is_current(self, collection: str, document_id: str, config: str, rev: str | None = None,
+                   checksum: str | None = None) -> bool:
+        """Check whether a document is already indexed with the given state.
+
+        :param collection: Name of the Qdrant collection.
+        :param document_id: CouchDB document ID.
+        :param config: Fingerprint of the indexing configuration.
+        :param rev: CouchDB revision. Compared if given.
+        :param checksum: Document checksum. Compared if given.
+        :return: `True` if nothing changed since the last indexing run.
+        :rtype: bool
+        """
+        checkpoint = self.get_document(collection, document_id)
+        if checkpoint is None or checkpoint["config"] != config:
+            return False
+        if rev is not None and checkpoint["rev"] == rev:
+            return True
+        return checksum is not None and checkpoint["checksum"] == checksum
+
+    def mark_indexed(self, collection: str, document_id: str, rev: str | None, checksum: str | None,
+                     config: str, chunks: int = 0):
+        """Record that a document has been indexed."""
+        with self._connect() as con:
+            con.execute(
+                "INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(collection, document_id) DO UPDATE SET rev = excluded.rev, "
+                "checksum = excluded.checksum, config = excluded.config, "
+                "chunks = excluded.chunks, indexed_at = excluded.indexed_at",
+                (collection, document_id, rev, checksum, config, chunks, time.time()),
+            )
+            self._bump_generation(con, collection)
+
+    def update_revision(self, collection: str, document_id: str, rev: str):
+        """Update the stored revision of a document whose content did not change."""
+        with self._connect() as con:
+            con.execute(
+                "UPDATE documents SET rev = ? WHERE collection = ? AND document_id = ?",
+                (rev, collection, document_id),
+            )
+
+    def remove(self, collection: str, document_id: str):
+        """Forget the checkpoint of a document."""
+        with self._connect() as con:
+            con.execute(
+                "DELETE FROM documents WHERE collection = ? AND document_id = ?",
+                (collection, document_id),
+            )
+            self._bump_generation(con, collection)
+
+    def reset(self, collection: str):
+        """Forget every checkpoint of a collection, e.g. after it was deleted."""
+        with self._connect() as con:
+            con.execute("DELETE FROM documents WHERE collection = ?", (collection,))
+            con.execute("DELETE FROM sequences WHERE collection = ?", (collection,))
+            self._bump_generation(con, collection)
+
+    def export_state(self, collection: str) -> dict:
+        """Return the checkpoints of a collection, e.g. to store them in a snapshot."""
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT document_id, rev, checksum, config, chunks, indexed_at "
+                "FROM documents WHERE collection = ?",
+                (collection,),
+            ).fetchall()
+        return {
+            "last_seq": self.get_sequence(collection),
+            "documents": [dict(row) for row in rows],
+        }
+
+    def import_state(self, collection: str, state: dict):
+        """Replace the checkpoints of a collection with a previously exported state."""
+        self.reset(collection)
+        with self._connect() as con:
+            con.executemany(
+                "INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (collection, row["document_id"], row["rev"], row["checksum"], row["config"],
+                     row["chunks"], row["indexed_at"])
+                    for row in state.get("documents", [])
+                ],
+            )
+        self.set_sequence(collection, state.get("last_seq", "0"))
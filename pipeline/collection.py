@@ -1,16 +1,64 @@
 """Module which manages Qdrant collections"""
 
-from qdrant_client import models
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as wait_futures
 
+from .checkpoint import IndexCheckpoint
+from .metrics import CALL_SECONDS
 from .vector import Vectorstore
 
+# Suffixes of the Azure deployments which are not part of the model name
+DEPLOYMENT_SUFFIXES = ("-sweden",)
+
+# Collections which existed before they were named after their model
+LEGACY_COLLECTIONS = {"text-embedding-ada-002-sweden": "text-embedding-3-small"}
+
+
+def collection_name(embedding_model: str) -> str:
+    """Return the collection holding the vectors of an embedding model.
+
+    The collection is named after the model, without the region of its
+    deployment: `text-embedding-3-large-sweden` -> `text-embedding-3-large`.
+    The ada-002 vectors stay in their existing collection.
+    """
+    if embedding_model in LEGACY_COLLECTIONS:
+        return LEGACY_COLLECTIONS[embedding_model]
+    for suffix in DEPLOYMENT_SUFFIXES:
+        embedding_model = embedding_model.removesuffix(suffix)
+    return embedding_model
+
+
+class _Pending:
+    """Points handed to `Collection.add`, resolved once all their batches are acknowledged."""
+
+    __slots__ = ("future", "count", "unsent", "in_flight")
+
+    def __init__(self, count: int):
+        self.future = Future()
+        self.count = count
+        self.unsent = count
+        self.in_flight = 0
+
+    def batch_done(self, error: BaseException | None):
+        self.in_flight -= 1
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        elif not self.unsent and not self.in_flight:
+            self.future.set_result(self.count)
+
 
 class Collection:
     """The `collection` class manages Qdrant collections and is used as a
     layer of abstraction to simplify and streamline Qdrant Collections.
     """
 
-    def __init__(self, vector_store: Vectorstore, collection_name):
+    def __init__(self, vector_store: Vectorstore, collection_name, parallel: int | None = None):
         """Instantiate a new Collection.
         This class is a wrapper around the Qdrant Collection API to simplify the API access.
 
@@ -18,9 +66,13 @@ class Collection:
         :type vector_store: Vectorstore
         :param collection_name: Name of the collection.
         :type collection_name: str
+        :param parallel: Number of parallel upload workers (`UPSERT_PARALLEL`, default 4).
+        :type parallel: int | None
         :raises RuntimeError: If the collection does not exist.
 
         """
+        from qdrant_client import models
+
         if not vector_store.client.collection_exists(collection_name):
             vector_store.client.create_collection(
                 collection_name,
@@ -32,14 +84,173 @@ class Collection:
         self.dimensions = vector_store.dimensions
         self.name = collection_name
         self.client = vector_store.client
+        self.parallel = int(os.environ.get("UPSERT_PARALLEL", 4)) if parallel is None else parallel
+        self.batch_size = int(os.environ.get("UPSERT_BATCH_SIZE", 64))
+        self._executor = None
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._outstanding = set()
+        self._acknowledged = None
+
+    def _submit(self, batch: list, max_retries: int, pending=()) -> Future:
+        """Upsert a batch in the background without waiting for Qdrant to apply it."""
+        # Bounded number of batches in flight, so buffered points stay few
+        while True:
+            with self._lock:
+                outstanding = set(self._outstanding)
+            if len(outstanding) < 2 * self.parallel:
+                break
+            wait_futures(outstanding, return_when=FIRST_COMPLETED)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.parallel,
+                                                    thread_name_prefix=f"upsert-{self.name}")
+            future = self._executor.submit(self._upsert, batch, False, max_retries)
+            self._outstanding.add(future)
+        future.add_done_callback(lambda done: self._batch_done(batch, pending, done))
+        return future
+
+    def _batch_done(self, batch: list, pending, future: Future):
+        error = future.exception()
+        with self._lock:
+            self._outstanding.discard(future)
+            if error is None:
+                self._acknowledged = batch
+        for entry in pending:
+            entry.batch_done(error)
+
+    def _take_batches(self, batch_size: int, partial: bool) -> list:
+        """Cut the buffer into batches; the rest stays buffered unless `partial`."""
+        batches = []
+        with self._lock:
+            while len(self._buffer) >= batch_size or partial and self._buffer:
+                taken, self._buffer = self._buffer[:batch_size], self._buffer[batch_size:]
+                pending = {}
+                for _, entry in taken:
+                    pending[entry] = pending.get(entry, 0) + 1
+                for entry, count in pending.items():
+                    entry.unsent -= count
+                    entry.in_flight += 1
+                batches.append(([point for point, _ in taken], list(pending)))
+        return batches
+
+    def add(self, points, batch_size: int | None = None, max_retries: int = 5) -> Future:
+        """Buffer points and upload them in batches of `batch_size` in the background.
+
+        Points of several calls are combined into one upsert request, so small
+        embedding batches still produce full upserts. Partial batches are sent
+        by `flush`.
+
+        :param points: Points to upload.
+        :type points: list|tuple|Iterable[models.PointStruct]
+        :param batch_size: Number of points per upsert request. Defaults to the
+            `batch_size` of the collection (`UPSERT_BATCH_SIZE`, default 64).
+        :type batch_size: int | None
+        :param max_retries: Retries per batch before the upload fails.
+        :type max_retries: int
+        :return: Future resolving to the number of points once every batch containing
+            them was acknowledged, or to the error of the first failed batch.
+        :rtype: Future
+        """
+        batch_size = batch_size or self.batch_size
+        points = list(points)
+        entry = _Pending(len(points))
+        if not points:
+            entry.future.set_result(0)
+            return entry.future
+        with self._lock:
+            self._buffer.extend((point, entry) for point in points)
+        for batch, pending in self._take_batches(batch_size, partial=False):
+            self._submit(batch, max_retries, pending)
+        return entry.future
+
+    def upload(self, points, batch_size: int = 64, parallel: int = 4, wait: bool = True,
+               max_retries: int = 5) -> int:
+        """Upload points to this collection in parallel batches.
+
+        Every batch is acknowledged as soon as Qdrant accepted it (`wait=False`),
+        so the upload is not slowed down by the indexing of the previous batch.
+        Batches rejected with 429 or 5xx (or failing on the network) are retried
+        with exponential backoff.
+
+        :param points: List, tuple or any iterable (e.g. a generator) of points.
+            Iterables are consumed lazily, only a few batches are held in memory.
+        :type points: list|tuple|Iterable[models.PointStruct]
+        :param batch_size: Number of points per upsert request.
+        :type batch_size: int
+        :param parallel: Number of parallel upload workers, if the collection has
+            not started its workers yet.
+        :type parallel: int
+        :param wait: Block until every uploaded point has been applied (see `flush`).
+        :type wait: bool
+        :param max_retries: Retries per batch before the upload fails.
+        :type max_retries: int
+        :return: Number of uploaded points.
+        :rtype: int
+        """
+        with self._lock:
+            if self._executor is None:
+                self.parallel = parallel
+        iterator = iter(points)
+        futures = []
+        while batch := list(itertools.islice(iterator, batch_size)):
+            futures.append(self._submit(batch, max_retries))
+        uploaded = sum(future.result() for future in futures)
+
+        if wait:
+            self.flush(max_retries)
+        return uploaded
 
-    def upload(self, points: list | tuple):
-        """Upload a list of points to this collection.
+    def flush(self, max_retries: int = 5):
+        """Consistency barrier for uploads which were not awaited.
 
-        :param points: List or tuple of points
-        :type points: list|tuple
+        Sends the buffered points and waits until every batch was acknowledged,
+        including batches still retrying. Qdrant applies the updates of a
+        collection in order, so upserting the last acknowledged batch again
+        (idempotent) with `wait=True` returns only once every batch has been
+        applied as well.
         """
-        self.client.upload_points(self.name, points)
+        for batch, pending in self._take_batches(self.batch_size, partial=True):
+            self._submit(batch, max_retries, pending)
+        while True:
+            with self._lock:
+                outstanding = set(self._outstanding)
+            if not outstanding:
+                break
+            wait_futures(outstanding)
+        with self._lock:
+            batch, self._acknowledged = self._acknowledged, None
+        if batch:
+            self._upsert(batch, True, max_retries)
+
+    def close(self):
+        """Flush the collection and stop its upload workers."""
+        self.flush()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _upsert(self, batch: list, wait: bool, max_retries: int) -> int:
+        from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
+
+        for attempt in itertools.count():
+            try:
+                with CALL_SECONDS.time(service="qdrant"):
+                    self.client.upsert(self.name, points=batch, wait=wait)
+                return len(batch)
+            except (UnexpectedResponse, ResponseHandlingException) as e:
+                status_code = getattr(e, "status_code", None)
+                retryable = status_code is None or status_code == 429 or status_code >= 500
+                if not retryable or attempt >= max_retries:
+                    raise
+                delay = min(2 ** attempt, 30)
+                if status_code == 429 and e.headers.get("Retry-After", "").isdigit():
+                    delay = int(e.headers["Retry-After"])
+                logging.warning(
+                    f"Upsert into {self.name} failed ({status_code or e}), retrying in {delay}s"
+                )
+                time.sleep(delay)
 
     def __str__(self):
         """Returns the name of the collection as a string."""
@@ -48,3 +259,91 @@ class Collection:
     def __repr__(self):
         """Returns a string representation of the object."""
         return f"Collection(client={self.client},collection_name={self.name})"
+
+
+class IndexTarget:
+    """An embedding model and the collection its vectors are indexed into."""
+
+    def __init__(self, vector_store: Vectorstore, collection: str | None = None):
+        """Create a target.
+
+        :param vector_store: Vectorstore of the embedding model.
+        :type vector_store: Vectorstore
+        :param collection: Name of the collection. Defaults to `collection_name`
+            of the model.
+        :type collection: str | None
+        """
+        self.vs = vector_store
+        self.collection = collection or collection_name(vector_store.embedding_model)
+        self._index = None
+        self._validated = False
+
+    def validate(self):
+        """Check that the target can be indexed into; the result is kept after the first success.
+
+        Creates the embedding client and calls Qdrant, so it is run before the
+        first indexing job rather than when the target is created.
+
+        :raises ValueError: If there is no client for the embedding model, or the
+            collection exists with vectors of another size.
+        """
+        if self._validated:
+            return
+        model = self.vs.embedding_model
+        if self.vs.aoai is None:
+            raise ValueError(
+                f"No embedding client for {model}: add a deployment of the model to "
+                f"AZURE_EMBEDDING_DEPLOYMENTS or remove it from INDEX_TARGETS."
+            )
+        try:
+            if not self.vs.client.collection_exists(self.collection):
+                return
+            vectors = self.vs.client.get_collection(self.collection).config.params.vectors
+        except Exception as e:
+            # Qdrant may be unreachable, the upload fails loudly if the size is wrong
+            logging.warning(f"Could not check the collection {self.collection}: {e!r}")
+            return
+        size = getattr(vectors, "size", None)
+        if size is not None and size != self.vs.dimensions:
+            raise ValueError(
+                f"Collection {self.collection} holds vectors of size {size}, "
+                f"{model} produces {self.vs.dimensions}."
+            )
+        self._validated = True
+
+    @classmethod
+    def from_env(cls) -> list:
+        """Return the targets listed in `INDEX_TARGETS`.
+
+        A comma separated list of embedding models, each optionally followed by
+        `=<collection>`, e.g. `text-embedding-ada-002-sweden,text-embedding-3-large=large`.
+        Defaults to `text-embedding-ada-002-sweden`.
+
+        :rtype: list[IndexTarget]
+        """
+        from .resources import resources
+
+        targets = []
+        for entry in os.environ.get("INDEX_TARGETS", "text-embedding-ada-002-sweden").split(","):
+            model, _, collection = entry.strip().partition("=")
+            if model:
+                targets.append(cls(resources.vectorstore(model), collection.strip() or None))
+        return targets
+
+    @property
+    def index(self) -> Collection:
+        """Upload buffer of the collection, created on first use."""
+        if self._index is None:
+            self._index = Collection(self.vs, self.collection)
+        return self._index
+
+    def config(self, chunk_size: int) -> str:
+        """Fingerprint of every setting which influences the vectors of this target."""
+        return IndexCheckpoint.fingerprint({
+            "embedding_model": self.vs.embedding_model,
+            "collection": self.collection,
+            "chunk_size": chunk_size,
+        })
+
+    def __repr__(self):
+        return f"IndexTarget(model={self.vs.embedding_model},collection={self.collection})"
@@ -0,0 +1,387 @@
+"""Load balancing over several Azure OpenAI deployments.
+
+A `DeploymentPool` spreads the calls of a service ("llm", "embedding") over
+the deployments configured in `AZURE_<SERVICE>_DEPLOYMENTS`, a JSON list like
+
+    [{"name": "sweden", "endpoint": "https://….openai.azure.com", "api_key": "…",
+      "api_version": "2024-02-01", "model": "gpt-4o-sweden", "weight": 1}, …]
+
+`model` is the deployment name in that resource; it replaces the `model` of
+the request. Embedding deployments are pooled per embedding model: an entry
+belongs to the pool of its `embedding_model` (defaults to `model`), so a
+`Vectorstore` is never balanced onto a deployment of another model. Calls are routed to the deployment with the lowest latency,
+weighted by its calls in flight and its recent error rate. Deployments which
+fail repeatedly or answer 429 are skipped by a circuit breaker until they
+cool down; failed calls are retried once on another deployment.
+
+With hedging (`AZURE_<SERVICE>_HEDGE=1`) a duplicate request is sent to a
+second deployment if the first one did not answer within its p95 latency.
+The first answer is used and the other request is cancelled.
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from .metrics import DEPLOYMENT_CALLS, DEPLOYMENT_SECONDS
+
+
+def _retryable(error: BaseException) -> bool:
+    """Whether an error is caused by the deployment (throttling, outage, timeout)
+    rather than by the request, so another deployment may succeed."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in (408, 409, 429) or status_code >= 500
+    if isinstance(error, (asyncio.TimeoutError, OSError)):
+        return True
+    try:
+        from openai import APIConnectionError
+    except ImportError:
+        return False
+    return isinstance(error, APIConnectionError)
+
+
+def _retry_after(error: BaseException) -> float | None:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures for `reset_timeout` seconds.
+
+    Once the timeout has passed, calls are let through again (half-open); the
+    first failure opens the breaker again, the first success closes it.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allows(self, now: float | None = None) -> bool:
+        return (time.monotonic() if now is None else now) >= self.open_until
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self, cooldown: float | None = None):
+        """Count a failure; `cooldown` (e.g. a `Retry-After`) opens the breaker right away."""
+        self.failures += 1
+        now = time.monotonic()
+        if self.failures >= self.threshold:
+            self.open_until = max(self.open_until, now + self.reset_timeout)
+        if cooldown:
+            self.open_until = max(self.open_until, now + cooldown)
+
+    @property
+    def state(self) -> str:
+        if not self.allows():
+            return "open"
+        return "half-open" if self.failures >= self.threshold else "closed"
+
+
+class Deployment:
+    """An Azure OpenAI deployment with its latency and error statistics."""
+
+    def __init__(self, name: str, client=None, model: str | None = None,
+                 endpoint: str | None = None, api_key: str | None = None,
+                 api_version: str | None = None, weight: float = 1.0, max_retries: int = 0,
+                 breaker: CircuitBreaker | None = None):
+        """Create a deployment.
+
+        :param name: Name used in logs and metrics.
+        :type name: str
+        :param client: AsyncAzureOpenAI client. Created on first use from
+            `endpoint`, `api_key` and `api_version` if omitted.
+        :param model: Deployment name which replaces the `model` of the requests.
+        :type model: str | None
+        :param weight: Relative capacity; higher weights receive more calls.
+        :type weight: float
+        :param max_retries: Retries of the client itself before the pool fails over.
+        :type max_retries: int
+        :param breaker: Circuit breaker of the deployment.
+        :type breaker: CircuitBreaker | None
+        """
+        self.name = name
+        self.model = model
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.api_version = api_version
+        self.weight = weight
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+        self._client = client
+        self.latency = None
+        self.updated = time.monotonic()
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=200)
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import AsyncAzureOpenAI
+
+            self._client = AsyncAzureOpenAI(azure_endpoint=self.endpoint, api_key=self.api_key,
+                                            api_version=self.api_version,
+                                            max_retries=self.max_retries)
+        return self._client
+
+    def score(self, half_life: float = 30.0) -> float:
+        """Expected cost of sending the next call here, lower is better.
+
+        Deployments without any successful call yet are tried first. The
+        latency estimate halves every `half_life` seconds without a call, so a
+        deployment which was slow once is tried again eventually.
+        """
+        if self.latency is None:
+            return self.in_flight
+        latency = self.latency * 0.5 ** ((time.monotonic() - self.updated) / half_life)
+        return latency * (1 + self.in_flight) * (1 + 4 * self.error_rate) / self.weight
+
+    def quantile(self, q: float) -> float | None:
+        """Latency quantile of the recent successful calls, `None` without enough samples."""
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+    def success(self, elapsed: float):
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        self.updated = time.monotonic()
+        self.latencies.append(elapsed)
+        self.error_rate *= 0.8
+        self.breaker.success()
+
+    def failure(self, error: BaseException):
+        self.error_rate = 0.8 * self.error_rate + 0.2
+        self.breaker.failure(_retry_after(error) if getattr(error, "status_code", None) == 429
+                             else None)
+
+    def stats(self) -> dict:
+        return {"name": self.name, "state": self.breaker.state, "in_flight": self.in_flight,
+                "latency": self.latency, "p95": self.quantile(0.95),
+                "error_rate": round(self.error_rate, 4)}
+
+
+class DeploymentPool:
+    """Routes the calls of a service to the best of several deployments."""
+
+    def __init__(self, service: str, deployments: list, hedge: bool = False,
+                 hedge_quantile: float = 0.95, hedge_delay: float = 1.0):
+        """Create a pool.
+
+        :param service: Name of the service, label of the metrics.
+        :type service: str
+        :param deployments: The `Deployment` objects.
+        :type deployments: list
+        :param hedge: Send a duplicate request to a second deployment if the
+            first one is slower than its `hedge_quantile` latency.
+        :type hedge: bool
+        :param hedge_quantile: Latency quantile after which a call is hedged.
+        :type hedge_quantile: float
+        :param hedge_delay: Hedging delay in seconds as long as a deployment has
+            too few samples for the quantile.
+        :type hedge_delay: float
+        """
+        if not deployments:
+            raise ValueError("A deployment pool needs at least one deployment.")
+        self.service = service
+        self.deployments = list(deployments)
+        self.hedge = hedge and len(self.deployments) > 1
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+
+    @classmethod
+    def from_env(cls, service: str, embedding_model: str | None = None
+                 ) -> "DeploymentPool | None":
+        """Create the pool of a service from `AZURE_<SERVICE>_DEPLOYMENTS`.
+
+        Also reads `AZURE_<SERVICE>_HEDGE`, `AZURE_<SERVICE>_HEDGE_DELAY`,
+        `AZURE_BREAKER_FAILURES` and `AZURE_BREAKER_RESET`.
+
+        :param embedding_model: Only use the deployments of this embedding model
+            (their `embedding_model`, or else their `model`).
+        :type embedding_model: str | None
+        :return: The pool, or `None` if no (matching) deployments are configured.
+        """
+        prefix = f"AZURE_{service.upper()}"
+        config = os.environ.get(f"{prefix}_DEPLOYMENTS")
+        if not config:
+            return None
+        entries = [entry for entry in json.loads(config)
+                   if embedding_model is None
+                   or entry.get("embedding_model", entry.get("model")) == embedding_model]
+        if not entries:
+            return None
+        deployments = [
+            Deployment(breaker=CircuitBreaker(int(os.environ.get("AZURE_BREAKER_FAILURES", 5)),
+                                              float(os.environ.get("AZURE_BREAKER_RESET", 30))),
+                       **{key: entry[key] for key in entry
+                          if key in ("name", "model", "endpoint", "api_key", "api_version",
+                                     "weight", "max_retries")})
+            for entry in entries
+        ]
+        return cls(service, deployments,
+                   hedge=os.environ.get(f"{prefix}_HEDGE", "0").lower() in ("1", "true", "yes"),
+                   hedge_delay=float(os.environ.get(f"{prefix}_HEDGE_DELAY", 1.0)))
+
+    def choose(self, exclude=()) -> Deployment | None:
+        """Return the deployment for the next call.
+
+        Deployments with an open circuit breaker are skipped unless all are
+        open; then the one which reopens first is used.
+        """
+        candidates = [deployment for deployment in self.deployments if deployment not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        available = [deployment for deployment in candidates if deployment.breaker.allows(now)]
+        if not available:
+            return min(candidates, key=lambda deployment: deployment.breaker.open_until)
+        return min(available, key=lambda deployment: (deployment.score(), random.random()))
+
+    async def _attempt(self, deployment: Deployment, fn):
+        deployment.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = await fn(deployment)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if _retryable(e):
+                deployment.failure(e)
+                DEPLOYMENT_CALLS.inc(service=self.service, deployment=deployment.name,
+                                     result="failure")
+                logging.warning(f"{self.service} deployment {deployment.name} failed: {e!r}")
+            raise
+        finally:
+            deployment.in_flight -= 1
+        elapsed = time.perf_counter() - start
+        deployment.success(elapsed)
+        DEPLOYMENT_SECONDS.observe(elapsed, service=self.service, deployment=deployment.name)
+        DEPLOYMENT_CALLS.inc(service=self.service, deployment=deployment.name, result="success")
+        return result
+
+    async def call(self, fn):
+        """Run `await fn(deployment)` on the best deployment.
+
+        :param fn: Coroutine function receiving the `Deployment`.
+        :raises Exception: The error of the last deployment which was tried.
+        :return: The result of the first successful call.
+        """
+        first = self.choose()
+        if self.hedge:
+            return await self._hedged(fn, first)
+        try:
+            return await self._attempt(first, fn)
+        except Exception as e:
+            fallback = self.choose(exclude={first}) if _retryable(e) else None
+            if fallback is None:
+                raise
+        return await self._attempt(fallback, fn)
+
+    def _hedge_after(self, deployment: Deployment) -> float:
+        quantile = deployment.quantile(self.hedge_quantile)
+        return self.hedge_delay if quantile is None else quantile
+
+    async def _hedged(self, fn, first: Deployment):
+        primary = asyncio.ensure_future(self._attempt(first, fn))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self._hedge_after(first))
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        second = None if done else self.choose(exclude={first})
+        if second is None:
+            try:
+                return await primary
+            except Exception as e:
+                fallback = self.choose(exclude={first}) if _retryable(e) else None
+                if fallback is None:
+                    raise
+            return await self._attempt(fallback, fn)
+
+        DEPLOYMENT_CALLS.inc(service=self.service, deployment=second.name, result="hedged")
+        hedge = asyncio.ensure_future(self._attempt(second, fn))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    for task in winners[1:]:
+                        await _discard(task.result())
+                    if winners[0] is hedge:
+                        DEPLOYMENT_CALLS.inc(service=self.service, deployment=second.name,
+                                             result="hedge_won")
+                    return winners[0].result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        """Close the clients of the deployments."""
+        for deployment in self.deployments:
+            if deployment._client is not None:
+                await deployment._client.close()
+
+    def stats(self) -> dict:
+        """Return the routing state of every deployment."""
+        return {"service": self.service, "hedge": self.hedge,
+                "deployments": [deployment.stats() for deployment in self.deployments]}
+
+
+async def _discard(result):
+    """Close the result of a losing hedged request, e.g. an unread stream."""
+    close = getattr(result, "close", None)
+    if close is not None:
+        try:
+            closed = close()
+            if asyncio.iscoroutine(closed):
+                await closed
+        except Exception as e:
+            logging.debug(f"Failed to close a hedged response: {e!r}")
+
+
+class BalancedClient:
+    """Stand-in for `AsyncAzureOpenAI` which routes through a `DeploymentPool`.
+
+    Supports `chat.completions.create` (also with `stream=True`) and
+    `embeddings.create`, the calls made by the pipelines.
+    """
+
+    def __init__(self, pool: DeploymentPool):
+        self.pool = pool
+        # Part of the memo keys of the completions
+        self.base_url = f"pool:{pool.service}"
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    @staticmethod
+    def _kwargs(deployment: Deployment, kwargs: dict) -> dict:
+        return {**kwargs, "model": deployment.model} if deployment.model else kwargs
+
+    async def _chat(self, **kwargs):
+        return await self.pool.call(lambda deployment: deployment.client.chat.completions.create(
+            **self._kwargs(deployment, kwargs)))
+
+    async def _embed(self, **kwargs):
+        return await self.pool.call(lambda deployment: deployment.client.embeddings.create(
+            **self._kwargs(deployment, kwargs)))
+
+    async def close(self):
+        await self.pool.aclose()
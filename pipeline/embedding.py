@@ -2,8 +2,6 @@
 
 import time
 
-from qdrant_client import models
-
 from .vector import Vectorstore
 
 
@@ -51,6 +49,8 @@ class Embedding:
 
     def _create_vector_points(self, embedding_data, texts):
         """Create a list of vector points from embedding data and texts."""
+        from qdrant_client import models
+
         return [
             models.PointStruct(
                 id=int(time.time() * 1000),  # More precise unique IDs
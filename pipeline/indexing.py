@@ -0,0 +1,119 @@
+"""Module with a staged producer/consumer pipeline used by indexing jobs."""
+
+import asyncio
+import logging
+
+from .tracing import NULL_TRACE
+
+_DONE = object()
+
+
+class Stage:
+    """A single step of a `StagedPipeline`.
+
+    The handler is a coroutine function `handler(item, emit)`. It may call
+    `await emit(result)` any number of times to pass results to the next stage.
+    """
+
+    def __init__(self, name: str, handler, concurrency: int = 1, queue_size: int | None = None,
+                 on_error=None):
+        """Create a new pipeline stage.
+
+        :param name: Name of the stage, used for logging and statistics.
+        :type name: str
+        :param handler: Coroutine function `handler(item, emit)`.
+        :param concurrency: Number of workers consuming the input queue of this stage.
+        :type concurrency: int
+        :param queue_size: Capacity of the input queue. A full queue blocks the previous
+            stage (backpressure). Defaults to twice the concurrency.
+        :type queue_size: int | None
+        :param on_error: Function `on_error(item, exception)` called when the handler
+            raises, e.g. to record the item as failed before it is dropped.
+        """
+        if concurrency < 1:
+            raise ValueError("A stage needs at least one worker.")
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue_size = queue_size or 2 * concurrency
+        self.on_error = on_error
+        self.processed = 0
+        self.failed = 0
+
+
+class StagedPipeline:
+    """Runs items through a chain of stages with bounded queues between them.
+
+    Every stage has its own workers, so network, CPU and database work of
+    different items overlap, while the bounded queues keep the number of items
+    in flight (and therefore the memory usage) independent of the input size.
+    """
+
+    def __init__(self, stages: list | tuple):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = list(stages)
+
+    async def run(self, items, trace=NULL_TRACE) -> dict:
+        """Feed `items` into the first stage and wait until every stage is drained.
+
+        Exceptions raised by a handler are logged, counted and passed to the
+        `on_error` function of the stage; the item is dropped and the pipeline
+        keeps running.
+
+        :param items: Iterable of input items for the first stage.
+        :param trace: Trace receiving one span per handler call. The wall time of a
+            span includes the time the handler waited for the next stage's queue.
+        :type trace: Trace | NullTrace
+        :return: Statistics per stage.
+        :rtype: dict
+        """
+        queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self.stages]
+
+        async def close(index):
+            if index < len(self.stages):
+                for _ in range(self.stages[index].concurrency):
+                    await queues[index].put(_DONE)
+
+        async def feed():
+            for item in items:
+                await queues[0].put(item)
+            await close(0)
+
+        async def work(index, stage):
+            inbox = queues[index]
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+
+            async def emit(result):
+                if outbox is not None:
+                    await outbox.put(result)
+
+            while (item := await inbox.get()) is not _DONE:
+                try:
+                    with trace.span(stage.name):
+                        await stage.handler(item, emit)
+                    stage.processed += 1
+                except Exception as e:
+                    stage.failed += 1
+                    logging.error(f"Indexing stage '{stage.name}' failed: {e}")
+                    if stage.on_error is not None:
+                        try:
+                            stage.on_error(item, e)
+                        except Exception as error:
+                            logging.error(
+                                f"Error handler of stage '{stage.name}' failed: {error!r}"
+                            )
+
+        async def run_stage(index, stage):
+            await asyncio.gather(*[work(index, stage) for _ in range(stage.concurrency)])
+            await close(index + 1)
+
+        await asyncio.gather(feed(), *[run_stage(i, s) for i, s in enumerate(self.stages)])
+        return self.stats()
+
+    def stats(self) -> dict:
+        """Return the number of processed and failed items per stage."""
+        return {
+            stage.name: {"processed": stage.processed, "failed": stage.failed}
+            for stage in self.stages
+        }
@@ -0,0 +1,299 @@
+"""Module with a durable job store shared by all workers of a host."""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+
+class JobStore:
+    """Stores indexing jobs, their per-document progress and a lease.
+
+    The store lives in a local SQLite file, so every uvicorn worker on the host
+    sees the same jobs. The lease guarantees that only one worker is indexing at
+    a time; a lease which is not renewed expires, so a crashed worker's job can be
+    resumed by another worker (or after a restart).
+    """
+
+    LEASE = "indexing"
+
+    def __init__(self, path: str | None = None, lease_ttl: int = 60):
+        """Open (and create if necessary) the job database.
+
+        :param path: Path to the SQLite file. Defaults to the `INDEX_STATE_PATH`
+            environment variable or `../data/index_state.sqlite3`.
+        :type path: str | None
+        :param lease_ttl: Seconds until a lease which is not renewed expires.
+        :type lease_ttl: int
+        """
+        self.path = path or os.environ.get(
+            "INDEX_STATE_PATH", "../data/index_state.sqlite3"
+        )
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    chunks INTEGER NOT NULL DEFAULT 0,
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    run_started_at REAL,
+                    run_base_done INTEGER NOT NULL DEFAULT 0,
+                    run_base_chunks INTEGER NOT NULL DEFAULT 0,
+                    run_base_tokens INTEGER NOT NULL DEFAULT 0,
+                    error TEXT
+                );
+                CREATE TABLE IF NOT EXISTS job_documents (
+                    job_id TEXT NOT NULL,
+                    document_id TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    chunks INTEGER NOT NULL DEFAULT 0,
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (job_id, document_id)
+                );
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    job_id TEXT,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS signals (
+                    name TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (name, owner)
+                );
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def acquire_lease(self, job_id: str | None = None) -> bool:
+        """Try to become the only indexing worker of the host.
+
+        A lease which is held already can only be taken again by its owner for
+        the same job, so a second job of the same worker is refused as well.
+
+        :param job_id: Job the lease is taken for.
+        :return: `True` if the lease is now held by this store's owner.
+        :rtype: bool
+        """
+        now = time.time()
+        with self._connect() as con:
+            cursor = con.execute(
+                "INSERT INTO leases (name, owner, job_id, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, job_id = excluded.job_id, "
+                "expires_at = excluded.expires_at WHERE leases.expires_at < ? "
+                "OR (leases.owner = ? AND leases.job_id = ?)",
+                (self.LEASE, self.owner, job_id, now + self.lease_ttl, now, self.owner, job_id),
+            )
+            return cursor.rowcount == 1
+
+    def renew_lease(self) -> bool:
+        """Extend the lease. Returns `False` if it was lost to another worker."""
+        with self._connect() as con:
+            cursor = con.execute(
+                "UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?",
+                (time.time() + self.lease_ttl, self.LEASE, self.owner),
+            )
+            return cursor.rowcount == 1
+
+    def release_lease(self):
+        """Give up the lease if it is held by this store's owner."""
+        with self._connect() as con:
+            con.execute(
+                "DELETE FROM leases WHERE name = ? AND owner = ?", (self.LEASE, self.owner)
+            )
+
+    def lease_active(self) -> bool:
+        """Check whether any worker currently holds the lease."""
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT expires_at FROM leases WHERE name = ?", (self.LEASE,)
+            ).fetchone()
+        return row is not None and row["expires_at"] >= time.time()
+
+    def set_signal(self, name: str, value: float):
+        """Publish a timestamp (`time.time()`) of this store's owner to the other workers.
+
+        Used by the scheduler for the end of the interactive load and of a
+        rate limit pause. Signals which are older than an hour are removed.
+        """
+        now = time.time()
+        with self._connect() as con:
+            con.execute(
+                "INSERT INTO signals (name, owner, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(name, owner) DO UPDATE SET value = excluded.value",
+                (name, self.owner, value),
+            )
+            con.execute("DELETE FROM signals WHERE value < ?", (now - 3600,))
+
+    def signals(self) -> dict:
+        """Return the latest timestamp of every signal over all workers."""
+        with self._connect() as con:
+            rows = con.execute("SELECT name, MAX(value) FROM signals GROUP BY name").fetchall()
+        return {name: value for name, value in rows}
+
+    def create_job(self, kind: str, documents: list | tuple, params: dict | None = None) -> str:
+        """Create a job together with its list of documents.
+
+        :param kind: Type of the job, e.g. `"full"` or `"incremental"`.
+        :param documents: IDs of the documents the job has to process.
+        :param params: Additional parameters needed to resume the job.
+        :return: ID of the new job.
+        :rtype: str
+        """
+        job_id = uuid.uuid4().hex
+        with self._connect() as con:
+            con.execute(
+                "INSERT INTO jobs (id, kind, status, params, total, created_at) "
+                "VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(params or {}), len(documents), time.time()),
+            )
+            con.executemany(
+                "INSERT OR IGNORE INTO job_documents (job_id, document_id) VALUES (?, ?)",
+                [(job_id, document) for document in documents],
+            )
+        return job_id
+
+    def add_documents(self, job_id: str, documents: list | tuple, params: dict | None = None):
+        """Add documents (and parameters) to a job which has not been started yet."""
+        with self._connect() as con:
+            con.executemany(
+                "INSERT OR IGNORE INTO job_documents (job_id, document_id) VALUES (?, ?)",
+                [(job_id, document) for document in documents],
+            )
+            con.execute(
+                "UPDATE jobs SET total = (SELECT COUNT(*) FROM job_documents WHERE job_id = ?), "
+                "params = COALESCE(?, params) WHERE id = ?",
+                (job_id, json.dumps(params) if params is not None else None, job_id),
+            )
+
+    def start_job(self, job_id: str):
+        """Mark a job as running; also used when an interrupted job is resumed."""
+        now = time.time()
+        with self._connect() as con:
+            con.execute(
+                "UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?), "
+                "run_started_at = ?, run_base_done = done, run_base_chunks = chunks, "
+                "run_base_tokens = tokens, error = NULL WHERE id = ?",
+                (now, now, job_id),
+            )
+
+    def pending_documents(self, job_id: str) -> list:
+        """Return the documents of a job which have not been processed yet."""
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT document_id FROM job_documents WHERE job_id = ? AND status = 'pending'",
+                (job_id,),
+            ).fetchall()
+        return [row["document_id"] for row in rows]
+
+    def document_done(self, job_id: str, document_id: str, chunks: int = 0, tokens: int = 0,
+                      failed: bool = False):
+        """Checkpoint the progress of a job after one of its documents was processed."""
+        with self._connect() as con:
+            cursor = con.execute(
+                "UPDATE job_documents SET status = ?, chunks = ?, tokens = ? "
+                "WHERE job_id = ? AND document_id = ? AND status = 'pending'",
+                ("failed" if failed else "done", chunks, tokens, job_id, document_id),
+            )
+            if cursor.rowcount:
+                con.execute(
+                    "UPDATE jobs SET done = done + 1, failed = failed + ?, chunks = chunks + ?, "
+                    "tokens = tokens + ? WHERE id = ?",
+                    (int(failed), chunks, tokens, job_id),
+                )
+
+    def finish_job(self, job_id: str, error: str | None = None, stats: dict | None = None):
+        """Mark a job as completed or, if an error is given, as failed.
+
+        :param stats: Stage breakdown of the last run, stored as `params["stats"]`.
+        :type stats: dict | None
+        """
+        with self._connect() as con:
+            con.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ?, "
+                "params = CASE WHEN ? IS NULL THEN params ELSE json_set(params, '$.stats', json(?)) "
+                "END WHERE id = ?",
+                ("failed" if error else "completed", time.time(), error,
+                 *[json.dumps(stats) if stats is not None else None] * 2, job_id),
+            )
+
+    @staticmethod
+    def _kinds(kinds: list | tuple | None) -> tuple:
+        """SQL condition and parameters restricting a query to some kinds of jobs."""
+        if not kinds:
+            return "1", ()
+        return f"kind IN ({', '.join('?' * len(kinds))})", tuple(kinds)
+
+    def unfinished_jobs(self, kinds: list | tuple | None = None) -> list:
+        """Return queued and running jobs, oldest first.
+
+        If nobody holds the lease, these jobs were interrupted and can be resumed.
+
+        :param kinds: Only return jobs of these kinds.
+        :type kinds: list | tuple | None
+        """
+        condition, params = self._kinds(kinds)
+        with self._connect() as con:
+            rows = con.execute(
+                f"SELECT * FROM jobs WHERE status IN ('queued', 'running') AND {condition} "
+                "ORDER BY created_at", params
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def get_job(self, job_id: str) -> dict | None:
+        """Return a job including its progress, throughput and ETA."""
+        with self._connect() as con:
+            row = con.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def latest_job(self, kinds: list | tuple | None = None) -> dict | None:
+        """Return the most recently created job, optionally only of some kinds."""
+        condition, params = self._kinds(kinds)
+        with self._connect() as con:
+            row = con.execute(
+                f"SELECT * FROM jobs WHERE {condition} ORDER BY created_at DESC LIMIT 1", params
+            ).fetchone()
+        return self._to_dict(row) if row else None
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["progress"] = round(job["done"] / job["total"], 4) if job["total"] else 1.0
+
+        elapsed = time.time() - job["run_started_at"] if job["run_started_at"] else 0
+        if job["status"] == "running" and elapsed > 0:
+            docs_per_second = (job["done"] - job["run_base_done"]) / elapsed
+            job["chunks_per_second"] = round((job["chunks"] - job["run_base_chunks"]) / elapsed, 2)
+            job["tokens_per_second"] = round((job["tokens"] - job["run_base_tokens"]) / elapsed, 2)
+            job["eta_seconds"] = (
+                round((job["total"] - job["done"]) / docs_per_second, 1) if docs_per_second else None
+            )
+        else:
+            job["chunks_per_second"] = job["tokens_per_second"] = job["eta_seconds"] = None
+
+        for key in ("run_base_done", "run_base_chunks", "run_base_tokens"):
+            del job[key]
+        return job
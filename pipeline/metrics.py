@@ -0,0 +1,307 @@
+"""In-process counters and latency histograms in the Prometheus text format.
+
+Every worker keeps its own registry and periodically writes a snapshot into
+`METRICS_PATH`; the `/metrics` route merges the snapshots of all living
+workers of the host, so the scraped values cover the whole server. Snapshots
+of exited workers are folded into `exited.json`, which keeps the counters
+monotonic when a worker is restarted.
+"""
+
+import bisect
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+# Upper bounds in seconds, from fast cache lookups to slow LLM answers
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                   60, 120)
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Metric:
+    """Base class of the metric types; values are kept per label combination."""
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels: list | tuple = (), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "type": self.type, "help": self.help, "labels": self.labels,
+                "values": [[list(key), value] for key, value in self.values.items()],
+            }
+
+
+class Counter(Metric):
+    """Monotonically increasing counter."""
+
+    type = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Histogram(Metric):
+    """Fixed-bucket histogram, e.g. of latencies in seconds.
+
+    Quantiles (p50, p95, p99) are computed by Prometheus with
+    `histogram_quantile` from the cumulative buckets.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: list | tuple = (),
+                 buckets: list | tuple = DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, followed by the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels) -> _Timer:
+        """Context manager observing the runtime of its block."""
+        return _Timer(self, labels)
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        snapshot["buckets"] = self.buckets
+        return snapshot
+
+
+class Registry:
+    """Metrics of a worker."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def snapshot(self) -> dict:
+        """Return the current values of every metric, JSON serializable."""
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+REGISTRY = Registry()
+
+
+def _path() -> str:
+    return os.environ.get("METRICS_PATH", "../data/metrics")
+
+
+def write_snapshot(registry: Registry = REGISTRY, path: str | None = None):
+    """Write the snapshot of this worker to `<METRICS_PATH>/<pid>.json`."""
+    path = path or _path()
+    os.makedirs(path, exist_ok=True)
+    target = os.path.join(path, f"{os.getpid()}.json")
+    with open(target + ".tmp", "w") as file:
+        json.dump(registry.snapshot(), file)
+    os.replace(target + ".tmp", target)
+
+
+def process_alive(pid: int) -> bool:
+    """Check whether a process of this host is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Aggregate of the snapshots of exited workers
+EXITED = "exited.json"
+
+
+def _read(file: str) -> dict | None:
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Skipping unreadable metrics snapshot {file}: {e!r}")
+        return None
+
+
+def _fold_exited(path: str, files: list):
+    """Add the snapshots of exited workers to the aggregate and remove them.
+
+    The lock file serializes workers scraping at the same time, so every
+    snapshot is added exactly once.
+    """
+    with open(os.path.join(path, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        snapshots = [snapshot for file in files if (snapshot := _read(file)) is not None]
+        if not snapshots:
+            return
+        target = os.path.join(path, EXITED)
+        aggregate = _read(target)
+        with open(target + ".tmp", "w") as file:
+            json.dump(to_snapshot(merge([aggregate or {}, *snapshots])), file)
+        os.replace(target + ".tmp", target)
+        for file in files:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+
+def collect(registry: Registry = REGISTRY, path: str | None = None) -> list:
+    """Return the snapshots of every worker of the host.
+
+    The snapshot of the calling worker is taken directly from its registry.
+    Snapshots of exited workers are folded into one aggregate, which is
+    returned together with the snapshots of the living workers.
+    """
+    path = path or _path()
+    snapshots = [registry.snapshot()]
+    if not os.path.isdir(path):
+        return snapshots
+    exited = []
+    for name in os.listdir(path):
+        pid, extension = os.path.splitext(name)
+        if extension != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        file = os.path.join(path, name)
+        if not process_alive(int(pid)):
+            exited.append(file)
+        elif (snapshot := _read(file)) is not None:
+            snapshots.append(snapshot)
+    if exited:
+        _fold_exited(path, exited)
+    if (aggregate := _read(os.path.join(path, EXITED))) is not None:
+        snapshots.append(aggregate)
+    return snapshots
+
+
+def merge(snapshots: list) -> dict:
+    """Sum the values of several snapshots per metric and label combination."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target["values"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target["values"][key] = current + value
+    return merged
+
+
+def to_snapshot(merged: dict) -> dict:
+    """Convert merged snapshots back into the JSON serializable snapshot format."""
+    return {
+        name: {**metric, "values": [[list(key), value] for key, value in metric["values"].items()]}
+        for name, metric in merged.items()
+    }
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(merged: dict) -> str:
+    """Render merged snapshots in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(metric['labels'], key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric["buckets"], math.inf], value[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == math.inf else f'le="{bound:g}"'
+                lines.append(f"{name}_bucket{_labels(metric['labels'], key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], key)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(metric['labels'], key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+# Metrics of the application
+HTTP_SECONDS = Histogram("rag_http_request_duration_seconds",
+                         "Duration of HTTP requests per route.", ["method", "route", "status"])
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds",
+                          "Duration of pipeline and indexing stages.", ["pipeline", "stage"])
+CALL_SECONDS = Histogram("rag_external_call_duration_seconds",
+                         "Duration of calls to embedding, Qdrant, LLM and CouchDB services.",
+                         ["service"])
+CACHE_REQUESTS = Counter("rag_cache_requests_total", "Cache lookups per cache and result.",
+                         ["cache", "result"])
+INDEXED = Counter("rag_indexed_total",
+                  "Indexed documents, chunks and tokens (indexing throughput).", ["unit"])
+ADMISSION_REQUESTS = Counter("rag_admission_total",
+                             "RAG requests per mode admitted directly, after queueing, or "
+                             "rejected with 429.", ["mode", "result"])
+ADMISSION_WAIT_SECONDS = Histogram("rag_admission_wait_seconds",
+                                   "Time RAG requests waited for a slot.", ["mode"])
+SCHEDULER_WAIT_SECONDS = Histogram("rag_azure_wait_seconds",
+                                   "Time Azure OpenAI calls waited for the client-side scheduler.",
+                                   ["service", "priority"])
+RATE_LIMITED = Counter("rag_azure_rate_limited_total",
+                       "Azure OpenAI calls rejected with 429 per service.", ["service"])
+DEPLOYMENT_CALLS = Counter("rag_azure_deployment_calls_total",
+                           "Calls per Azure OpenAI deployment: successes, failures and hedges.",
+                           ["service", "deployment", "result"])
+DEPLOYMENT_SECONDS = Histogram("rag_azure_deployment_duration_seconds",
+                               "Duration of successful calls per Azure OpenAI deployment.",
+                               ["service", "deployment"])
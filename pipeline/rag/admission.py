@@ -0,0 +1,208 @@
+"""Admission control for the RAG pipelines.
+
+Every RAG mode gets its own concurrency limit and a bounded wait queue. On top
+of that, all modes share a global limit; when a slot frees up, the waiting
+requests of the mode with the best (lowest) priority are admitted first. By
+default the expensive modes (advanced, modular) can only take a fraction of
+the global slots, so a burst of them never starves cheap naive queries.
+
+A request which finds the queue of its mode full, or which waited longer
+than the queue timeout, is rejected right away with 429 and a `Retry-After`
+estimated from the recent service times of the mode.
+"""
+
+import asyncio
+import math
+import os
+import time
+from functools import lru_cache
+
+from fastapi import HTTPException
+
+from pipeline.metrics import ADMISSION_REQUESTS, ADMISSION_WAIT_SECONDS
+
+# Default concurrency, queue size and priority (lower is admitted first) per mode
+DEFAULT_LIMITS = {
+    "no-rag": (16, 64, 0),
+    "naive": (16, 64, 0),
+    "advanced": (4, 16, 1),
+    "modular": (4, 16, 1),
+}
+
+
+class ModeLimit:
+    """Concurrency limit, wait queue and priority of a RAG mode."""
+
+    def __init__(self, concurrency: int, queue_size: int, priority: int = 0,
+                 timeout: float = 15.0):
+        """Create a limit.
+
+        :param concurrency: Maximum number of concurrently running requests.
+        :type concurrency: int
+        :param queue_size: Maximum number of waiting requests; further requests are rejected.
+        :type queue_size: int
+        :param priority: Waiting requests of lower priorities are admitted first.
+        :type priority: int
+        :param timeout: Maximum seconds a request waits in the queue.
+        :type timeout: float
+        """
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.priority = priority
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls, mode: str, concurrency: int, queue_size: int, priority: int):
+        """Read the limit of a mode from `<MODE>_CONCURRENCY`, `<MODE>_QUEUE_SIZE`,
+        `<MODE>_PRIORITY` and `ADMISSION_TIMEOUT`, e.g. `NO_RAG_CONCURRENCY`."""
+        prefix = mode.upper().replace("-", "_")
+        return cls(int(os.environ.get(f"{prefix}_CONCURRENCY", concurrency)),
+                   int(os.environ.get(f"{prefix}_QUEUE_SIZE", queue_size)),
+                   int(os.environ.get(f"{prefix}_PRIORITY", priority)),
+                   float(os.environ.get("ADMISSION_TIMEOUT", 15)))
+
+
+class Slot:
+    """A running request; released when the request is done."""
+
+    __slots__ = ("admission", "mode", "start", "released")
+
+    def __init__(self, admission, mode: str):
+        self.admission = admission
+        self.mode = mode
+        self.start = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        """Free the slot. Safe to call more than once."""
+        if not self.released:
+            self.released = True
+            self.admission._release(self.mode, time.perf_counter() - self.start)
+
+
+class Admission:
+    """Per-mode concurrency limits with bounded, prioritised wait queues.
+
+    Used from the event loop of a worker only, so no locking is needed.
+    """
+
+    def __init__(self, limits: dict | None = None, max_concurrency: int | None = None):
+        """Create the admission control.
+
+        :param limits: `ModeLimit` per mode. Defaults to `DEFAULT_LIMITS`,
+            overridable through the environment (see `ModeLimit.from_env`).
+        :type limits: dict | None
+        :param max_concurrency: Maximum number of running requests over all
+            modes (`RAG_MAX_CONCURRENCY`, default 16).
+        :type max_concurrency: int | None
+        """
+        self.limits = limits or {mode: ModeLimit.from_env(mode, *default)
+                                 for mode, default in DEFAULT_LIMITS.items()}
+        self.max_concurrency = int(os.environ.get("RAG_MAX_CONCURRENCY", 16)) \
+            if max_concurrency is None else max_concurrency
+        self.active = {mode: 0 for mode in self.limits}
+        self.waiting = {mode: [] for mode in self.limits}
+        # Moving average of the seconds a slot is held, for `Retry-After`
+        self.service_time = {mode: 1.0 for mode in self.limits}
+        self._order = sorted(self.limits, key=lambda mode: self.limits[mode].priority)
+
+    def _free(self, mode: str) -> bool:
+        return (self.active[mode] < self.limits[mode].concurrency
+                and sum(self.active.values()) < self.max_concurrency)
+
+    def _grant(self, mode: str) -> Slot:
+        self.active[mode] += 1
+        return Slot(self, mode)
+
+    def _release(self, mode: str, held: float):
+        self.active[mode] -= 1
+        self.service_time[mode] = 0.8 * self.service_time[mode] + 0.2 * held
+        for waiting_mode in self._order:
+            queue = self.waiting[waiting_mode]
+            while queue and self._free(waiting_mode):
+                waiter = queue.pop(0)
+                if not waiter.done():
+                    waiter.set_result(self._grant(waiting_mode))
+
+    def retry_after(self, mode: str) -> int:
+        """Estimate the seconds until a new request of the mode would be admitted."""
+        limit = self.limits[mode]
+        backlog = len(self.waiting[mode]) + 1
+        return max(1, math.ceil(self.service_time[mode] * backlog / max(limit.concurrency, 1)))
+
+    def _saturated(self, mode: str, result: str) -> HTTPException:
+        ADMISSION_REQUESTS.inc(mode=mode, result=result)
+        return HTTPException(429, detail=f"Too many {mode} requests, please retry later.",
+                             headers={"Retry-After": str(self.retry_after(mode))})
+
+    async def acquire(self, mode: str) -> Slot:
+        """Wait for a slot of a mode.
+
+        :param mode: RAG mode, a key of `limits`.
+        :type mode: str
+        :raises HTTPException: 429 with `Retry-After` if the queue of the mode is
+            full or the request waited longer than the queue timeout.
+        :return: The slot, to be released when the request is done.
+        :rtype: Slot
+        """
+        limit = self.limits[mode]
+        queue = self.waiting[mode]
+        if not queue and self._free(mode):
+            ADMISSION_REQUESTS.inc(mode=mode, result="admitted")
+            return self._grant(mode)
+        if len(queue) >= limit.queue_size:
+            raise self._saturated(mode, "rejected")
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        start = time.perf_counter()
+        try:
+            slot = await asyncio.wait_for(waiter, limit.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter in queue:
+                queue.remove(waiter)
+            if waiter.done() and not waiter.cancelled():
+                # Admitted just before the timeout or the cancellation
+                waiter.result().release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._saturated(mode, "timeout")
+        finally:
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, mode=mode)
+        ADMISSION_REQUESTS.inc(mode=mode, result="queued")
+        return slot
+
+    def slot(self, mode: str):
+        """Async context manager holding a slot of a mode: `async with admission.slot("naive"):`."""
+        return _SlotContext(self, mode)
+
+    def stats(self) -> dict:
+        """Return the running and waiting requests per mode."""
+        return {
+            mode: {"active": self.active[mode], "waiting": len(self.waiting[mode]),
+                   "concurrency": limit.concurrency, "queue_size": limit.queue_size,
+                   "priority": limit.priority}
+            for mode, limit in self.limits.items()
+        }
+
+
+class _SlotContext:
+    __slots__ = ("admission", "mode", "slot")
+
+    def __init__(self, admission: Admission, mode: str):
+        self.admission = admission
+        self.mode = mode
+        self.slot = None
+
+    async def __aenter__(self) -> Slot:
+        self.slot = await self.admission.acquire(self.mode)
+        return self.slot
+
+    async def __aexit__(self, *exc_info):
+        self.slot.release()
+
+
+@lru_cache(maxsize=None)
+def shared_admission() -> Admission:
+    """Return the admission control shared by all pipelines of this process."""
+    return Admission()
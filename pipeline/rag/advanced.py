@@ -1,17 +1,38 @@
+import asyncio
+import logging
+import os
 from datetime import datetime
 
-from fastapi import APIRouter, Body
-from openai import AzureOpenAI
+from fastapi import APIRouter, Body, Request
 from pydantic import BaseModel
 
-from passwords.pw import api_version, gpt_password, gpt_sweden
-from pipeline.vector import Vectorstore
+from passwords.pw import api_version
+from pipeline.collection import collection_name
+from pipeline.metrics import CALL_SECONDS
+from pipeline.resources import resources
+from pipeline.tracing import new_trace, record
+from .common import (complete, EMBEDDING_MODEL, EMBEDDING_TIMEOUT, GPT_DEPLOYMENT, LLM_TIMEOUT,
+    RagContext, run_cancellable, SEARCH_TIMEOUT, stream_pipeline, with_stats)
+from .admission import shared_admission
+from .cache import ResponseCache
+from .context import assemble
+from .memo import shared_memo
+from .rerank import fetch_size, rerank
+
+# Minimum cosine similarity between the original and the rewritten prompt for
+# the speculative retrieval to be used
+SPECULATIVE_SIMILARITY = float(os.environ.get("SPECULATIVE_SIMILARITY", 0.9))
 
 
 class Prompt(BaseModel):
     prompt: str = ("Wie ist der kontinuierliche Verbesserungsprozess der Volksbank Heilbronn?")
     top_k: int = 5
+    fetch_k: int | None = None
+    mmr_lambda: float = 0.7
     language: str = "German"
+    stream: bool = False
+    speculative: bool = False
+    advanded_stats: bool = False
 
 
 class AdvancedRAG:
@@ -19,92 +40,171 @@ class AdvancedRAG:
         self.router = APIRouter()
         self.router.add_api_route("/rag/advanced-rag", self.wrapper, methods=["POST"],
             tags=["AdvancedRAG"])
-        self.clien = AzureOpenAI(api_key=gpt_password, azure_endpoint=gpt_sweden,
-            api_version=api_version,
-            azure_deployment="https://ai-team-dbs-sweden.openai.azure.com/openai/deployments/gpt-4o-sweden/chat/completions?api-version=2023-03-15-preview", )
-
-        self.clien.chat.completions.create(messages=[{
-                                                         "role": "user",
-                                                         "content": "Lol"
-                                                     }], model="gpt-4o-sweden")
-
-        self.user_prompt = ""
-        self.new_prompt = ""
-        self.embedded_prompt = ""
-        self.docs = []
-        self.language = "German"
-
-    def add_prompt(self, prompt, language):
+        self.vs = resources.vectorstore(EMBEDDING_MODEL)
+        self.collection = collection_name(EMBEDDING_MODEL)
+        self.cache = ResponseCache("advanced", self.collection)
+        self.memo = shared_memo()
+        self.admission = shared_admission()
+
+    @property
+    def clien(self):
+        """Shared AsyncAzureOpenAI client, created on first use."""
+        return resources.chat_client(api_version=api_version, azure_deployment=GPT_DEPLOYMENT)
+
+    async def add_prompt(self, ctx: RagContext):
         p1 = (f"please answer with one Word: Which language is this prompt? "
-              f"Prompt: {prompt}")
-        prmt = f"Reformulate the following prompt so that it is more precise and specific Prompt suitable for a LLM to understand. Prompt: {prompt}"
-        self.language = language
-        self.new_prompt = (
-            self.clien.chat.completions.create(temperature=0.1, model="gpt-4o-sweden", messages=[{
-                "role": "user",
-                "content": prmt
-            }, ], ).choices[0].message.content)
-        print(self.new_prompt)
-        self.embedded_prompt = self.embed_text(self.new_prompt)
-
-    def retrieve_top_k(self, k):
-        vs = Vectorstore("text-embedding-ada-002-sweden")
-        docs = vs.client.search(collection_name="text-embedding-3-small",
-            query_vector=self.embedded_prompt, limit=k, with_vectors=False, with_payload=True, )
-        docs = list(docs)
-        t = []
-        for doc in docs:
-            a = doc.payload.get("text")
-            a = a.strip()
-            a = a.replace("...", "")
-            a = " ".join(a.split())
-            t.append(a)
-
-        self.docs = t
-
-    def embed_text(self, text: str):
+              f"Prompt: {ctx.prompt}")
+        prmt = f"Reformulate the following prompt so that it is more precise and specific Prompt suitable for a LLM to understand. Prompt: {ctx.prompt}"
+        with ctx.trace.span("rewrite"):
+            ctx.rewritten_prompt = await self.memo.create(self.clien, "rewrite", temperature=0.1,
+                model="gpt-4o-sweden", timeout=LLM_TIMEOUT, messages=[{
+                    "role": "user",
+                    "content": prmt
+                }], )
+        logging.debug(f"Rewritten prompt: {ctx.rewritten_prompt}")
+        await ctx.emit("rewrite", {"prompt": ctx.rewritten_prompt})
+        with ctx.trace.span("embedding"):
+            ctx.embedding = await self.embed_text(ctx.rewritten_prompt)
+
+    async def search(self, ctx: RagContext, embedding) -> list:
+        """Search the collection for the chunks closest to an embedding.
+
+        `ctx.fetch_k` candidates are fetched and reranked by maximal marginal relevance.
+        """
+        with CALL_SECONDS.time(service="qdrant"):
+            docs = await self.vs.aclient.search(collection_name=self.collection,
+                query_vector=embedding, limit=fetch_size(ctx.top_k, ctx.fetch_k),
+                with_vectors=True, with_payload=True, timeout=SEARCH_TIMEOUT, )
+        docs = rerank(embedding, docs, ctx.top_k, ctx.mmr_lambda)
+        record(chunks=len(docs))
+        return docs
+
+    async def retrieve_top_k(self, ctx: RagContext, docs: list | None = None):
+        """Retrieve the chunks for the rewritten prompt.
+
+        :param ctx: Context of the request.
+        :type ctx: RagContext
+        :param docs: Already retrieved chunks (speculative retrieval). If `None`,
+            the collection is searched with `ctx.embedding`.
+        :type docs: list | None
+        """
+        if docs is None:
+            with ctx.trace.span("search"):
+                docs = await self.search(ctx, ctx.embedding)
+        await ctx.emit("retrieval", {"ids": [doc.id for doc in docs]})
+        with ctx.trace.span("context"):
+            ctx.documents = assemble(docs, model="gpt-4o-sweden")
+
+    async def speculative_search(self, ctx: RagContext):
+        """Embed and search the original prompt, returns the embedding and the hits."""
+        with ctx.trace.span("speculative_search"):
+            embedding = await self.embed_text(ctx.prompt)
+            return embedding, await self.search(ctx, embedding)
+
+    async def embed_text(self, text: str):
         """Embed text using the vectorstore's embedding model."""
-        vs = Vectorstore("text-embedding-ada-002-sweden")
+        return (await self.vs.aembed([text], timeout=EMBEDDING_TIMEOUT))[0]
 
-        embedding_response = vs.oai.embeddings.create(model=vs.embedding_model, input=[text])
-        return embedding_response.data[0].embedding
-
-    def new_prompting(self):
+    async def new_prompting(self, ctx: RagContext):
+        context = "\n\n".join(ctx.documents)
         promptt = (
             f"Based on this old prompt and this old data, improve the prompt for an LLM to understand better. Formulate the new prompt in the same language as the old one"
-            f"Old Prompt: {self.new_prompt},"
-            f"Old Data: {self.docs}")
-
-        self.new_prompt = (
-            self.clien.chat.completions.create(temperature=0.1, model="gpt-4o-sweden", messages=[{
-                                                                                                     "role": "user",
-                                                                                                     "content": promptt
-                                                                                                 }], ).choices[
-                0].message.content)
-
-    def answer(self):
+            f"Old Prompt: {ctx.rewritten_prompt},"
+            f"Old Data: {context}")
+
+        with ctx.trace.span("reprompt"):
+            ctx.rewritten_prompt = await self.memo.create(self.clien, "reprompt", temperature=0.1,
+                model="gpt-4o-sweden", timeout=LLM_TIMEOUT, messages=[{
+                    "role": "user",
+                    "content": promptt
+                }], )
+        await ctx.emit("rewrite", {"prompt": ctx.rewritten_prompt})
+
+    async def answer(self, ctx: RagContext):
+        context = "\n\n".join(ctx.documents)
         prompt = (f"System: Please answer following prompt based on the "
                   f"provided context. Select relevant facts only. Your answer should be in plain text only."
-                  f"Prompt: {self.new_prompt}"
-                  f"Context: {self.docs}"
+                  f"Prompt: {ctx.rewritten_prompt}"
+                  f"Context: {context}"
                   f"Current Date: {datetime.today()}"
-                  f"Target language: {self.language}")
-        print(prompt)
+                  f"Target language: {ctx.language}")
 
-        return (self.clien.chat.completions.create(temperature=0.3, model="gpt-4o-sweden",
-            messages=[{
-                          "role": "user",
-                          "content": prompt
-                      }], ).choices[0].message.content)
+        with ctx.trace.span("answer"):
+            ctx.answer = await complete(self.clien, ctx, temperature=0.3,
+                model="gpt-4o-sweden", timeout=LLM_TIMEOUT, messages=[{
+                    "role": "user",
+                    "content": prompt
+                }], )
 
-    async def wrapper(self, request: Prompt = Body(...)):
+    async def wrapper(self, http_request: Request, request: Prompt = Body(...)):
         """## Advanced RAG endpoint
         This represents the advanced RAG implementation.
         Since the data goes through a decent amount of stages can a request take about 3 minutes.
 
         Please be patient.
+
+        Set `"speculative": true` to search the original prompt while it is being rewritten. The speculative results are used if the rewritten prompt is semantically close enough to the original one, which saves a retrieval round trip.
+
+        `fetch_k` candidates (default: 4 × `top_k`) are retrieved and reranked by maximal marginal relevance to remove near-duplicate chunks. `mmr_lambda` weighs relevance (1) against diversity (0).
+
+        Answers are cached until the index changes. A cached answer is streamed as a `cache` event followed by a single `token` event.
+
+        Set `"advanded_stats": true` to receive the answer as `{"response": ..., "stats": ...}`, where `stats` breaks the request down per stage (wall time, tokens in and out, cache hits, retrieved chunks). Streaming requests receive it as a `stats` event.
+
+        Requests are limited per RAG mode. If all slots and the wait queue of the mode are taken, the server answers with `429 Too Many Requests` and a `Retry-After` header.
+
+        Set `"stream": true` to receive server-sent events instead: `rewrite` (rewritten prompt), `retrieval` (IDs of the retrieved chunks), `token` (parts of the answer) and finally `done` or `error`.
         """
-        self.add_prompt(request.prompt, request.language)
-        self.retrieve_top_k(request.top_k)
-        self.new_prompting()
-        return self.answer()
+        ctx = RagContext(prompt=request.prompt, language=request.language, top_k=request.top_k,
+                         fetch_k=request.fetch_k, mmr_lambda=request.mmr_lambda,
+                         trace=new_trace(request.advanded_stats, "advanced"))
+        variant = "speculative" if request.speculative else ""
+        answer, embedding = await self.cache.lookup(ctx, self.embed_text, variant)
+        if answer is not None:
+            ctx.answer = answer
+            if request.stream:
+                return stream_pipeline(ctx, self.cache.replay(ctx), lambda: ctx.answer)
+            return with_stats(ctx, ctx.answer)
+
+        with ctx.trace.span("admission"):
+            slot = await self.admission.acquire("advanced")
+        pipeline = self.cache.store(ctx, self._run(ctx, request.speculative), embedding, variant)
+        if request.stream:
+            return stream_pipeline(ctx, pipeline, lambda: ctx.answer, slot=slot)
+        try:
+            await run_cancellable(http_request, pipeline)
+        finally:
+            slot.release()
+        return with_stats(ctx, ctx.answer)
+
+    async def _run(self, ctx: RagContext, speculative: bool = False):
+        if speculative:
+            await self._speculative_retrieval(ctx)
+        else:
+            await self.add_prompt(ctx)
+            await self.retrieve_top_k(ctx)
+        await self.new_prompting(ctx)
+        await self.answer(ctx)
+
+    async def _speculative_retrieval(self, ctx: RagContext):
+        speculation = asyncio.ensure_future(self.speculative_search(ctx))
+        try:
+            await self.add_prompt(ctx)
+        except BaseException:
+            speculation.cancel()
+            raise
+        try:
+            embedding, docs = await speculation
+        except Exception as e:
+            logging.warning(f"Speculative retrieval failed: {e!r}")
+            docs = None
+
+        if docs is not None:
+            import numpy as np
+
+            a, b = np.asarray(embedding), np.asarray(ctx.embedding)
+            similarity = float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+            logging.info(f"Similarity of original and rewritten prompt: {similarity:.3f}")
+            if similarity < SPECULATIVE_SIMILARITY:
+                docs = None
+        await self.retrieve_top_k(ctx, docs)
@@ -0,0 +1,187 @@
+"""Cache for the answers of the RAG pipelines."""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from pipeline.cache_store import CacheStore, shared_store
+from pipeline.checkpoint import IndexCheckpoint
+from pipeline.metrics import CACHE_REQUESTS
+from pipeline.tracing import record
+from .common import RagContext
+
+# Seconds between two checks of the index generation
+GENERATION_CHECK_INTERVAL = 1.0
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize a prompt for exact cache lookups (case, whitespace, trailing punctuation)."""
+    return " ".join(prompt.casefold().split()).rstrip("?!. ")
+
+
+class ResponseCache:
+    """LRU cache with TTL for pipeline answers.
+
+    Answers are looked up by the normalized prompt and every request parameter
+    which influences the answer. If a similarity threshold is configured,
+    answers of semantically equivalent prompts (cosine similarity of the prompt
+    embeddings) are returned as well.
+
+    The cache is cleared as soon as the generation of the indexed collection
+    changes, i.e. whenever documents are indexed or removed. The entries are
+    kept in a `CacheStore`, by default the one shared by all workers.
+    """
+
+    def __init__(self, mode: str, collection: str = "text-embedding-3-small",
+                 max_entries: int | None = None, ttl: float | None = None,
+                 similarity: float | None = None, checkpoint: IndexCheckpoint | None = None,
+                 store: CacheStore | None = None):
+        """Create a cache for one pipeline.
+
+        :param mode: Name of the pipeline, part of every key.
+        :type mode: str
+        :param collection: Collection the answers are based on.
+        :type collection: str
+        :param max_entries: Maximum number of answers (`RESPONSE_CACHE_SIZE`, default 1024).
+            0 disables the cache.
+        :type max_entries: int | None
+        :param ttl: Lifetime of an answer in seconds (`RESPONSE_CACHE_TTL`, default 3600).
+        :type ttl: float | None
+        :param similarity: Minimum cosine similarity for semantic hits
+            (`RESPONSE_CACHE_SIMILARITY`). Semantic lookups are disabled if unset.
+        :type similarity: float | None
+        :param checkpoint: State store providing the index generation.
+        :type checkpoint: IndexCheckpoint | None
+        :param store: Backend of the cache. Defaults to `shared_store()`.
+        :type store: CacheStore | None
+        """
+        self.mode = mode
+        self.collection = collection
+        self.max_entries = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024)) \
+            if max_entries is None else max_entries
+        self.ttl = float(os.environ.get("RESPONSE_CACHE_TTL", 3600)) if ttl is None else ttl
+        if similarity is None and os.environ.get("RESPONSE_CACHE_SIMILARITY"):
+            similarity = float(os.environ["RESPONSE_CACHE_SIMILARITY"])
+        self.similarity = similarity
+        self.checkpoint = checkpoint or IndexCheckpoint()
+        self._backend = store
+        self.hits = 0
+        self.misses = 0
+        self._generation = None
+        self._checked_at = 0.0
+
+    @property
+    def backend(self) -> CacheStore:
+        """Backend of the cache, `shared_store()` is opened on first use."""
+        if self._backend is None:
+            self._backend = shared_store()
+        return self._backend
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @property
+    def semantic(self) -> bool:
+        return self.enabled and self.similarity is not None
+
+    def _params(self, ctx: RagContext, variant: str = "") -> str:
+        return json.dumps([variant, ctx.language, ctx.top_k, ctx.fetch_k, ctx.mmr_lambda])
+
+    @property
+    def namespace(self) -> str:
+        return f"response:{self.mode}:{self.collection}:{self._generation}"
+
+    def _check_generation(self):
+        now = time.monotonic()
+        if now - self._checked_at < GENERATION_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        generation = self.checkpoint.get_generation(self.collection)
+        if generation != self._generation:
+            if self._generation is not None:
+                logging.info(f"Index of {self.collection} changed, clearing the {self.mode} cache")
+                self.backend.clear(self.namespace)
+            self._generation = generation
+
+    def get(self, ctx: RagContext, embedding=None, variant: str = "") -> str | None:
+        """Return the cached answer for a request or `None`.
+
+        :param ctx: Context of the request.
+        :type ctx: RagContext
+        :param embedding: Embedding of the prompt, used for semantic lookups.
+        :param variant: Additional pipeline option which changes the answer.
+        :type variant: str
+        """
+        if not self.enabled:
+            return None
+        try:
+            self._check_generation()
+            params = self._params(ctx, variant)
+            answer = self.backend.get(
+                self.namespace, json.dumps([normalize_prompt(ctx.prompt), params])
+            )
+            if answer is None and embedding is not None and self.similarity is not None:
+                nearest = self.backend.nearest(self.namespace, embedding, params, self.similarity)
+                answer = nearest[1] if nearest else None
+        except (sqlite3.Error, ValueError) as e:
+            logging.warning(f"Response cache lookup failed: {e!r}")
+            answer = None
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            record(cache_hits=1)
+        CACHE_REQUESTS.inc(cache="response", result="miss" if answer is None else "hit")
+        return answer
+
+    def put(self, ctx: RagContext, answer: str, embedding=None, variant: str = ""):
+        """Store the answer of a request."""
+        if not self.enabled or not answer:
+            return
+        try:
+            self._check_generation()
+            params = self._params(ctx, variant)
+            if embedding is not None and len(embedding) != getattr(self.backend, "dimensions",
+                                                                   len(embedding)):
+                embedding = None
+            self.backend.put(self.namespace, json.dumps([normalize_prompt(ctx.prompt), params]),
+                           answer, vector=embedding, partition=params, ttl=self.ttl,
+                           limit=self.max_entries)
+        except (sqlite3.Error, ValueError) as e:
+            logging.warning(f"Response cache update failed: {e!r}")
+
+    async def lookup(self, ctx: RagContext, embed, variant: str = "") -> tuple:
+        """Look up a request, embedding its prompt first if semantic lookups are enabled.
+
+        :param ctx: Context of the request.
+        :type ctx: RagContext
+        :param embed: Coroutine function returning the embedding of a text.
+        :param variant: Additional pipeline option which changes the answer.
+        :type variant: str
+        :return: The cached answer (or `None`) and the prompt embedding (or `None`).
+        :rtype: tuple
+        """
+        with ctx.trace.span("cache"):
+            embedding = None
+            if self.semantic:
+                try:
+                    embedding = await embed(ctx.prompt)
+                except Exception as e:
+                    logging.warning(f"Failed to embed the prompt for a cache lookup: {e!r}")
+            # The store is SQLite backed, so the lookup runs in a thread
+            return await asyncio.to_thread(self.get, ctx, embedding, variant), embedding
+
+    async def store(self, ctx: RagContext, coro, embedding=None, variant: str = ""):
+        """Run a pipeline coroutine and cache the answer it wrote into `ctx`."""
+        await coro
+        await asyncio.to_thread(self.put, ctx, ctx.answer, embedding, variant)
+
+    @staticmethod
+    async def replay(ctx: RagContext):
+        """Send a cached answer to a streaming client."""
+        await ctx.emit("cache", {"hit": True})
+        await ctx.emit("token", {"text": ctx.answer})
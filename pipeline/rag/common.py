@@ -0,0 +1,222 @@
+"""Helpers shared by the RAG pipelines."""
+
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from pipeline.metrics import CALL_SECONDS
+from pipeline.scheduler import chat_completion, chat_tokens, shared_scheduler
+from pipeline.tracing import NULL_TRACE, record, record_usage, tracing, Trace
+
+# Timeouts in seconds
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 120))
+EMBEDDING_TIMEOUT = float(os.environ.get("EMBEDDING_TIMEOUT", 10))
+SEARCH_TIMEOUT = int(os.environ.get("SEARCH_TIMEOUT", 10))
+REQUEST_TIMEOUT = float(os.environ.get("RAG_REQUEST_TIMEOUT", 300))
+
+# Embedding model of the queries; its collection is searched (see `collection_name`)
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-ada-002-sweden")
+
+GPT_DEPLOYMENT = "https://ai-team-dbs-sweden.openai.azure.com/openai/deployments/gpt-4o-sweden/chat/completions?api-version=2023-03-15-preview"
+
+
+@dataclass
+class RagContext:
+    """State of a single RAG request.
+
+    The pipelines only keep clients on their instances; everything that belongs
+    to a request lives in its context, which is passed explicitly from stage to
+    stage. Concurrent requests therefore never share state.
+    """
+
+    prompt: str
+    language: str = "German"
+    top_k: int = 5
+    fetch_k: int | None = None
+    mmr_lambda: float = 0.7
+    rewritten_prompt: str = ""
+    embedding: list = field(default_factory=list)
+    documents: list = field(default_factory=list)
+    answer: str = ""
+    events: asyncio.Queue | None = None
+    trace: Trace = NULL_TRACE
+
+    @property
+    def streaming(self) -> bool:
+        """Whether the client asked for server-sent events."""
+        return self.events is not None
+
+    async def emit(self, event: str, data):
+        """Send an intermediate event to a streaming client. No-op otherwise."""
+        if self.events is not None:
+            await self.events.put((event, data))
+
+
+async def complete(client, ctx: RagContext, **kwargs) -> str:
+    """Run a chat completion through the shared Azure scheduler and return its text.
+
+    For streaming requests the completion is requested with `stream=True` and
+    every token is forwarded to the client as a `token` event. Streamed
+    completions report no usage, so for traced requests the prompt tokens are
+    counted locally and every streamed chunk counts as one output token.
+
+    :param client: AsyncAzureOpenAI client.
+    :param ctx: Context of the request.
+    :type ctx: RagContext
+    :param kwargs: Arguments of `chat.completions.create`.
+    :return: The full completion.
+    :rtype: str
+    """
+    if not ctx.streaming:
+        response = await chat_completion(client, **kwargs)
+        record_usage(response)
+        return response.choices[0].message.content
+
+    parts = []
+    async with shared_scheduler().slot("llm", chat_tokens(kwargs)):
+        with CALL_SECONDS.time(service="llm"):
+            async for chunk in await client.chat.completions.create(stream=True, **kwargs):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    await ctx.emit("token", {"text": chunk.choices[0].delta.content})
+    if tracing():
+        from .context import count_tokens
+
+        record(tokens_in=sum(count_tokens(message["content"], kwargs.get("model", "gpt-4o"))
+                             for message in kwargs.get("messages", [])),
+               tokens_out=len(parts))
+    return "".join(parts)
+
+
+def with_stats(ctx: RagContext, response):
+    """Attach the stage breakdown of a traced request to its response.
+
+    :param ctx: Context of the request.
+    :type ctx: RagContext
+    :param response: Response of the pipeline. Dictionaries get a `stats` key,
+        other responses are wrapped as `{"response": ..., "stats": ...}`.
+    :return: The response, unchanged if the request is not traced.
+    """
+    if not ctx.trace.enabled:
+        return response
+    if isinstance(response, dict):
+        return {**response, "stats": ctx.trace.summary()}
+    return {"response": response, "stats": ctx.trace.summary()}
+
+
+def _timed_out(error: BaseException) -> bool:
+    """Whether an error is a timeout of the pipeline or of one of its LLM,
+    embedding or Qdrant calls."""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return True
+    try:
+        from openai import APITimeoutError
+    except ImportError:
+        return False
+    return isinstance(error, APITimeoutError)
+
+
+def sse_event(event: str, data) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def stream_pipeline(ctx: RagContext, coro, result, timeout: float = REQUEST_TIMEOUT,
+                    slot=None) -> StreamingResponse:
+    """Run a pipeline and stream its events to the client.
+
+    Emits the intermediate events of the stages, the `token` events of the
+    final answer, the stage breakdown as a `stats` event (traced requests only)
+    and a closing `done` (with `result()`) or `error` event. The pipeline is
+    cancelled if the client disconnects.
+
+    :param ctx: Context of the request; its event queue is created here.
+    :type ctx: RagContext
+    :param coro: The pipeline coroutine.
+    :param result: Callable returning the payload of the `done` event.
+    :param timeout: Maximum runtime in seconds.
+    :type timeout: float
+    :param slot: Admission slot of the request, released when the stream ends.
+    :type slot: Slot | None
+    :return: Response with the media type `text/event-stream`.
+    :rtype: StreamingResponse
+    """
+    ctx.events = asyncio.Queue()
+
+    async def events():
+        task = asyncio.ensure_future(asyncio.wait_for(coro, timeout))
+        task.add_done_callback(lambda _: ctx.events.put_nowait(None))
+        try:
+            while (item := await ctx.events.get()) is not None:
+                yield sse_event(*item)
+            if task.exception() is None:
+                if ctx.trace.enabled:
+                    yield sse_event("stats", ctx.trace.summary())
+                yield sse_event("done", result())
+            else:
+                error = task.exception()
+                logging.error(f"Streaming pipeline failed: {error!r}")
+                if isinstance(error, HTTPException):
+                    detail = error.detail
+                elif _timed_out(error):
+                    detail = "The RAG pipeline timed out."
+                else:
+                    detail = "Pipeline failed."
+                yield sse_event("error", {"detail": detail})
+        finally:
+            task.cancel()
+            if slot is not None:
+                slot.release()
+
+    # The background task also releases the slot if the stream never started
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(slot.release) if slot else None)
+
+
+async def run_cancellable(request: Request, coro, timeout: float = REQUEST_TIMEOUT):
+    """Run a pipeline coroutine on behalf of an HTTP request.
+
+    The pipeline is cancelled (including its outstanding LLM, embedding and
+    Qdrant calls) as soon as the client disconnects or the timeout expires.
+
+    :param request: The request the pipeline is running for.
+    :type request: Request
+    :param coro: The pipeline coroutine.
+    :param timeout: Maximum runtime in seconds.
+    :type timeout: float
+    :raises HTTPException: 504 if the pipeline or one of its stages timed out,
+        499 if the client went away.
+    :return: The result of the coroutine.
+    """
+    task = asyncio.ensure_future(coro)
+
+    async def wait_for_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(0.5)
+
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        done, _ = await asyncio.wait(
+            {task, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if task in done:
+            try:
+                return task.result()
+            except Exception as e:
+                if not _timed_out(e):
+                    raise
+                raise HTTPException(status_code=504, detail="The RAG pipeline timed out.") from e
+        if watcher in done:
+            raise HTTPException(status_code=499, detail="Client closed the request.")
+        raise HTTPException(status_code=504, detail="The RAG pipeline timed out.")
+    finally:
+        task.cancel()
+        watcher.cancel()
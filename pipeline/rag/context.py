@@ -0,0 +1,130 @@
+"""Assembly of the retrieved chunks into the context of a prompt."""
+
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# Maximum number of context tokens per chat model (prefix match, longest prefix wins)
+TOKEN_BUDGETS = {
+    "gpt-4o": 4000,
+    "gpt-4": 3000,
+    "gpt-35-turbo": 2000,
+}
+DEFAULT_TOKEN_BUDGET = 2000
+# Chunks scoring more than this below the best hit are dropped
+SCORE_MARGIN = float(os.environ.get("CONTEXT_SCORE_MARGIN", 0.1))
+# A passage is only truncated to fill the budget if at least this many tokens are left
+MIN_PASSAGE_TOKENS = 50
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str) -> "tiktoken.Encoding":
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Return the number of tokens of a text for a chat model."""
+    return len(_encoding(model).encode(text))
+
+
+def token_budget(model: str) -> int:
+    """Return the context token budget of a chat model.
+
+    The `CONTEXT_TOKEN_BUDGET` environment variable overrides the defaults.
+    """
+    if os.environ.get("CONTEXT_TOKEN_BUDGET"):
+        return int(os.environ["CONTEXT_TOKEN_BUDGET"])
+    prefixes = [prefix for prefix in TOKEN_BUDGETS if model.startswith(prefix)]
+    return TOKEN_BUDGETS[max(prefixes, key=len)] if prefixes else DEFAULT_TOKEN_BUDGET
+
+
+def _clean(text: str) -> str:
+    return " ".join(text.replace("...", "").split())
+
+
+def assemble(points: list, model: str = "gpt-4o", max_tokens: int | None = None,
+             score_margin: float = SCORE_MARGIN) -> list[str]:
+    """Turn retrieved points into a compact list of passages.
+
+    - duplicated chunks (same ID or same text) are removed,
+    - chunks scoring more than `score_margin` below the best hit are dropped,
+    - neighbouring chunks (`chunk_index`) of the same document are merged
+      into one passage,
+    - passages are ordered by their best score and cut to the token budget
+      of the model.
+
+    :param points: Scored points returned by Qdrant (with payload).
+    :type points: list
+    :param model: Chat model the context is meant for.
+    :type model: str
+    :param max_tokens: Token budget. Defaults to `token_budget(model)`.
+    :type max_tokens: int | None
+    :param score_margin: Maximum distance to the best score.
+    :type score_margin: float
+    :return: Passages, most relevant first.
+    :rtype: list[str]
+    """
+    max_tokens = token_budget(model) if max_tokens is None else max_tokens
+    points = sorted(points, key=lambda point: point.score or 0, reverse=True)
+    best_score = (points[0].score or 0) if points else 0
+
+    seen_ids, seen_texts = set(), set()
+    chunks = []
+    for point in points:
+        payload = point.payload or {}
+        text = _clean(payload.get("text") or "")
+        if not text or point.id in seen_ids or text in seen_texts:
+            continue
+        if chunks and (point.score or 0) < best_score - score_margin:
+            break
+        seen_ids.add(point.id)
+        seen_texts.add(text)
+        chunks.append(
+            (payload.get("document_id"), payload.get("chunk_index"), point.score or 0, payload["text"])
+        )
+
+    # Merge runs of consecutive chunks of the same document. The chunks are
+    # disjoint token slices, so concatenating them restores the original text.
+    passages = []
+    runs = {}
+    for document_id, chunk_index, score, text in sorted(
+        chunks, key=lambda chunk: (str(chunk[0]), chunk[1] if chunk[1] is not None else -1)
+    ):
+        previous = runs.get(document_id)
+        if (document_id is not None and chunk_index is not None and previous is not None
+                and previous["last_index"] == chunk_index - 1):
+            previous["texts"].append(text)
+            previous["score"] = max(previous["score"], score)
+            previous["last_index"] = chunk_index
+            continue
+        run = {"texts": [text], "score": score, "last_index": chunk_index}
+        runs[document_id] = run
+        passages.append(run)
+    passages.sort(key=lambda run: run["score"], reverse=True)
+
+    encoding = _encoding(model)
+    packed = []
+    remaining = max_tokens
+    for run in passages:
+        text = _clean("".join(run["texts"]))
+        tokens = encoding.encode(text)
+        if len(tokens) > remaining:
+            if remaining >= MIN_PASSAGE_TOKENS:
+                packed.append(encoding.decode(tokens[:remaining]))
+            break
+        packed.append(text)
+        remaining -= len(tokens)
+    return packed
+
+
+def pack_context(points: list, model: str = "gpt-4o", max_tokens: int | None = None) -> str:
+    """Return the passages of `assemble` as a single context string."""
+    return "\n\n".join(assemble(points, model, max_tokens))
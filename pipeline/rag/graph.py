@@ -0,0 +1,118 @@
+"""Declarative stage graph used to run RAG modules concurrently."""
+
+import asyncio
+import logging
+
+from pipeline.tracing import NULL_TRACE
+
+
+class EarlyExit(Exception):
+    """Raised by a module to finish the whole graph with `result`."""
+
+    def __init__(self, result=None):
+        super().__init__("Early exit")
+        self.result = result
+
+
+class Module:
+    """A node of a `StageGraph`.
+
+    The coroutine function is called as `fn(ctx, *results)` with the results of
+    the modules listed in `requires`, in that order.
+    """
+
+    def __init__(self, name: str, fn, requires: list | tuple = (), timeout: float | None = None,
+                 optional: bool = False):
+        """Create a module.
+
+        :param name: Unique name of the module; its result is stored under this name.
+        :type name: str
+        :param fn: Coroutine function `fn(ctx, *results)`.
+        :param requires: Names of the modules whose results are needed.
+        :type requires: list | tuple
+        :param timeout: Maximum runtime of the module in seconds.
+        :type timeout: float | None
+        :param optional: If the module fails or times out, its result is `None`
+            instead of failing the whole graph.
+        :type optional: bool
+        """
+        self.name = name
+        self.fn = fn
+        self.requires = tuple(requires)
+        self.timeout = timeout
+        self.optional = optional
+
+
+class StageGraph:
+    """Runs modules as soon as their dependencies are done.
+
+    Independent branches run concurrently, so the latency of the graph is the
+    latency of its critical path instead of the sum of all modules. Every
+    module runs in a span of the context's trace (if it has one).
+    """
+
+    def __init__(self, modules: list | tuple):
+        self.modules = {module.name: module for module in modules}
+        if len(self.modules) != len(modules):
+            raise ValueError("Module names must be unique.")
+        for module in modules:
+            missing = set(module.requires) - self.modules.keys()
+            if missing:
+                raise ValueError(f"Module '{module.name}' requires unknown modules: {missing}")
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        resolved = set()
+        pending = dict(self.modules)
+        while pending:
+            ready = [name for name, module in pending.items() if set(module.requires) <= resolved]
+            if not ready:
+                raise ValueError(f"Cyclic dependencies between modules: {sorted(pending)}")
+            resolved.update(ready)
+            for name in ready:
+                del pending[name]
+
+    async def _run_module(self, module: Module, ctx, results: dict):
+        try:
+            with getattr(ctx, "trace", NULL_TRACE).span(module.name):
+                return await asyncio.wait_for(
+                    module.fn(ctx, *[results[name] for name in module.requires]), module.timeout
+                )
+        except EarlyExit:
+            raise
+        except Exception as e:
+            if not module.optional:
+                raise
+            logging.warning(f"Optional module '{module.name}' failed: {e!r}")
+            return None
+
+    async def run(self, ctx) -> dict:
+        """Run the graph for a request.
+
+        :param ctx: Request context passed to every module.
+        :return: Results of all modules by name. If a module raised `EarlyExit`,
+            the graph stops and its result is stored under the key `"early_exit"`.
+        :rtype: dict
+        """
+        results = {}
+        running = {}
+        waiting = dict(self.modules)
+        try:
+            while waiting or running:
+                for name in [n for n, m in waiting.items() if set(m.requires) <= results.keys()]:
+                    running[asyncio.ensure_future(
+                        self._run_module(waiting.pop(name), ctx, results)
+                    )] = name
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    try:
+                        results[name] = task.result()
+                    except EarlyExit as e:
+                        logging.info(f"Module '{name}' finished the graph early")
+                        results["early_exit"] = e.result
+                        return results
+        finally:
+            for task in running:
+                task.cancel()
+        return results
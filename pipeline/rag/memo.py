@@ -0,0 +1,139 @@
+"""Memoization of the intermediate LLM calls of the RAG pipelines."""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from asyncio import to_thread
+from functools import lru_cache
+
+from pipeline.cache_store import CacheStore, shared_store
+from pipeline.metrics import CACHE_REQUESTS
+from pipeline.scheduler import chat_completion
+from pipeline.tracing import record, record_usage
+
+# Stages whose completions are memoized unless `LLM_CACHE_STAGES` says otherwise. The
+# reformulations of the modular pipeline are sampled on purpose and therefore left out
+DEFAULT_STAGES = "rewrite,reprompt,refine,features,filter"
+
+
+class CompletionMemo:
+    """Bounded memo for chat completions, kept in the shared cache store.
+
+    Completions are keyed by deployment, messages, temperature and max_tokens.
+    Only stages which are enabled are looked up; hits and misses are counted
+    per stage. Completions sampled above `max_temperature` are never memoized,
+    since the caller wants a different answer each time.
+    """
+
+    def __init__(self, store: CacheStore | None = None, max_entries: int | None = None,
+                 stages: str | None = None, max_temperature: float | None = None):
+        """Create the memo.
+
+        :param store: Backend of the memo. Defaults to `shared_store()`.
+        :type store: CacheStore | None
+        :param max_entries: Maximum number of stored completions (`LLM_CACHE_SIZE`, default 10000).
+        :type max_entries: int | None
+        :param stages: Comma separated list of memoized stages (`LLM_CACHE_STAGES`).
+        :type stages: str | None
+        :param max_temperature: Highest memoized temperature (`LLM_CACHE_MAX_TEMPERATURE`,
+            default 0.3).
+        :type max_temperature: float | None
+        """
+        self._store = store
+        self.max_entries = int(os.environ.get("LLM_CACHE_SIZE", 10000)) \
+            if max_entries is None else max_entries
+        stages = os.environ.get("LLM_CACHE_STAGES", DEFAULT_STAGES) if stages is None else stages
+        self.stages = {stage.strip() for stage in stages.split(",") if stage.strip()}
+        self.max_temperature = float(os.environ.get("LLM_CACHE_MAX_TEMPERATURE", 0.3)) \
+            if max_temperature is None else max_temperature
+        self.metrics = {}
+
+    @property
+    def store(self) -> CacheStore:
+        """Backend of the memo, `shared_store()` is opened on first use."""
+        if self._store is None:
+            self._store = shared_store()
+        return self._store
+
+    def enable(self, stage: str, enabled: bool = True):
+        """Enable or disable memoization for a stage."""
+        if enabled:
+            self.stages.add(stage)
+        else:
+            self.stages.discard(stage)
+
+    @staticmethod
+    def key(client, **kwargs) -> str:
+        """Return the memo key of a completion request."""
+        return hashlib.sha256(json.dumps({
+            "deployment": str(getattr(client, "base_url", "")),
+            "model": kwargs.get("model"),
+            "messages": kwargs.get("messages"),
+            "temperature": kwargs.get("temperature"),
+            "max_tokens": kwargs.get("max_tokens"),
+        }, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _count(self, stage: str, hit: bool):
+        counters = self.metrics.setdefault(stage, {"hits": 0, "misses": 0})
+        counters["hits" if hit else "misses"] += 1
+        CACHE_REQUESTS.inc(cache="llm", result="hit" if hit else "miss")
+
+    async def create(self, client, stage: str, **kwargs) -> str:
+        """Run `client.chat.completions.create(**kwargs)` through the memo.
+
+        :param client: AsyncAzureOpenAI client.
+        :param stage: Name of the pipeline stage, see `LLM_CACHE_STAGES`.
+        :type stage: str
+        :param kwargs: Arguments of `chat.completions.create`.
+        :return: Content of the completion.
+        :rtype: str
+        """
+        if stage not in self.stages or self.max_entries <= 0 \
+                or kwargs.get("temperature", 1.0) > self.max_temperature:
+            response = await chat_completion(client, **kwargs)
+            record_usage(response)
+            return response.choices[0].message.content
+
+        key = self.key(client, **kwargs)
+        try:
+            content = await to_thread(self.store.get, "llm", key)
+        except sqlite3.Error as e:
+            logging.warning(f"LLM cache lookup failed: {e!r}")
+            content = None
+        self._count(stage, content is not None)
+        if content is not None:
+            record(cache_hits=1)
+            return content
+
+        response = await chat_completion(client, **kwargs)
+        record_usage(response)
+        content = response.choices[0].message.content
+        if content:
+            try:
+                await to_thread(self.store.put, "llm", key, content, limit=self.max_entries)
+            except sqlite3.Error as e:
+                logging.warning(f"LLM cache update failed: {e!r}")
+        return content
+
+    def stats(self) -> dict:
+        """Return hits, misses and hit rate per stage of this process."""
+        return {
+            "entries": self.store.count("llm"),
+            "max_entries": self.max_entries,
+            "stages": {
+                stage: {
+                    **counters,
+                    "hit_rate": counters["hits"] / max(counters["hits"] + counters["misses"], 1),
+                    "enabled": stage in self.stages,
+                }
+                for stage, counters in self.metrics.items()
+            },
+        }
+
+
+@lru_cache(maxsize=None)
+def shared_memo() -> CompletionMemo:
+    """Return the memo shared by all pipelines of this process."""
+    return CompletionMemo()
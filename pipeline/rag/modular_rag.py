@@ -1,115 +1,225 @@
-from fastapi import APIRouter
-from openai import AzureOpenAI
+import asyncio
+import os
+
+from fastapi import APIRouter, Request
 from pydantic import BaseModel
 
-from passwords.pw import api_version, gpt_password, gpt_sweden
-from pipeline.vector import Vectorstore
+from passwords.pw import api_version
+from pipeline.collection import collection_name
+from pipeline.metrics import CALL_SECONDS
+from pipeline.resources import resources
+from pipeline.tracing import new_trace, record
+from .common import (complete, EMBEDDING_MODEL, EMBEDDING_TIMEOUT, GPT_DEPLOYMENT, LLM_TIMEOUT,
+    RagContext, run_cancellable, SEARCH_TIMEOUT, stream_pipeline, with_stats)
+from .admission import shared_admission
+from .cache import ResponseCache
+from .context import pack_context
+from .graph import Module, StageGraph
+from .memo import shared_memo
+from .rerank import fetch_size, rerank
+
+# Number of prompt reformulations requested in parallel if no relevant features were found
+REFORMULATION_CANDIDATES = int(os.environ.get("REFORMULATION_CANDIDATES", 5))
 
 
 class ModularRagPrompt(BaseModel):
     prompt: str = (
-        "Warum ist Alpinski umweltschädigend? Begründe und belege anhand passender Quellen.",)
+        "Warum ist Alpinski umweltschädigend? Begründe und belege anhand passender Quellen.")
     top_k: int = 5
+    fetch_k: int | None = None
+    mmr_lambda: float = 0.7
     language: str = "German"
+    stream: bool = False
+    advanded_stats: bool = False
 
 
 class ModularRag:
     def __init__(self):
-        self.user_prompt = ""
-        self.vs = Vectorstore("text-embedding-ada-002-sweden")
-        self.client = AzureOpenAI(api_key=gpt_password, azure_endpoint=gpt_sweden,
-            api_version=api_version,
-            azure_deployment="https://ai-team-dbs-sweden.openai.azure.com/openai/deployments/gpt-4o-sweden/chat/completions?api-version=2023-03-15-preview", )
+        self.vs = resources.vectorstore(EMBEDDING_MODEL)
+        self.collection = collection_name(EMBEDDING_MODEL)
+        self.cache = ResponseCache("modular", self.collection)
+        self.memo = shared_memo()
+        self.admission = shared_admission()
         self.router = APIRouter()
         self.router.add_api_route("/rag/modular-rag", self.modular, methods=["POST"],
             tags=["ModularRag"])
-        self.language = "German"
-
-    def set_user_prompt(self, prompt):
-        """Set the user prompt for the current session."""
-        self.user_prompt = prompt
-
-    def refine_prompt(self, prompt):
+        # The raw prompt is searched speculatively while the prompt is refined, so
+        # retrieval is not delayed by the rewrite.
+        self.graph = StageGraph([
+            Module("refine", self._refine, timeout=LLM_TIMEOUT),
+            Module("speculative_search", lambda ctx: self._search(ctx, ctx.prompt),
+                timeout=EMBEDDING_TIMEOUT + SEARCH_TIMEOUT, optional=True),
+            Module("search", self._search, requires=["refine"],
+                timeout=EMBEDDING_TIMEOUT + SEARCH_TIMEOUT),
+            Module("documents", self._merge_documents, requires=["speculative_search", "search"]),
+            Module("features", self._extract, requires=["documents"], timeout=LLM_TIMEOUT),
+            Module("filtered", self.filter_and_adjust_features, requires=["features", "refine"],
+                timeout=2 * LLM_TIMEOUT),
+            Module("answer", self._answer, requires=["filtered"], timeout=LLM_TIMEOUT),
+        ])
+
+    @property
+    def client(self):
+        """Shared AsyncAzureOpenAI client, created on first use."""
+        return resources.chat_client(api_version=api_version, azure_deployment=GPT_DEPLOYMENT)
+
+    async def refine_prompt(self, prompt):
         """Refine the input prompt to be more specific and clear for LLMs."""
         refined_prompt = f"Reformulate the following prompt to make it more precise and specific for a large language model: '{prompt}'"
-        response = self.client.chat.completions.create(model="gpt-4o", temperature=0.3, messages=[{
-                                                                                                      "role": "user",
-                                                                                                      "content": refined_prompt
-                                                                                                  }], )
-        return response.choices[0].message.content
+        return await self.memo.create(self.client, "refine", model="gpt-4o", temperature=0.3,
+            timeout=LLM_TIMEOUT, messages=[{
+                "role": "user",
+                "content": refined_prompt
+            }], )
 
-    def extract_features(self, text):
+    async def extract_features(self, text):
         """Extract important features and key information from the given text."""
         prompt = f"Extract all relevant features and key information from the following text, listed item by item: '{text}'"
-        response = self.client.chat.completions.create(model="gpt-4o", temperature=0.3, messages=[{
-                                                                                                      "role": "user",
-                                                                                                      "content": prompt
-                                                                                                  }], )
-        return response.choices[0].message.content
-
-    def filter_and_adjust_features(self, text, original_prompt):
-        """Filter and adjust features to align with the original prompt."""
+        return await self.memo.create(self.client, "features", model="gpt-4o", temperature=0.3,
+            timeout=LLM_TIMEOUT, messages=[{
+                "role": "user",
+                "content": prompt
+            }], )
+
+    async def filter_and_adjust_features(self, ctx: RagContext, text, original_prompt):
+        """Filter and adjust features to align with the original prompt.
+
+        If no relevant information was found, several reformulations of the prompt
+        are requested in parallel and the first usable one is taken.
+        """
         prompt = f"Based on the following prompt, extract all relevant information from the text. If none is relevant, add knowledge from previous trainings. Text: '{text}' Prompt: '{original_prompt}'"
 
-        response = self.client.chat.completions.create(model="gpt-4o", temperature=0.1, messages=[{
-                                                                                                      "role": "user",
-                                                                                                      "content": prompt
-                                                                                                  }], )
-        answer = response.choices[0].message.content
+        answer = await self.memo.create(self.client, "filter", model="gpt-4o", temperature=0.1,
+            timeout=LLM_TIMEOUT, messages=[{
+                "role": "user",
+                "content": prompt
+            }], )
 
         if "none" in answer.lower():
-            for _ in range(5):
-                reformulate_prompt = (
-                    f"Based on the given information and the original prompt, reformulate the prompt to better match the available data. "
-                    f"Original Prompt: '{original_prompt}', Extracted Features: '{answer}'")
-                response = self.client.chat.completions.create(model="gpt-4o", temperature=0.1,
-                    messages=[{
-                                  "role": "user",
-                                  "content": reformulate_prompt
-                              }], )
-                new_prompt = response.choices[0].message.content
-
-                if "none" not in new_prompt.lower():
-                    original_prompt = new_prompt
-                    break
+            reformulate_prompt = (
+                f"Based on the given information and the original prompt, reformulate the prompt to better match the available data. "
+                f"Original Prompt: '{original_prompt}', Extracted Features: '{answer}'")
+            # Spread the temperatures so that the candidates actually differ
+            candidates = [asyncio.ensure_future(self.memo.create(self.client, "reformulate",
+                model="gpt-4o", temperature=0.1 + 0.2 * i, timeout=LLM_TIMEOUT, messages=[{
+                    "role": "user",
+                    "content": reformulate_prompt
+                }], )) for i in range(REFORMULATION_CANDIDATES)]
+            try:
+                for candidate in asyncio.as_completed(candidates):
+                    try:
+                        new_prompt = await candidate
+                    except Exception:
+                        continue
+                    if "none" not in new_prompt.lower():
+                        original_prompt = new_prompt
+                        break
+            finally:
+                for candidate in candidates:
+                    candidate.cancel()
 
         return {
             "prompt": original_prompt,
             "features": answer
         }
 
-    def generate_answer(self, prompt, information):
+    async def generate_answer(self, ctx: RagContext, prompt, information):
         """Generate a final answer using the refined prompt and information."""
         final_prompt = (
             f"Using the information provided, generate a response to the following prompt. "
-            f"Prompt: '{prompt}', Information: '{information}', Language: '{self.language}'")
-        response = self.client.chat.completions.create(model="gpt-4o", temperature=0.1, messages=[{
-                                                                                                      "role": "user",
-                                                                                                      "content": final_prompt
-                                                                                                  }], )
-        return response.choices[0].message.content
-
-    def create_embedding(self, text):
+            f"Prompt: '{prompt}', Information: '{information}', Language: '{ctx.language}'")
+        return await complete(self.client, ctx, model="gpt-4o", temperature=0.1,
+            timeout=LLM_TIMEOUT, messages=[{
+                "role": "user",
+                "content": final_prompt
+            }], )
+
+    async def create_embedding(self, text):
         """Generate an embedding for the provided text."""
-        embedding_response = self.vs.oai.embeddings.create(model=self.vs.embedding_model,
-            input=[text])
-        return embedding_response.data[0].embedding
-
-    def retrieve_top_k(self, embedding, k):
-        """Retrieve the top K most relevant documents based on the provided embedding."""
-        return self.vs.client.search(query_vector=embedding, limit=k,
-            collection_name="text-embedding-3-small")
-
-    async def modular(self, req: ModularRagPrompt):
+        return (await self.vs.aembed([text], timeout=EMBEDDING_TIMEOUT))[0]
+
+    async def retrieve_candidates(self, embedding, k, fetch_k=None):
+        """Retrieve the `fetch_k` candidates of the embedding, including their vectors."""
+        with CALL_SECONDS.time(service="qdrant"):
+            return await self.vs.aclient.search(query_vector=embedding,
+                limit=fetch_size(k, fetch_k), with_vectors=True,
+                collection_name=self.collection, timeout=SEARCH_TIMEOUT)
+
+    async def retrieve_top_k(self, embedding, k, fetch_k=None, mmr_lambda=0.7):
+        """Retrieve the top K most relevant documents based on the provided embedding.
+        `fetch_k` candidates are fetched and reranked by maximal marginal relevance."""
+        docs = rerank(embedding, await self.retrieve_candidates(embedding, k, fetch_k), k,
+                      mmr_lambda)
+        record(chunks=len(docs))
+        return docs
+
+    async def modular(self, request: Request, req: ModularRagPrompt):
         """## Modular Rag endpoint
         This endpoint takes quite some time to be processed. Once it is triggered it can take a few minutes until you will get a response.
+
+        `fetch_k` candidates (default: 4 × `top_k`) are retrieved and reranked by maximal marginal relevance to remove near-duplicate chunks. `mmr_lambda` weighs relevance (1) against diversity (0).
+
+        Answers are cached until the index changes. A cached answer is streamed as a `cache` event followed by a single `token` event.
+
+        Set `"advanded_stats": true` to receive the answer as `{"response": ..., "stats": ...}`, where `stats` breaks the request down per module (wall time, tokens in and out, cache hits, retrieved chunks). Modules run concurrently, so their wall times overlap. Streaming requests receive the breakdown as a `stats` event.
+
+        Requests are limited per RAG mode. If all slots and the wait queue of the mode are taken, the server answers with `429 Too Many Requests` and a `Retry-After` header.
+
+        Set `"stream": true` to receive server-sent events instead: `rewrite` (refined prompt), `retrieval` (IDs of the retrieved chunks), `token` (parts of the answer) and finally `done` or `error`.
+        """
+        ctx = RagContext(prompt=req.prompt, language=req.language, top_k=req.top_k,
+                         fetch_k=req.fetch_k, mmr_lambda=req.mmr_lambda,
+                         trace=new_trace(req.advanded_stats, "modular"))
+        answer, embedding = await self.cache.lookup(ctx, self.create_embedding)
+        if answer is not None:
+            ctx.answer = answer
+            if req.stream:
+                return stream_pipeline(ctx, self.cache.replay(ctx), lambda: ctx.answer)
+            return with_stats(ctx, ctx.answer)
+
+        with ctx.trace.span("admission"):
+            slot = await self.admission.acquire("modular")
+        pipeline = self.cache.store(ctx, self._run(ctx), embedding)
+        if req.stream:
+            return stream_pipeline(ctx, pipeline, lambda: ctx.answer, slot=slot)
+        try:
+            await run_cancellable(request, pipeline)
+        finally:
+            slot.release()
+        return with_stats(ctx, ctx.answer)
+
+    async def _run(self, ctx: RagContext):
+        await self.graph.run(ctx)
+
+    async def _refine(self, ctx: RagContext):
+        ctx.rewritten_prompt = await self.refine_prompt(ctx.prompt)
+        await ctx.emit("rewrite", {"prompt": ctx.rewritten_prompt})
+        return ctx.rewritten_prompt
+
+    async def _search(self, ctx: RagContext, text):
+        """Return the embedding of the text and its candidates, reranked in `_merge_documents`."""
+        embedding = await self.create_embedding(text)
+        return embedding, await self.retrieve_candidates(embedding, ctx.top_k, ctx.fetch_k)
+
+    async def _merge_documents(self, ctx: RagContext, speculative, refined):
+        """Rerank the candidates of the raw and the refined prompt together.
+
+        The union is reranked once by maximal marginal relevance to the refined
+        prompt, so near-duplicates found by both searches are removed as well.
         """
-        self.language = req.language
-        self.set_user_prompt(req.prompt)
-        refined_prompt = self.refine_prompt(self.user_prompt)
-        prompt_embedding = self.create_embedding(refined_prompt)
-        retrieved_docs = self.retrieve_top_k(prompt_embedding, req.top_k)
-        extracted_features = self.extract_features(retrieved_docs)
-        filtered_features = self.filter_and_adjust_features(extracted_features, refined_prompt)
-
-        return self.generate_answer(filtered_features["prompt"], filtered_features["features"])
+        embedding, candidates = refined
+        union = {point.id: point for point in candidates}
+        for point in (speculative or (None, []))[1]:
+            union.setdefault(point.id, point)
+        ctx.documents = rerank(embedding, list(union.values()), ctx.top_k, ctx.mmr_lambda)
+        record(chunks=len(ctx.documents))
+        await ctx.emit("retrieval", {"ids": [doc.id for doc in ctx.documents]})
+        return ctx.documents
+
+    async def _extract(self, ctx: RagContext, documents):
+        return await self.extract_features(pack_context(documents, model="gpt-4o"))
+
+    async def _answer(self, ctx: RagContext, filtered_features):
+        ctx.answer = await self.generate_answer(ctx, filtered_features["prompt"],
+                                                filtered_features["features"])
+        return ctx.answer
@@ -1,13 +1,19 @@
 import logging
 from typing import List
 
-from fastapi import APIRouter, Body, HTTPException
-from openai import AzureOpenAI
+from fastapi import APIRouter, Body, HTTPException, Request
 from pydantic import BaseModel
-from qdrant_client import models
 
-from passwords.pw import gpt_password, gpt_sweden
-from pipeline import vector
+from pipeline.collection import collection_name
+from pipeline.metrics import CALL_SECONDS
+from pipeline.resources import resources
+from pipeline.tracing import new_trace, record
+from .common import (complete, EMBEDDING_MODEL, EMBEDDING_TIMEOUT, LLM_TIMEOUT, RagContext,
+    run_cancellable, SEARCH_TIMEOUT, stream_pipeline, with_stats)
+from .admission import shared_admission
+from .cache import ResponseCache
+from .context import pack_context
+from .rerank import fetch_size, rerank
 
 logging.basicConfig(level=logging.INFO)
 
@@ -15,103 +21,164 @@ logging.basicConfig(level=logging.INFO)
 class Prompt(BaseModel):
     prompt: str = "Wer ist Siglinde?"
     top_k: int = 5
+    fetch_k: int | None = None
+    mmr_lambda: float = 0.7
     language: str = "English"
+    stream: bool = False
+    advanded_stats: bool = False
 
 
 class NaiveRagGPT4:
-    def __init__(self, embedding_model="text-embedding-ada-002-sweden", gpt_model="gpt-4o"
+    def __init__(self, embedding_model=EMBEDDING_MODEL, gpt_model="gpt-4o"
     ):
-        self.language = "German"
         self.router = APIRouter()
-        self.vs = vector.Vectorstore(embedding_model=embedding_model)
+        self.vs = resources.vectorstore(embedding_model)
+        self.collection = collection_name(embedding_model)
         self.gpt_model = gpt_model
+        self._collection_ready = False
 
-        self.client = AzureOpenAI(
-            api_key=gpt_password,
-            azure_endpoint=gpt_sweden,
-            api_version="2023-03-15-preview",
+        self.cache = ResponseCache("naive", self.collection)
+        self.admission = shared_admission()
+
+        self.router.add_api_route("/rag/naive-rag/", self.query, methods=["POST"], tags=["NaiveRag"]
         )
 
-        if not self.vs.client.collection_exists("text-embedding-3-small"):
-            self.vs.client.create_collection(
-                "text-embedding-3-small",
+    @property
+    def client(self):
+        """Shared AsyncAzureOpenAI client, created on first use."""
+        return resources.chat_client(api_version="2023-03-15-preview")
+
+    async def _ensure_collection(self):
+        """Create the collection on the first search if it does not exist yet."""
+        if self._collection_ready:
+            return
+        if not await self.vs.aclient.collection_exists(self.collection):
+            from qdrant_client import models
+
+            await self.vs.aclient.create_collection(
+                self.collection,
                 models.VectorParams(
                     size=self.vs.dimensions, distance=models.Distance.COSINE
                 ),
             )
+        self._collection_ready = True
 
-        self.router.add_api_route("/rag/naive-rag/", self.query, methods=["POST"], tags=["NaiveRag"]
-        )
-
-    def embed_text(self, text: str) -> List[float]:
+    async def embed_text(self, text: str) -> List[float]:
         """Embed text using the vectorstore's embedding model."""
-        embedding_response = self.vs.oai.embeddings.create(
-            model=self.vs.embedding_model, input=[text]
-        )
-        return embedding_response.data[0].embedding
-
-    def retrieve_documents(self, query_embedding: List[float], top_k: int = 5
-    ) -> List[models.ScoredPoint]:
-        """Retrieve top K documents from Qdrant based on the query embedding."""
-        search_result = self.vs.client.search(
-            collection_name="text-embedding-3-small",
-            query_vector=query_embedding,
-            limit=top_k,
-        )
-        return search_result
+        return (await self.vs.aembed([text], timeout=EMBEDDING_TIMEOUT))[0]
+
+    async def retrieve_documents(self, query_embedding: List[float], top_k: int = 5,
+                                 fetch_k: int | None = None, mmr_lambda: float = 0.7
+    ) -> list:
+        """Retrieve top K documents from Qdrant based on the query embedding.
+
+        `fetch_k` candidates are fetched and reranked by maximal marginal relevance.
+        """
+        await self._ensure_collection()
+        with CALL_SECONDS.time(service="qdrant"):
+            search_result = await self.vs.aclient.search(
+                collection_name=self.collection,
+                query_vector=query_embedding,
+                limit=fetch_size(top_k, fetch_k),
+                with_vectors=True,
+                timeout=SEARCH_TIMEOUT,
+            )
+        return rerank(query_embedding, search_result, top_k, mmr_lambda)
 
-    def generate_response(self, query: str, context: str) -> str:
+    async def generate_response(self, ctx: RagContext, context: str) -> str:
         """Generate a response using GPT-4."""
 
         prompt = (
             f"Please generate a precise and accurate answer based on the given context and query. Generate your answer in the given target language."
-            f"Context: {context}\n\nQuery: {query}\n\nTarget language: {self.language} \n\nAnswer:")
+            f"Context: {context}\n\nQuery: {ctx.prompt}\n\nTarget language: {ctx.language} \n\nAnswer:")
 
         try:
-            response = (self.client.chat.completions.create(temperature=0.3, model="gpt-4o-sweden",
-                max_tokens=4000, messages=[{
+            response = await complete(self.client, ctx, temperature=0.3,
+                model="gpt-4o-sweden", max_tokens=4000, timeout=LLM_TIMEOUT, messages=[{
                     "role": "user",
                     "content": prompt
-                }, ], ).choices[0].message.content)
+                }, ], )
 
             return response
         except Exception as e:
             logging.error(f"Failed to generate response using GPT-4: {e}")
             raise HTTPException(status_code=500, detail="Failed to generate response.")
 
-    async def query(self, query: Prompt = Body(...)):
+    async def query(self, request: Request, query: Prompt = Body(...)):
         """## Naive RAG
-        This is the naive RAG implementation. Only trigger one request at once. This can take some time to go through the different servers.
+        This is the naive RAG implementation. This can take some time to go through the different servers.
 
         >INFO
         >Try asking the AI about the documents in the DB. To get a list of all documents, just use the `list_files` endpoint.
+
+        `fetch_k` candidates (default: 4 × `top_k`) are retrieved and reranked by maximal marginal relevance to remove near-duplicate chunks. `mmr_lambda` weighs relevance (1) against diversity (0).
+
+        Answers are cached until the index changes. A cached answer is streamed as a `cache` event followed by a single `token` event.
+
+        Set `"advanded_stats": true` to receive a `stats` breakdown per stage (wall time, tokens in and out, cache hits, retrieved chunks) with the response, or as a `stats` event when streaming.
+
+        Requests are limited per RAG mode. If all slots and the wait queue of the mode are taken, the server answers with `429 Too Many Requests` and a `Retry-After` header.
+
+        Set `"stream": true` to receive server-sent events instead: `retrieval` (IDs of the retrieved chunks), `token` (parts of the answer) and finally `done` or `error`.
         """
-        logging.info(f"Received query: {query.prompt}")
-        self.language = query.language
+        ctx = RagContext(prompt=query.prompt, language=query.language, top_k=query.top_k,
+                         fetch_k=query.fetch_k, mmr_lambda=query.mmr_lambda,
+                         trace=new_trace(query.advanded_stats, "naive"))
+        answer, embedding = await self.cache.lookup(ctx, self.embed_text)
+        if answer is not None:
+            ctx.answer = answer
+            if query.stream:
+                return stream_pipeline(ctx, self.cache.replay(ctx), lambda: self._response(ctx))
+            return with_stats(ctx, self._response(ctx))
+
+        ctx.embedding = embedding or []
+        with ctx.trace.span("admission"):
+            slot = await self.admission.acquire("naive")
+        pipeline = self.cache.store(ctx, self._query(ctx), embedding)
+        if query.stream:
+            return stream_pipeline(ctx, pipeline, lambda: self._response(ctx), slot=slot)
+        try:
+            await run_cancellable(request, pipeline)
+        finally:
+            slot.release()
+        return with_stats(ctx, self._response(ctx))
+
+    @staticmethod
+    def _response(ctx: RagContext) -> dict:
+        return {
+            "query": ctx.prompt,
+            "response": ctx.answer
+        }
+
+    async def _query(self, ctx: RagContext):
+        logging.info(f"Received query: {ctx.prompt}")
 
         try:
-            query_embedding = self.embed_text(query.prompt)
+            if not ctx.embedding:
+                with ctx.trace.span("embedding"):
+                    ctx.embedding = await self.embed_text(ctx.prompt)
         except Exception as e:
             logging.error(f"Failed to embed query: {e}")
             raise HTTPException(status_code=500, detail="Failed to embed query.")
 
         try:
-            search_results = self.retrieve_documents(query_embedding, query.top_k)
-            logging.info(f"Retrieved {len(search_results)} relevant documents.")
+            with ctx.trace.span("search"):
+                ctx.documents = await self.retrieve_documents(ctx.embedding, ctx.top_k,
+                                                              ctx.fetch_k, ctx.mmr_lambda)
+                record(chunks=len(ctx.documents))
+            logging.info(f"Retrieved {len(ctx.documents)} relevant documents.")
+            await ctx.emit("retrieval", {"ids": [result.id for result in ctx.documents]})
         except Exception as e:
             logging.error(f"Failed to retrieve documents: {e}")
             raise HTTPException(status_code=500, detail="Failed to retrieve documents.")
 
-        context = " ".join([result.payload["text"] for result in search_results])
+        with ctx.trace.span("context"):
+            context = pack_context(ctx.documents, model="gpt-4o-sweden")
 
         try:
-            response = self.generate_response(query.prompt, context)
-            logging.info(f"Generated response: {response}")
+            with ctx.trace.span("answer"):
+                ctx.answer = await self.generate_response(ctx, context)
+            logging.info(f"Generated response: {ctx.answer}")
         except Exception as e:
             logging.error(f"Failed to generate response: {e}")
             raise HTTPException(status_code=500, detail="Failed to generate response.")
-
-        return {
-            "query": query.prompt,
-            "response": response
-        }
@@ -0,0 +1,67 @@
+"""Maximal marginal relevance reranking of retrieved chunks."""
+
+# Number of candidates fetched per requested chunk if `fetch_k` is not set
+FETCH_FACTOR = 4
+
+
+def fetch_size(top_k: int, fetch_k: int | None = None) -> int:
+    """Return the number of candidates to fetch for `top_k` results."""
+    return max(top_k, fetch_k or FETCH_FACTOR * top_k)
+
+
+def mmr(query, candidates, k: int, lambda_mult: float = 0.5) -> list[int]:
+    """Select `k` candidates by maximal marginal relevance.
+
+    Every step picks the candidate maximising
+    `lambda_mult * sim(query, c) - (1 - lambda_mult) * max(sim(c, selected))`,
+    so near-duplicates of already selected chunks are pushed back.
+
+    :param query: Query vector.
+    :param candidates: Matrix with one candidate vector per row.
+    :param k: Number of candidates to select.
+    :type k: int
+    :param lambda_mult: 1 ranks by relevance only, 0 by diversity only.
+    :type lambda_mult: float
+    :return: Indices of the selected candidates in selection order.
+    :rtype: list[int]
+    """
+    import numpy as np
+
+    candidates = np.asarray(candidates, dtype=np.float32)
+    if candidates.size == 0 or k <= 0:
+        return []
+    query = np.asarray(query, dtype=np.float32)
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = query / max(np.linalg.norm(query), 1e-12)
+
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    for _ in range(min(k, len(candidates)) - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        index = int(np.argmax(scores))
+        selected.append(index)
+        np.maximum(redundancy, similarity[index], out=redundancy)
+    return selected
+
+
+def rerank(query, points: list, k: int, lambda_mult: float = 0.5) -> list:
+    """Rerank scored points (retrieved with vectors) by maximal marginal relevance.
+
+    Points without vectors are returned in their original order.
+
+    :param query: Query vector.
+    :param points: Points returned by a Qdrant search with `with_vectors=True`.
+    :type points: list
+    :param k: Number of points to keep.
+    :type k: int
+    :param lambda_mult: Trade-off between relevance and diversity.
+    :type lambda_mult: float
+    :return: The selected points.
+    :rtype: list
+    """
+    if not points or any(point.vector is None for point in points):
+        return list(points)[:k]
+    return [points[i] for i in mmr(query, [point.vector for point in points], k, lambda_mult)]
@@ -0,0 +1,129 @@
+"""Container for the clients shared by the routers of a worker.
+
+Clients are created on first use, so importing the application stays cheap
+and a worker only pays for the services it actually calls. The heavy client
+libraries (openai, qdrant_client) are imported lazily as well.
+"""
+
+import logging
+import os
+import threading
+
+
+class Resources:
+    """Lazily created, shared clients.
+
+    The application closes the container in its lifespan handler when the
+    worker shuts down.
+    """
+
+    def __init__(self):
+        self._vectorstores = {}
+        self._chat_clients = {}
+        self._balanced_clients = {}
+        self._process_pool = None
+        self._lock = threading.Lock()
+
+    def vectorstore(self, embedding_model: str):
+        """Return the shared `Vectorstore` of an embedding model.
+
+        :param embedding_model: Name of the embedding model.
+        :type embedding_model: str
+        :rtype: Vectorstore
+        """
+        with self._lock:
+            if embedding_model not in self._vectorstores:
+                from .vector import Vectorstore
+
+                self._vectorstores[embedding_model] = Vectorstore(embedding_model)
+            return self._vectorstores[embedding_model]
+
+    def balanced_client(self, service: str, embedding_model: str | None = None):
+        """Return the client balancing over the deployments of a service.
+
+        :param service: "llm" or "embedding", see `pipeline.deployments`.
+        :type service: str
+        :param embedding_model: Model of the embedding deployments to balance over.
+        :type embedding_model: str | None
+        :return: The shared `BalancedClient`, or `None` if
+            `AZURE_<SERVICE>_DEPLOYMENTS` has no (matching) deployments.
+        :rtype: BalancedClient | None
+        """
+        key = (service, embedding_model)
+        with self._lock:
+            if key not in self._balanced_clients:
+                from .deployments import BalancedClient, DeploymentPool
+
+                pool = DeploymentPool.from_env(service, embedding_model)
+                self._balanced_clients[key] = BalancedClient(pool) if pool else None
+            return self._balanced_clients[key]
+
+    def chat_client(self, **kwargs):
+        """Return a shared AsyncAzureOpenAI client for the GPT deployments.
+
+        If several deployments are configured (`AZURE_LLM_DEPLOYMENTS`), the
+        balancing client is returned instead and `kwargs` are ignored.
+
+        :param kwargs: Arguments of `AsyncAzureOpenAI` which differ from the
+            defaults (key and endpoint of the Sweden deployment).
+        :rtype: AsyncAzureOpenAI | BalancedClient
+        """
+        balanced = self.balanced_client("llm")
+        if balanced is not None:
+            return balanced
+        key = tuple(sorted(kwargs.items()))
+        with self._lock:
+            if key not in self._chat_clients:
+                from openai import AsyncAzureOpenAI
+
+                from passwords.pw import gpt_password, gpt_sweden
+
+                self._chat_clients[key] = AsyncAzureOpenAI(
+                    **{"api_key": gpt_password, "azure_endpoint": gpt_sweden, **kwargs}
+                )
+            return self._chat_clients[key]
+
+    def process_pool(self):
+        """Return the process pool for CPU-bound work, e.g. the extraction of uploads.
+
+        The number of processes is read from `UPLOAD_PROCESSES` (default 2).
+        The processes are started by a fork server (or spawned where it is not
+        available) rather than forked, so they do not inherit the threads,
+        sockets and clients of the worker.
+
+        :rtype: ProcessPoolExecutor
+        """
+        with self._lock:
+            if self._process_pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() \
+                    else "spawn"
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=int(os.environ.get("UPLOAD_PROCESSES", 2)),
+                    mp_context=multiprocessing.get_context(method))
+            return self._process_pool
+
+    async def aclose(self):
+        """Close every client created so far and shut the process pool down."""
+        with self._lock:
+            chat_clients = list(self._chat_clients.values())
+            chat_clients += [client for client in self._balanced_clients.values() if client]
+            vectorstores = list(self._vectorstores.values())
+            process_pool, self._process_pool = self._process_pool, None
+            self._chat_clients.clear()
+            self._balanced_clients.clear()
+            self._vectorstores.clear()
+        if process_pool is not None:
+            process_pool.shutdown(wait=False, cancel_futures=True)
+        for client in chat_clients:
+            await client.close()
+        for vectorstore in vectorstores:
+            try:
+                await vectorstore.aclose()
+            except Exception as e:
+                logging.warning(f"Failed to close the clients of {vectorstore.embedding_model}: {e!r}")
+
+
+resources = Resources()
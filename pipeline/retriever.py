@@ -9,9 +9,10 @@ import zlib
 import requests as re
 from dotenv import dotenv_values
 from fastapi import HTTPException
-from pypdf import errors, PdfReader
 from tqdm import tqdm
 
+from .metrics import CALL_SECONDS
+
 
 class DocumentDB:
     """Handles operations with CouchDB for storing and retrieving documents."""
@@ -41,11 +42,22 @@ class DocumentDB:
         """
         Adds a document to the CouchDB.
 
+        Extracts the text on the calling thread; the upload routes use
+        `pipeline.upload` instead, which keeps the event loop free.
+
         :param document: Document file to be added to the database.
         :return: Meta-information about the added document.
         """
+        return self.store_document(self.prepare_document(document))
+
+    def store_document(self, doc_info: dict) -> dict:
+        """
+        Stores a prepared document in the CouchDB.
+
+        :param doc_info: Document as returned by `prepare_document` or `pipeline.upload.prepare`.
+        :return: Meta-information about the added document.
+        """
         try:
-            doc_info = self.prepare_document(document)
             response = self._upload_document(doc_info)
             response.raise_for_status()
             return self._construct_response(doc_info)
@@ -55,14 +67,12 @@ class DocumentDB:
     @staticmethod
     def prepare_document(document) -> dict:
         """Prepare document metadata and content for storage."""
-        name = document.filename.replace(",", "-").replace(" ", "-")
-        content = Extractor.from_bytes(document.file)
-        compressed_content = base64.b64encode(
-            zlib.compress(content.encode("utf-8"), 9)
-        ).decode("utf-8")
+        from .upload import compress_text, document_title
+
+        compressed_content = compress_text(Extractor.from_bytes(document.file))
 
         return {
-            "title": name,
+            "title": document_title(document.filename),
             "content": compressed_content,
             "date": time.strftime("%Y-%m-%d-%H-%M-%S"),
             "checksum": hashlib.sha3_256(
@@ -72,18 +82,19 @@ class DocumentDB:
 
     def _upload_document(self, document: dict):
         """Upload the prepared document to CouchDB."""
-        return re.put(
-            f'{self.url}/docs/{document["title"]}-{document["date"]}',
-            json={
-                "title": document["title"],
-                "content": document["content"],
-                "date": document["date"],
-                "timestamp": int(time.time()),
-                "checksum": document["checksum"],
-            },
-            auth=(self._user, self._password),
-            timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
-        )
+        with CALL_SECONDS.time(service="couchdb"):
+            return re.put(
+                f'{self.url}/docs/{document["title"]}-{document["date"]}',
+                json={
+                    "title": document["title"],
+                    "content": document["content"],
+                    "date": document["date"],
+                    "timestamp": int(time.time()),
+                    "checksum": document["checksum"],
+                },
+                auth=(self._user, self._password),
+                timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
+            )
 
     def _construct_response(self, document: dict) -> dict:
         """Construct a response with metadata about the uploaded document."""
@@ -102,11 +113,12 @@ class DocumentDB:
         :return: The document data.
         """
         try:
-            response = re.get(
-                f"{self.url}/docs/{doc_id}",
-                auth=(self._user, self._password),
-                timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
-            )
+            with CALL_SECONDS.time(service="couchdb"):
+                response = re.get(
+                    f"{self.url}/docs/{doc_id}",
+                    auth=(self._user, self._password),
+                    timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
+                )
             response.raise_for_status()
             document = response.json()
             document["content"] = self._decompress_content(document["content"])
@@ -123,19 +135,62 @@ class DocumentDB:
 
     def list_documents(self) -> list:
         """List all document IDs in CouchDB."""
+        try:
+            with CALL_SECONDS.time(service="couchdb"):
+                response = re.get(
+                    f"{self.url}/docs/_all_docs",
+                    auth=(self._user, self._password),
+                    timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
+                )
+            response.raise_for_status()
+            return [row["id"] for row in response.json().get("rows", [])]
+        except re.RequestException as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"An error occurred while listing documents: {e}",
+            )
+
+    def changes(self, since: str = "0", longpoll: bool = False, timeout: int = 60000) -> dict:
+        """
+        Read the change feed of the `docs` database.
+
+        :param since: Sequence to read changes from. `"0"` returns every document.
+        :param longpoll: Block until at least one change happened or `timeout` expired.
+        :param timeout: Longpoll timeout in milliseconds.
+        :return: Dictionary with the `results` (id, seq, revision, deleted) and the `last_seq`.
+        """
+        params = {"since": since, "style": "main_only"}
+        request_timeout = int(self.secrets.get("DEFAULT_TIMEOUT", 30))
+        if longpoll:
+            params.update({"feed": "longpoll", "timeout": timeout})
+            request_timeout += timeout // 1000
         try:
             response = re.get(
-                f"{self.url}/docs/_all_docs",
+                f"{self.url}/docs/_changes",
+                params=params,
                 auth=(self._user, self._password),
-                timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
+                timeout=request_timeout,
             )
             response.raise_for_status()
-            return [row["id"] for row in response.json().get("rows", [])]
+            feed = response.json()
         except re.RequestException as e:
             raise HTTPException(
                 status_code=500,
-                detail=f"An error occurred while listing documents: {e}",
+                detail=f"An error occurred while reading the change feed: {e}",
             )
+        return {
+            "results": [
+                {
+                    "id": row["id"],
+                    "seq": row["seq"],
+                    "rev": row["changes"][0]["rev"] if row.get("changes") else None,
+                    "deleted": row.get("deleted", False),
+                }
+                for row in feed.get("results", [])
+                if not row["id"].startswith("_design/")
+            ],
+            "last_seq": feed.get("last_seq", since),
+        }
 
     def delete_document(self, doc_id: str):
         """Delete a document from CouchDB."""
@@ -146,11 +201,12 @@ class DocumentDB:
             )
         rev = self.get_document(doc_id)["_rev"]
         try:
-            re.delete(
-                f"{self.url}/docs/{doc_id}?rev={rev}",
-                auth=(self._user, self._password),
-                timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
-            )
+            with CALL_SECONDS.time(service="couchdb"):
+                re.delete(
+                    f"{self.url}/docs/{doc_id}?rev={rev}",
+                    auth=(self._user, self._password),
+                    timeout=int(self.secrets.get("DEFAULT_TIMEOUT", 30)),
+                )
         except re.RequestException as e:
             raise HTTPException(
                 status_code=500, detail=f"Failed to delete document: {e}"
@@ -219,6 +275,8 @@ class Extractor:
     @staticmethod
     def from_bytes(inp: bytes) -> str:
         """Extract text from a PDF provided as bytes."""
+        from pypdf import PdfReader
+
         reader = PdfReader(inp)
         return "".join(page.extract_text() for page in reader.pages)
 
@@ -239,6 +297,8 @@ class Extractor:
 
     def _extract_text_from_pdf(self, pdf_path: str) -> str:
         """Extract text from a single PDF file."""
+        from pypdf import errors, PdfReader
+
         try:
             with open(pdf_path, "rb") as file:
                 reader = PdfReader(file)
@@ -0,0 +1,415 @@
+"""Client-side scheduler for the calls to the Azure OpenAI deployments.
+
+Queries and indexing jobs share the embedding and GPT deployments and their
+quota. Every outbound call therefore asks the scheduler of its worker for
+permission first:
+
+- Each service ("embedding", "llm") has a token and a request budget per
+  minute (`AZURE_<SERVICE>_TPM`, `AZURE_<SERVICE>_RPM`; 0 means unlimited),
+  refilled continuously. Budgets are per worker, so with several workers they
+  should be set to the quota divided by the number of workers.
+- Calls have a priority class. Waiting interactive calls are always served
+  before background calls, and background calls leave a reserve of the budget
+  (`AZURE_BACKGROUND_RESERVE`) untouched.
+- While interactive calls are running, and for `AZURE_INTERACTIVE_WINDOW`
+  seconds afterwards, background calls are throttled to
+  `AZURE_BACKGROUND_BUSY_CONCURRENCY` concurrent calls.
+- A 429 from Azure pauses the background calls of the service for the
+  `Retry-After` of the response.
+
+The interactive load and the 429 pauses are published to the other workers of
+the host through the job store (`JobStore.set_signal`), and the scheduler
+reads theirs every `AZURE_SIGNAL_INTERVAL` seconds. An interactive call
+counts as running for at most `AZURE_INTERACTIVE_LEASE` seconds in the other
+workers, so a crashed worker does not throttle the background calls forever.
+
+The priority class is taken from a context variable, so code which runs on
+behalf of an indexing job only has to be wrapped in `background()`.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from .metrics import CALL_SECONDS, RATE_LIMITED, SCHEDULER_WAIT_SECONDS
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_priority = ContextVar("azure_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def background():
+    """Run the calls made in the block (and in tasks started from it) as background calls."""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_tokens(texts) -> int:
+    """Estimate the number of tokens of texts (about four characters per token).
+
+    Exact counts are not needed: the budget is corrected with the usage which
+    Azure reports once the call is done.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    return sum(len(text) for text in texts) // 4 + 1
+
+
+def chat_tokens(kwargs: dict) -> int:
+    """Estimate the tokens of a chat completion request, including its `max_tokens`."""
+    messages = kwargs.get("messages", [])
+    return (estimate_tokens([str(message.get("content", "")) for message in messages])
+            + (kwargs.get("max_tokens") or 0))
+
+
+class _Bucket:
+    """Token bucket refilled continuously with `per_minute / 60` per second."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float, reserve: float = 0.0) -> float:
+        """Seconds until `amount` can be taken while keeping `reserve` of the capacity."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        required = min(amount + reserve * self.capacity, self.capacity)
+        return max(0.0, (required - self.level) / self.rate)
+
+    def take(self, amount: float):
+        if self.rate > 0:
+            self._refill(time.monotonic())
+            # May become negative when the actual usage exceeds the estimate
+            self.level -= amount
+
+
+class _Budget:
+    """Budgets, wait queue and backoff of a service."""
+
+    def __init__(self, service: str, tpm: float, rpm: float):
+        self.service = service
+        self.tokens = _Bucket(tpm)
+        self.requests = _Bucket(rpm)
+        self.waiting = []
+        self.paused_until = 0.0
+        self.wakeup = None
+        self.pump = None
+
+    def stats(self) -> dict:
+        return {"waiting": len(self.waiting), "tokens": self.tokens.level,
+                "requests": self.requests.level,
+                "paused_for": max(0.0, self.paused_until - time.monotonic())}
+
+
+class Call:
+    """A scheduled call, used as an async context manager around the request."""
+
+    __slots__ = ("scheduler", "service", "tokens", "priority", "queued", "budget")
+
+    def __init__(self, scheduler, service: str, tokens: int, priority: int):
+        self.scheduler = scheduler
+        self.service = service
+        self.tokens = tokens
+        self.priority = priority
+        self.queued = time.perf_counter()
+        self.budget = None
+
+    def usage(self, response):
+        """Correct the budget with the token usage reported by the response."""
+        total = getattr(getattr(response, "usage", None), "total_tokens", None)
+        if total and self.budget is not None:
+            self.budget.tokens.take(total - self.tokens)
+            self.tokens = total
+
+    async def __aenter__(self):
+        await self.scheduler._acquire(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler._release(self, exc)
+
+
+class AzureScheduler:
+    """Schedules the Azure OpenAI calls of a worker by priority and budget.
+
+    Used from the event loop of the worker only.
+    """
+
+    def __init__(self, budgets: dict | None = None, background_concurrency: int | None = None,
+                 busy_concurrency: int | None = None, reserve: float | None = None,
+                 window: float | None = None, signals=None,
+                 signal_interval: float | None = None):
+        """Create the scheduler.
+
+        :param budgets: `(tokens per minute, requests per minute)` per service.
+            Services which are not listed are read from `AZURE_<SERVICE>_TPM`
+            and `AZURE_<SERVICE>_RPM`.
+        :type budgets: dict | None
+        :param background_concurrency: Concurrent background calls while there is
+            no interactive load (`AZURE_BACKGROUND_CONCURRENCY`, default 4).
+        :type background_concurrency: int | None
+        :param busy_concurrency: Concurrent background calls under interactive load
+            (`AZURE_BACKGROUND_BUSY_CONCURRENCY`, default 1).
+        :type busy_concurrency: int | None
+        :param reserve: Share of the budgets kept for interactive calls
+            (`AZURE_BACKGROUND_RESERVE`, default 0.3).
+        :type reserve: float | None
+        :param window: Seconds after the last interactive call during which the
+            background calls stay throttled (`AZURE_INTERACTIVE_WINDOW`, default 5).
+        :type window: float | None
+        :param signals: Store shared with the other workers, see
+            `JobStore.set_signal`. Without it, the scheduler only sees the calls
+            of this process.
+        :type signals: JobStore | None
+        :param signal_interval: Seconds between two reads of the signals of the
+            other workers (`AZURE_SIGNAL_INTERVAL`, default 1).
+        :type signal_interval: float | None
+        """
+        self.limits = dict(budgets or {})
+        self.background_concurrency = int(os.environ.get("AZURE_BACKGROUND_CONCURRENCY", 4)) \
+            if background_concurrency is None else background_concurrency
+        self.busy_concurrency = int(os.environ.get("AZURE_BACKGROUND_BUSY_CONCURRENCY", 1)) \
+            if busy_concurrency is None else busy_concurrency
+        self.reserve = float(os.environ.get("AZURE_BACKGROUND_RESERVE", 0.3)) \
+            if reserve is None else reserve
+        self.window = float(os.environ.get("AZURE_INTERACTIVE_WINDOW", 5)) \
+            if window is None else window
+        self.signals = signals
+        self.signal_interval = float(os.environ.get("AZURE_SIGNAL_INTERVAL", 1)) \
+            if signal_interval is None else signal_interval
+        self.interactive_lease = float(os.environ.get("AZURE_INTERACTIVE_LEASE", 60))
+        self.budgets = {}
+        self.running = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.last_interactive = -math.inf
+        self._sequence = itertools.count()
+        # Signals of all workers, converted to `time.monotonic()`
+        self._shared = {}
+        self._shared_read = -math.inf
+        self._reading = None
+        # One thread keeps the published signals in order
+        self._signal_executor = ThreadPoolExecutor(1, thread_name_prefix="scheduler-signals") \
+            if signals is not None else None
+
+    def _publish(self, name: str, until: float):
+        """Publish a signal ending at `until` (`time.monotonic()`) without blocking the loop."""
+        if self.signals is None:
+            return
+        def publish():
+            try:
+                self.signals.set_signal(name, until - time.monotonic() + time.time())
+            except Exception as e:
+                logging.warning(f"Failed to publish scheduler signal {name}: {e!r}")
+
+        self._signal_executor.submit(publish)
+
+    async def refresh(self):
+        """Read the signals of the other workers and wake up the waiting calls."""
+        if self.signals is None:
+            return
+        self._shared_read = time.monotonic()
+        try:
+            signals = await asyncio.get_running_loop().run_in_executor(
+                self._signal_executor, self.signals.signals
+            )
+        except Exception as e:
+            logging.warning(f"Failed to read scheduler signals: {e!r}")
+            return
+        offset = time.monotonic() - time.time()
+        self._shared = {name: value + offset for name, value in signals.items()}
+        for budget in self.budgets.values():
+            if budget.wakeup is not None:
+                budget.wakeup.set()
+
+    def _refresh(self, now: float):
+        """Start reading the signals of the other workers if they are outdated."""
+        if (self.signals is None or self._reading is not None
+                or now - self._shared_read < self.signal_interval):
+            return
+        self._reading = asyncio.ensure_future(self.refresh())
+        self._reading.add_done_callback(lambda _: setattr(self, "_reading", None))
+
+    def budget(self, service: str) -> _Budget:
+        """Return the budget of a service, created on first use."""
+        if service not in self.budgets:
+            prefix = f"AZURE_{service.upper()}"
+            tpm, rpm = self.limits.get(service, (float(os.environ.get(f"{prefix}_TPM", 0)),
+                                                 float(os.environ.get(f"{prefix}_RPM", 0))))
+            self.budgets[service] = _Budget(service, tpm, rpm)
+        return self.budgets[service]
+
+    def slot(self, service: str, tokens: int = 0, priority: int | None = None) -> Call:
+        """Wait for permission to call a service: `async with scheduler.slot("llm", 500) as call:`.
+
+        :param service: "embedding" or "llm".
+        :type service: str
+        :param tokens: Estimated tokens of the call, see `estimate_tokens`.
+        :type tokens: int
+        :param priority: `INTERACTIVE` or `BACKGROUND`. Defaults to the class of
+            the current context, see `background`.
+        :type priority: int | None
+        :rtype: Call
+        """
+        return Call(self, service, tokens, _priority.get() if priority is None else priority)
+
+    def _busy(self, now: float) -> float:
+        """Seconds the background calls stay throttled, `inf` while interactive calls run."""
+        if self.running[INTERACTIVE]:
+            return math.inf
+        return max(0.0, self.last_interactive + self.window - now,
+                   self._shared.get("interactive", -math.inf) - now)
+
+    def _delay(self, budget: _Budget, call: Call) -> float:
+        now = time.monotonic()
+        if call.priority == INTERACTIVE:
+            return max(budget.requests.delay(1, now), budget.tokens.delay(call.tokens, now))
+        self._refresh(now)
+        delays = [budget.requests.delay(1, now, self.reserve),
+                  budget.tokens.delay(call.tokens, now, self.reserve),
+                  budget.paused_until - now,
+                  self._shared.get(f"paused:{budget.service}", -math.inf) - now]
+        busy = self._busy(now)
+        limit = self.busy_concurrency if busy > 0 else self.background_concurrency
+        if self.running[BACKGROUND] >= limit:
+            # Waits for a running call to finish, or for the interactive load to end
+            delays.append(busy if busy > 0 else math.inf)
+        return max(delays)
+
+    def _start(self, budget: _Budget, call: Call):
+        call.budget = budget
+        budget.requests.take(1)
+        budget.tokens.take(call.tokens)
+        self.running[call.priority] += 1
+        if call.priority == INTERACTIVE:
+            self.last_interactive = time.monotonic()
+            if self.running[INTERACTIVE] == 1:
+                self._publish("interactive", self.last_interactive + self.interactive_lease)
+        SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - call.queued, service=call.service,
+                                       priority=PRIORITY_NAMES[call.priority])
+
+    async def _acquire(self, call: Call):
+        budget = self.budget(call.service)
+        ahead = budget.waiting and budget.waiting[0][0] <= call.priority
+        if not ahead and self._delay(budget, call) <= 0:
+            self._start(budget, call)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(budget.waiting, (call.priority, next(self._sequence), call, waiter))
+        if budget.pump is None:
+            budget.wakeup = asyncio.Event()
+            budget.pump = asyncio.create_task(self._pump(budget))
+        else:
+            budget.wakeup.set()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Started just before the cancellation
+                self._release(call, None)
+            else:
+                waiter.cancel()
+            raise
+
+    async def _pump(self, budget: _Budget):
+        """Start the waiting calls of a service in priority order once they may run."""
+        try:
+            while budget.waiting:
+                _, _, call, waiter = budget.waiting[0]
+                if waiter.done():
+                    heapq.heappop(budget.waiting)
+                    continue
+                delay = self._delay(budget, call)
+                if delay <= 0:
+                    heapq.heappop(budget.waiting)
+                    self._start(budget, call)
+                    waiter.set_result(None)
+                    continue
+                if self.signals is not None:
+                    # Signals of the other workers may end the wait earlier
+                    delay = min(delay, self.signal_interval)
+                budget.wakeup.clear()
+                try:
+                    await asyncio.wait_for(budget.wakeup.wait(),
+                                           None if math.isinf(delay) else delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            budget.pump = None
+
+    def _release(self, call: Call, exc: BaseException | None):
+        budget = call.budget
+        if budget is None:
+            return
+        call.budget = None
+        self.running[call.priority] -= 1
+        if call.priority == INTERACTIVE:
+            self.last_interactive = time.monotonic()
+            if not self.running[INTERACTIVE]:
+                self._publish("interactive", self.last_interactive + self.window)
+        if getattr(exc, "status_code", None) == 429:
+            RATE_LIMITED.inc(service=call.service)
+            headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+            try:
+                retry_after = float(headers.get("retry-after", 10))
+            except ValueError:
+                retry_after = 10.0
+            budget.paused_until = max(budget.paused_until, time.monotonic() + retry_after)
+            self._publish(f"paused:{call.service}", budget.paused_until)
+        for other in self.budgets.values():
+            if other.wakeup is not None:
+                other.wakeup.set()
+
+    def stats(self) -> dict:
+        """Return the running calls per priority class and the state of every budget."""
+        return {
+            "running": {PRIORITY_NAMES[priority]: count for priority, count in self.running.items()},
+            "interactive_load": self._busy(time.monotonic()) > 0,
+            "services": {service: budget.stats() for service, budget in self.budgets.items()},
+        }
+
+
+@lru_cache(maxsize=None)
+def shared_scheduler() -> AzureScheduler:
+    """Return the scheduler shared by all Azure clients of this process.
+
+    The interactive load and rate limit pauses are shared with the other
+    workers of the host through the job store.
+    """
+    from .jobs import JobStore
+
+    return AzureScheduler(signals=JobStore())
+
+
+async def chat_completion(client, **kwargs):
+    """Run a chat completion (without streaming) through the shared scheduler.
+
+    :param client: AsyncAzureOpenAI client.
+    :param kwargs: Arguments of `chat.completions.create`.
+    :return: The response of the deployment.
+    """
+    async with shared_scheduler().slot("llm", chat_tokens(kwargs)) as call:
+        with CALL_SECONDS.time(service="llm"):
+            response = await client.chat.completions.create(**kwargs)
+        call.usage(response)
+    return response
@@ -0,0 +1,147 @@
+"""Module for exporting and importing collections without re-embedding the corpus."""
+
+import gzip
+import json
+import os
+import time
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient
+
+FORMAT_VERSION = 1
+
+
+def export_collection(client: "QdrantClient", collection: str, path: str, batch_size: int = 1024,
+                      extra: dict | None = None) -> dict:
+    """Write every point of a collection into a local snapshot directory.
+
+    The snapshot consists of
+        - `vectors.npy`: float32 matrix (one row per point), written as a memmap,
+        - `payloads.json.gz`: point IDs and the payloads stored column by column,
+        - `manifest.json`: collection parameters and the number of points.
+
+    :param client: Qdrant client.
+    :type client: "QdrantClient"
+    :param collection: Name of the collection to export.
+    :type collection: str
+    :param path: Target directory. Existing snapshot files are overwritten.
+    :type path: str
+    :param batch_size: Number of points fetched per scroll request.
+    :type batch_size: int
+    :param extra: Additional data stored in the manifest, e.g. indexing checkpoints.
+    :type extra: dict | None
+    :return: The manifest of the snapshot.
+    :rtype: dict
+    """
+    import numpy as np
+
+    params = client.get_collection(collection).config.params.vectors
+    count = client.count(collection, exact=True).count
+    os.makedirs(path, exist_ok=True)
+
+    vectors = np.lib.format.open_memmap(
+        os.path.join(path, "vectors.npy"), mode="w+", dtype=np.float32,
+        shape=(count, params.size),
+    )
+    ids = []
+    columns = {}
+    offset = None
+    row = 0
+    while row < count:
+        points, offset = client.scroll(
+            collection, limit=batch_size, offset=offset, with_vectors=True, with_payload=True
+        )
+        for point in points[: count - row]:
+            vectors[row] = point.vector
+            ids.append(point.id)
+            for key in point.payload or {}:
+                columns.setdefault(key, [None] * row)
+            for key, column in columns.items():
+                column.append((point.payload or {}).get(key))
+            row += 1
+        if offset is None:
+            break
+    vectors.flush()
+    del vectors
+
+    with gzip.open(os.path.join(path, "payloads.json.gz"), "wt", encoding="utf-8") as file:
+        json.dump({"ids": ids, "columns": columns}, file, ensure_ascii=False)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "collection": collection,
+        "dimensions": params.size,
+        "distance": params.distance.value,
+        "count": row,
+        "created_at": int(time.time()),
+        **(extra or {}),
+    }
+    with open(os.path.join(path, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def read_manifest(path: str) -> dict:
+    """Read the manifest of a snapshot directory.
+
+    :raises FileNotFoundError: If the directory does not contain a snapshot.
+    """
+    with open(os.path.join(path, "manifest.json")) as file:
+        manifest = json.load(file)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format: {manifest.get('format_version')}")
+    return manifest
+
+
+def import_collection(client: "QdrantClient", path: str, collection: str | None = None,
+                      batch_size: int = 256, parallel: int = 4, recreate: bool = False) -> dict:
+    """Stream a snapshot back into Qdrant with parallel batched upserts.
+
+    :param client: Qdrant client.
+    :type client: "QdrantClient"
+    :param path: Snapshot directory created by `export_collection`.
+    :type path: str
+    :param collection: Target collection. Defaults to the exported collection.
+    :type collection: str | None
+    :param batch_size: Number of points per upsert.
+    :type batch_size: int
+    :param parallel: Number of parallel upload workers.
+    :type parallel: int
+    :param recreate: Drop the target collection before importing.
+    :type recreate: bool
+    :return: The manifest of the imported snapshot.
+    :rtype: dict
+    """
+    import numpy as np
+    from qdrant_client import models
+
+    manifest = read_manifest(path)
+    collection = collection or manifest["collection"]
+    count = manifest["count"]
+
+    if recreate and client.collection_exists(collection):
+        client.delete_collection(collection)
+    if not client.collection_exists(collection):
+        client.create_collection(
+            collection,
+            vectors_config=models.VectorParams(
+                size=manifest["dimensions"], distance=models.Distance(manifest["distance"])
+            ),
+        )
+
+    vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")[:count]
+    with gzip.open(os.path.join(path, "payloads.json.gz"), "rt", encoding="utf-8") as file:
+        data = json.load(file)
+    columns = data["columns"]
+    payloads = (
+        {key: column[row] for key, column in columns.items() if column[row] is not None}
+        for row in range(count)
+    )
+
+    client.upload_collection(
+        collection, vectors=vectors, payload=payloads, ids=data["ids"],
+        batch_size=batch_size, parallel=parallel, wait=True,
+    )
+    return manifest
@@ -0,0 +1,178 @@
+"""Lightweight spans for a per-stage breakdown of requests and indexing jobs.
+
+A `Trace` collects one `Span` per executed stage. Code further down (LLM
+calls, embeddings, caches) does not need to know about the trace: `record`
+adds counters to the span which is currently open in the running task. When
+tracing is disabled, `NullTrace` hands out spans which only feed the stage
+latency histogram and `record` only reads a context variable.
+"""
+
+import time
+from contextvars import ContextVar
+
+from .metrics import STAGE_SECONDS
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    """Wall time and counters (tokens, cache hits, chunks, ...) of one stage."""
+
+    __slots__ = ("name", "start", "duration", "counters")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.counters = {}
+
+    def add(self, **counters):
+        """Add to the counters of the span."""
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class _SpanContext:
+    __slots__ = ("span", "pipeline", "token")
+
+    def __init__(self, span: Span, pipeline: str):
+        self.span = span
+        self.pipeline = pipeline
+        self.token = None
+
+    def __enter__(self) -> Span:
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.duration = time.perf_counter() - self.span.start
+        _current_span.reset(self.token)
+        STAGE_SECONDS.observe(self.span.duration, pipeline=self.pipeline, stage=self.span.name)
+
+
+class Trace:
+    """Collects the spans of a request or a job."""
+
+    enabled = True
+
+    def __init__(self, pipeline: str = ""):
+        """Create a trace.
+
+        :param pipeline: Name of the pipeline, label of the stage latency histogram.
+        :type pipeline: str
+        """
+        self.pipeline = pipeline
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def span(self, name: str) -> _SpanContext:
+        """Open a span for a stage: `with trace.span("search") as span: ...`.
+
+        Stages may be entered several times (and concurrently); `summary`
+        aggregates all spans of the same name.
+        """
+        span = Span(name)
+        self.spans.append(span)
+        return _SpanContext(span, self.pipeline)
+
+    def summary(self) -> dict:
+        """Return the breakdown per stage, in the order the stages started.
+
+        :return: Total wall time and, per stage, the number of calls, the
+            offset of the first call, the summed wall time and the summed counters.
+        :rtype: dict
+        """
+        now = time.perf_counter()
+        stages = {}
+        totals = {}
+        for span in self.spans:
+            stage = stages.setdefault(span.name, {
+                "name": span.name,
+                "calls": 0,
+                "start_ms": round((span.start - self.start) * 1000, 3),
+                "wall_ms": 0.0,
+            })
+            stage["calls"] += 1
+            stage["wall_ms"] += ((span.duration if span.duration is not None else now - span.start)
+                                 * 1000)
+            for key, value in span.counters.items():
+                stage[key] = stage.get(key, 0) + value
+                totals[key] = totals.get(key, 0) + value
+        for stage in stages.values():
+            stage["wall_ms"] = round(stage["wall_ms"], 3)
+        return {
+            "total_ms": round((now - self.start) * 1000, 3),
+            **totals,
+            "stages": list(stages.values()),
+        }
+
+
+class _StageTimer:
+    __slots__ = ("pipeline", "name", "start")
+
+    def __init__(self, pipeline: str, name: str):
+        self.pipeline = pipeline
+        self.name = name
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, pipeline=self.pipeline,
+                              stage=self.name)
+
+
+class NullTrace:
+    """Trace of requests which did not ask for statistics.
+
+    Keeps no spans; the stages are only timed for the latency histogram.
+    """
+
+    enabled = False
+
+    def __init__(self, pipeline: str = ""):
+        self.pipeline = pipeline
+
+    def span(self, name: str) -> _StageTimer:
+        return _StageTimer(self.pipeline, name)
+
+    def summary(self):
+        return None
+
+
+NULL_TRACE = NullTrace()
+_null_traces = {}
+
+
+def new_trace(enabled: bool, pipeline: str = "") -> Trace | NullTrace:
+    """Return a new `Trace` if `enabled`, otherwise the shared `NullTrace` of the pipeline."""
+    if enabled:
+        return Trace(pipeline)
+    if pipeline not in _null_traces:
+        _null_traces[pipeline] = NullTrace(pipeline)
+    return _null_traces[pipeline]
+
+
+def record(**counters):
+    """Add counters to the span which is open in the current task, if any."""
+    span = _current_span.get()
+    if span is not None:
+        span.add(**counters)
+
+
+def tracing() -> bool:
+    """Whether a span is open in the current task."""
+    return _current_span.get() is not None
+
+
+def record_usage(response):
+    """Record the token usage reported by an OpenAI response."""
+    span = _current_span.get()
+    usage = getattr(response, "usage", None)
+    if span is not None and usage is not None:
+        span.add(tokens_in=usage.prompt_tokens or 0,
+                 tokens_out=getattr(usage, "completion_tokens", 0) or 0)
@@ -0,0 +1,143 @@
+"""Module which prepares uploaded PDF files without blocking the event loop.
+
+An upload is streamed chunk by chunk into a temporary file on disk while its
+checksum is computed. The CPU-bound work, extracting the text and compressing
+it, runs in the process pool of the worker (see `Resources.process_pool`),
+which only receives the path of the temporary file.
+
+The temporary files are named after the worker (`upload-<pid>-...`), so the
+files of a crashed worker can be removed with `remove_stale`.
+"""
+
+import asyncio
+import base64
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+from .metrics import process_alive
+from .resources import resources
+
+# Bytes read from the upload at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+class SpooledUpload:
+    """An upload stored in a temporary file, removed with `close`."""
+
+    def __init__(self, title: str, path: str, size: int, checksum: str):
+        """Create the upload.
+
+        :param title: Name of the document, derived from the file name.
+        :type title: str
+        :param path: Path of the temporary file.
+        :type path: str
+        :param size: Size of the file in bytes.
+        :type size: int
+        :param checksum: SHA3-256 of the file.
+        :type checksum: str
+        """
+        self.title = title
+        self.path = path
+        self.size = size
+        self.checksum = checksum
+        self.date = time.strftime("%Y-%m-%d-%H-%M-%S")
+
+    @property
+    def document_id(self) -> str:
+        """ID of the document in CouchDB."""
+        return f"{self.title}-{self.date}"
+
+    def close(self):
+        """Remove the temporary file."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def document_title(filename: str) -> str:
+    """Return the title of a document, the file name without commas and spaces."""
+    return filename.replace(",", "-").replace(" ", "-")
+
+
+async def spool(upload, directory: str | None = None) -> SpooledUpload:
+    """Stream an upload into a temporary file and compute its checksum on the way.
+
+    :param upload: The uploaded file (`fastapi.UploadFile`).
+    :param directory: Directory of the temporary file (`UPLOAD_DIR`, default
+        the system's temporary directory).
+    :type directory: str | None
+    :rtype: SpooledUpload
+    """
+    directory = directory or os.environ.get("UPLOAD_DIR") or None
+    handle, path = tempfile.mkstemp(suffix=".pdf", prefix=f"upload-{os.getpid()}-", dir=directory)
+    checksum = hashlib.sha3_256()
+    size = 0
+    try:
+        with os.fdopen(handle, "wb") as file:
+            while chunk := await upload.read(CHUNK_SIZE):
+                checksum.update(chunk)
+                size += len(chunk)
+                await asyncio.to_thread(file.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return SpooledUpload(document_title(upload.filename), path, size, checksum.hexdigest())
+
+
+def remove_stale(directory: str | None = None) -> int:
+    """Remove the temporary files left behind by exited workers.
+
+    :param directory: Directory of the temporary files, see `spool`.
+    :type directory: str | None
+    :return: Number of removed files.
+    :rtype: int
+    """
+    directory = directory or os.environ.get("UPLOAD_DIR") or tempfile.gettempdir()
+    removed = 0
+    for path in glob.glob(os.path.join(directory, "upload-*-*.pdf")):
+        pid = os.path.basename(path).split("-")[1]
+        if not pid.isdigit() or int(pid) == os.getpid() or process_alive(int(pid)):
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError as e:
+            logging.warning(f"Failed to remove the stale upload {path}: {e!r}")
+    return removed
+
+
+def compress_text(text: str) -> str:
+    """Compress text the way it is stored in CouchDB (zlib, base64)."""
+    return base64.b64encode(zlib.compress(text.encode("utf-8"), 9)).decode("utf-8")
+
+
+def compress_pdf(path: str) -> str:
+    """Extract the text of a PDF file and compress it. Runs in the process pool."""
+    from .retriever import Extractor
+
+    with open(path, "rb") as file:
+        return compress_text(Extractor.from_bytes(file))
+
+
+async def prepare(upload: SpooledUpload) -> dict:
+    """Extract and compress a spooled upload in the process pool.
+
+    :param upload: Upload returned by `spool`.
+    :type upload: SpooledUpload
+    :return: The document as expected by `DocumentDB.store_document`.
+    :rtype: dict
+    """
+    loop = asyncio.get_running_loop()
+    content = await loop.run_in_executor(resources.process_pool(), compress_pdf, upload.path)
+    return {
+        "title": upload.title,
+        "content": content,
+        "date": upload.date,
+        "checksum": upload.checksum,
+    }
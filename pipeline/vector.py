@@ -1,15 +1,33 @@
 """Module with all classes related to Vector operations."""
 
+import hashlib
+import logging
+import os
+import sqlite3
+from asyncio import to_thread
+from typing import TYPE_CHECKING
+
 from dotenv import dotenv_values
-from openai import AzureOpenAI
-from qdrant_client import QdrantClient
 
 import passwords.pw
 from passwords import pw
+from .cache_store import shared_store
+from .metrics import CACHE_REQUESTS, CALL_SECONDS
+from .scheduler import estimate_tokens, shared_scheduler
+from .tracing import record, record_usage
+
+if TYPE_CHECKING:
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+    from qdrant_client import AsyncQdrantClient, QdrantClient
+
+    from .deployments import BalancedClient
 
 
 class Vectorstore:
-    """Handles operations with Qdrant databases, supporting OpenAI embedding models."""
+    """Handles operations with Qdrant databases, supporting OpenAI embedding models.
+
+    All clients are created on first use.
+    """
 
     def __init__(self, embedding_model: str):
         """
@@ -24,8 +42,10 @@ class Vectorstore:
         """
         self.embedding_model = embedding_model
         self.dimensions = self._get_model_dimensions(embedding_model)
-        self.client = self._initialize_qdrant_client()
-        self.oai = self._initialize_openai_client()
+        self._client = None
+        self._oai = None
+        self._aclient = None
+        self._aoai = None
 
     def _get_model_dimensions(self, embedding_model: str) -> int:
         """Retrieve the number of dimensions for the given embedding model."""
@@ -40,14 +60,32 @@ class Vectorstore:
         except KeyError:
             raise ValueError(f"Unknown embedding model: {embedding_model}")
 
-    def _initialize_qdrant_client(self) -> QdrantClient:
+    @property
+    def client(self) -> "QdrantClient":
+        """Qdrant client, created on first use."""
+        if self._client is None:
+            self._client = self._initialize_qdrant_client()
+        return self._client
+
+    @property
+    def oai(self) -> "AzureOpenAI | None":
+        """OpenAI client for the embedding model, created on first use."""
+        if self._oai is None:
+            self._oai = self._initialize_openai_client()
+        return self._oai
+
+    def _initialize_qdrant_client(self) -> "QdrantClient":
         """Initialize and return a Qdrant client instance."""
+        from qdrant_client import QdrantClient
+
         qdrant_host = dotenv_values("../.env").get("QDRANT_HOST")
         return QdrantClient(host=qdrant_host, api_key=pw.access_token_qdrant, port=443)
 
     def _initialize_openai_client(self):
         """Initialize and return an OpenAI client instance based on the selected embedding model."""
         if self.embedding_model == "text-embedding-ada-002-sweden":
+            from openai import AzureOpenAI
+
             azure_env = dict(dotenv_values("../azure.env"))
 
             a = AzureOpenAI(azure_endpoint=passwords.pw.embedding_url,
@@ -55,3 +93,102 @@ class Vectorstore:
             )
 
             return a
+
+    @property
+    def aclient(self) -> "AsyncQdrantClient":
+        """Asynchronous Qdrant client, created on first use."""
+        if self._aclient is None:
+            from qdrant_client import AsyncQdrantClient
+
+            qdrant_host = dotenv_values("../.env").get("QDRANT_HOST")
+            self._aclient = AsyncQdrantClient(
+                host=qdrant_host, api_key=pw.access_token_qdrant, port=443
+            )
+        return self._aclient
+
+    @property
+    def aoai(self) -> "AsyncAzureOpenAI | BalancedClient | None":
+        """Asynchronous OpenAI client for the embedding model, created on first use.
+
+        If deployments of this model are configured (`AZURE_EMBEDDING_DEPLOYMENTS`),
+        the shared client balancing over them is returned.
+        """
+        from .resources import resources
+
+        balanced = resources.balanced_client("embedding", self.embedding_model)
+        if balanced is not None:
+            return balanced
+        if self._aoai is None and self.embedding_model == "text-embedding-ada-002-sweden":
+            from openai import AsyncAzureOpenAI
+
+            self._aoai = AsyncAzureOpenAI(azure_endpoint=passwords.pw.embedding_url,
+                api_key=passwords.pw.embedding_key, api_version=passwords.pw.embedding_version,
+            )
+        return self._aoai
+
+    async def aembed(self, texts: list | tuple, timeout: float | None = None) -> list:
+        """Embed texts without blocking the event loop.
+
+        Embeddings are cached in the shared cache store (`EMBEDDING_CACHE_SIZE`
+        entries per model, 0 disables the cache), only uncached texts are sent
+        to the embedding model, through the shared Azure scheduler.
+
+        :param texts: Texts to embed.
+        :type texts: list | tuple
+        :param timeout: Timeout of the embedding request in seconds.
+        :type timeout: float | None
+        :return: One embedding per text.
+        :rtype: list[list[float]]
+        """
+        texts = list(texts)
+        limit = int(os.environ.get("EMBEDDING_CACHE_SIZE", 8192))
+        store = shared_store() if limit > 0 else None
+        if store is not None and getattr(store, "dimensions", self.dimensions) != self.dimensions:
+            store = None
+        namespace = f"embedding:{self.embedding_model}"
+        keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+
+        embeddings = [None] * len(texts)
+        if store is not None:
+            try:
+                cached = await to_thread(lambda: [store.get_vector(namespace, key) for key in keys])
+                embeddings = [None if vector is None else vector.tolist() for vector in cached]
+            except sqlite3.Error as e:
+                logging.warning(f"Embedding cache lookup failed: {e!r}")
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) < len(texts):
+            record(cache_hits=len(texts) - len(missing))
+        if store is not None:
+            CACHE_REQUESTS.inc(len(texts) - len(missing), cache="embedding", result="hit")
+            CACHE_REQUESTS.inc(len(missing), cache="embedding", result="miss")
+        if missing:
+            inputs = [texts[i] for i in missing]
+            async with shared_scheduler().slot("embedding", estimate_tokens(inputs)) as call:
+                with CALL_SECONDS.time(service="embedding"):
+                    response = await self.aoai.embeddings.create(
+                        model=self.embedding_model, input=inputs, timeout=timeout
+                    )
+                call.usage(response)
+            record_usage(response)
+            for i, data in zip(missing, response.data):
+                embeddings[i] = data.embedding
+            if store is not None:
+                try:
+                    await to_thread(lambda: [
+                        store.put(namespace, keys[i], vector=embeddings[i], limit=limit)
+                        for i in missing
+                    ])
+                except sqlite3.Error as e:
+                    logging.warning(f"Embedding cache update failed: {e!r}")
+        return embeddings
+
+    async def aclose(self):
+        """Close the clients which have been created."""
+        for client in (self._client, self._oai):
+            if client is not None:
+                client.close()
+        for client in (self._aclient, self._aoai):
+            if client is not None:
+                await client.close()
+        self._client = self._oai = self._aclient = self._aoai = None
@@ -1,9 +1,45 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+import httpx
 import pytest
+from fastapi import FastAPI, HTTPException, UploadFile
+from fastapi.responses import HTMLResponse
+from pypdf import PdfWriter
 import qdrant_client
 from qdrant_client import models
+from qdrant_client.http.exceptions import UnexpectedResponse
 
-from pipeline import Vectorstore
+from app.rag_api import RagApi
+from app.middleware import LoggingMiddleware, MetricsSink, MetricsWriter, ProfilingMiddleware
+from app.profiler import SamplingProfiler
+from pipeline import Collection, metrics, Vectorstore
+from pipeline.cache_store import MemoryCacheStore, SQLiteCacheStore
+from pipeline.checkpoint import IndexCheckpoint
+from pipeline.collection import collection_name, IndexTarget
+from pipeline.deployments import BalancedClient, Deployment, DeploymentPool
+from pipeline.indexing import Stage, StagedPipeline
+from pipeline.jobs import JobStore
+from pipeline.scheduler import (AzureScheduler, background, BACKGROUND, INTERACTIVE,
+                                shared_scheduler)
+from pipeline.snapshot import export_collection, import_collection
+from pipeline.tracing import NULL_TRACE, record, Trace
+from pipeline import upload
 from pipeline.rag.chunk import Chunking
+from pipeline.rag import cache, context
+from pipeline.rag.admission import Admission, ModeLimit
+from pipeline.rag.common import RagContext, run_cancellable, stream_pipeline
+from pipeline.rag.graph import EarlyExit, Module, StageGraph
+from pipeline.rag.memo import CompletionMemo
+from pipeline.rag.rerank import mmr
 
 
 @pytest.mark.parametrize(
@@ -68,5 +104,1076 @@ def test_chunking():
     assert isinstance(j, str), "Readable Chunks must be type string"
 
 
+def test_index_checkpoint(tmp_path):
+    checkpoint = IndexCheckpoint(str(tmp_path / "state.sqlite3"))
+    config = IndexCheckpoint.fingerprint({"chunk_size": 300})
+    assert checkpoint.get_sequence("test") == "0", "Fresh checkpoint must start at sequence 0"
+    assert not checkpoint.is_current("test", "doc", config, rev="1-a"), "Unknown documents are never current"
+
+    checkpoint.mark_indexed("test", "doc", "1-a", "abc", config, 12)
+    checkpoint.set_sequence("test", "42-xyz")
+    assert checkpoint.is_current("test", "doc", config, rev="1-a")
+    assert checkpoint.is_current("test", "doc", config, rev="2-b", checksum="abc"), "Same checksum is current"
+    assert not checkpoint.is_current("test", "doc", config, rev="2-b", checksum="def")
+    assert not checkpoint.is_current(
+        "test", "doc", IndexCheckpoint.fingerprint({"chunk_size": 500}), rev="1-a"
+    ), "A different configuration requires reindexing"
+    assert checkpoint.get_sequence("test") == "42-xyz"
+
+    checkpoint.reset("test")
+    assert checkpoint.get_document("test", "doc") is None
+
+
+def test_staged_pipeline():
+    in_flight = 0
+    max_in_flight = 0
+    results = []
+
+    async def split(item, emit):
+        for part in range(3):
+            await emit((item, part))
+
+    async def slow(item, emit):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.001)
+        in_flight -= 1
+        if item == (7, 1):
+            raise RuntimeError("Broken item")
+        await emit(item)
+
+    async def collect(item, emit):
+        results.append(item)
+
+    pipeline = StagedPipeline([
+        Stage("split", split), Stage("slow", slow, concurrency=3, queue_size=2), Stage("collect", collect)
+    ])
+    stats = asyncio.run(pipeline.run(range(20)))
+
+    assert len(results) == 59, "Every item except the broken one must arrive"
+    assert max_in_flight <= 3, "Concurrency of a stage must be bounded"
+    assert stats["slow"] == {"processed": 59, "failed": 1}
+
+
+def test_stage_graph():
+    started = {}
+
+    async def step(name, delay, result):
+        started[name] = asyncio.get_running_loop().time()
+        await asyncio.sleep(delay)
+        return result
+
+    async def slow(ctx):
+        await asyncio.sleep(1)
+
+    async def combine(ctx, a, b, c):
+        if ctx == "exit":
+            raise EarlyExit(a + b)
+        return (a, b, c)
+
+    graph = StageGraph([
+        Module("a", lambda ctx: step("a", 0.05, 1)),
+        Module("b", lambda ctx: step("b", 0.05, 2)),
+        Module("c", slow, timeout=0.01, optional=True),
+        Module("d", combine, requires=["a", "b", "c"]),
+    ])
+    results = asyncio.run(graph.run("ctx"))
+    assert results["d"] == (1, 2, None), "Failed optional modules must yield None"
+    assert abs(started["a"] - started["b"]) < 0.04, "Independent modules must run concurrently"
+    assert asyncio.run(graph.run("exit"))["early_exit"] == 3
+
+    with pytest.raises(ValueError):
+        StageGraph([Module("x", slow, requires=["y"]), Module("y", slow, requires=["x"])])
+
+
+def test_context_packing(monkeypatch):
+    class WordEncoding:
+        def encode(self, text):
+            return text.split(" ")
+
+        def decode(self, tokens):
+            return " ".join(tokens)
+
+    monkeypatch.setattr(context, "_encoding", lambda model: WordEncoding())
+
+    def point(id, score, text, document_id="a", chunk_index=None):
+        return SimpleNamespace(id=id, score=score, payload={
+            "text": text, "document_id": document_id, "chunk_index": chunk_index
+        })
+
+    points = [
+        point(1, 0.90, "one two ", chunk_index=0),
+        point(2, 0.88, "three four", chunk_index=1),
+        point(3, 0.87, "one two ", "b"),
+        point(4, 0.85, "other doc", "c"),
+        point(5, 0.50, "irrelevant", "d"),
+    ]
+    assert context.assemble(points, max_tokens=100) == ["one two three four", "other doc"]
+    assert context.assemble(points, max_tokens=5) == ["one two three four"]
+    monkeypatch.setattr(context, "MIN_PASSAGE_TOKENS", 1)
+    assert context.assemble(points, max_tokens=3) == ["one two three"]
+
+
+def test_mmr():
+    query = [1.0, 0.0, 0.0]
+    candidates = [
+        [1.0, 0.1, 0.0],
+        [1.0, 0.11, 0.0],  # Near-duplicate of the first candidate
+        [0.8, 0.0, 0.6],
+    ]
+    assert mmr(query, candidates, 2, lambda_mult=1.0) == [0, 1]
+    assert mmr(query, candidates, 2, lambda_mult=0.5) == [0, 2]
+    assert mmr(query, [], 2) == []
+
+
+def test_modular_merge():
+    from pipeline.rag.modular_rag import ModularRag
+
+    def point(id, score, vector):
+        return SimpleNamespace(id=id, score=score, vector=vector, payload={})
+
+    query = [1.0, 0.0, 0.0]
+    refined = (query, [point(1, 0.99, [1.0, 0.1, 0.0]), point(3, 0.8, [0.8, 0.0, 0.6])])
+    # The raw prompt finds a near-duplicate of the first hit with a higher score
+    speculative = ([0.0, 1.0, 0.0],
+                   [point(2, 0.999, [1.0, 0.11, 0.0]), point(1, 0.5, [1.0, 0.1, 0.0])])
+    ctx = RagContext("prompt", top_k=2, mmr_lambda=0.5)
+    documents = asyncio.run(ModularRag._merge_documents(None, ctx, speculative, refined))
+    assert [doc.id for doc in documents] == [1, 3], "The union must be reranked as a whole"
+    assert asyncio.run(ModularRag._merge_documents(None, ctx, None, refined)) == documents
+
+
+def test_speculative_retrieval(monkeypatch):
+    from pipeline.rag import advanced
+
+    monkeypatch.setattr(advanced, "assemble", lambda docs, model: [doc.payload for doc in docs])
+    monkeypatch.setattr(advanced.AdvancedRAG, "clien", None)
+    embeddings = {"prompt": [1.0, 0.0], "close": [1.0, 0.01], "far": [0.0, 1.0]}
+
+    def pipeline(rewritten, fail_speculation=False):
+        rag = advanced.AdvancedRAG.__new__(advanced.AdvancedRAG)
+        rag.searched = []
+        rag.speculation_cancelled = False
+
+        async def create(client, stage, **kwargs):
+            if isinstance(rewritten, Exception):
+                await asyncio.sleep(0.01)
+                raise rewritten
+            return rewritten
+
+        async def embed_text(text):
+            if text == "prompt" and isinstance(rewritten, Exception):
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    rag.speculation_cancelled = True
+                    raise
+            if text == "prompt" and fail_speculation:
+                raise httpx.ConnectError("unreachable")
+            return embeddings[text]
+
+        async def search(ctx, embedding):
+            rag.searched.append(embedding)
+            return [SimpleNamespace(id=len(rag.searched), payload=embedding)]
+
+        rag.memo = SimpleNamespace(create=create)
+        rag.embed_text, rag.search = embed_text, search
+        return rag
+
+    def run(rag):
+        ctx = RagContext("prompt")
+        asyncio.run(rag._speculative_retrieval(ctx))
+        return ctx
+
+    # Similar enough: the hits of the original prompt are reused
+    rag = pipeline("close")
+    assert run(rag).documents == [embeddings["prompt"]] and rag.searched == [embeddings["prompt"]]
+
+    # Too different: the rewritten prompt is searched again
+    rag = pipeline("far")
+    assert run(rag).documents == [embeddings["far"]]
+    assert rag.searched == [embeddings["prompt"], embeddings["far"]]
+
+    # The speculation failed: fall back to a normal search
+    rag = pipeline("close", fail_speculation=True)
+    assert run(rag).documents == [embeddings["close"]] and rag.searched == [embeddings["close"]]
+
+    # The rewrite failed: the speculation must not keep running
+    rag = pipeline(RuntimeError("rewrite failed"))
+
+    async def rewrite_fails():
+        with pytest.raises(RuntimeError):
+            await rag._speculative_retrieval(RagContext("prompt"))
+        await asyncio.sleep(0.01)
+        return rag.speculation_cancelled
+
+    assert asyncio.run(rewrite_fails()) and not rag.searched
+
+
+def test_concurrent_requests(tmp_path, monkeypatch):
+    from pipeline.rag import advanced, modular_rag
+
+    monkeypatch.setenv("INDEX_STATE_PATH", str(tmp_path / "state.sqlite3"))
+
+    def tag(text):
+        return "alpha" if "alpha" in str(text) else "beta"
+
+    async def llm(content, result):
+        # The first request answers slower, so the stages of both requests interleave
+        await asyncio.sleep(0.02 if tag(content) == "alpha" else 0.005)
+        return result
+
+    async def create(client, stage, **kwargs):
+        content = kwargs["messages"][0]["content"]
+        return await llm(content, f"{stage} {tag(content)}")
+
+    async def complete(client, ctx, **kwargs):
+        content = kwargs["messages"][0]["content"]
+        return await llm(content, f"answer {tag(content)}")
+
+    async def embed(text):
+        return await llm(text, [1.0, 0.0] if tag(text) == "alpha" else [0.0, 1.0])
+
+    def hits(embedding):
+        name = "alpha" if embedding[0] else "beta"
+        return [SimpleNamespace(id=name, score=1.0, vector=embedding, payload={"text": name})]
+
+    async def search(ctx, embedding):
+        return await llm(ctx.prompt, hits(embedding))
+
+    async def candidates(embedding, k, fetch_k=None):
+        return hits(embedding)
+
+    def texts(docs, model):
+        return [doc.payload["text"] for doc in docs]
+
+    monkeypatch.setattr(advanced, "complete", complete)
+    monkeypatch.setattr(advanced, "assemble", texts)
+    monkeypatch.setattr(advanced.AdvancedRAG, "clien", None)
+    rag = advanced.AdvancedRAG.__new__(advanced.AdvancedRAG)
+    rag.memo = SimpleNamespace(create=create)
+    rag.embed_text, rag.search = embed, search
+
+    monkeypatch.setattr(modular_rag, "complete", complete)
+    monkeypatch.setattr(modular_rag, "pack_context", lambda docs, model: " ".join(texts(docs, model)))
+    monkeypatch.setattr(modular_rag.ModularRag, "client", None)
+    modular = modular_rag.ModularRag()
+    modular.memo = SimpleNamespace(create=create)
+    modular.create_embedding, modular.retrieve_candidates = embed, candidates
+
+    async def run(pipeline):
+        contexts = [RagContext("Who is alpha?"), RagContext("Who is beta?")]
+        await asyncio.gather(*[pipeline(ctx) for ctx in contexts])
+        return contexts
+
+    for first, second in (asyncio.run(run(rag._run)), asyncio.run(run(modular._run))):
+        assert (first.answer, second.answer) == ("answer alpha", "answer beta")
+        assert "alpha" in first.rewritten_prompt and "beta" in second.rewritten_prompt
+        assert [tag(doc) for doc in first.documents] == ["alpha"]
+        assert [tag(doc) for doc in second.documents] == ["beta"]
+
+
+def test_stream_pipeline():
+    async def pipeline(ctx, fail=False, hang=False):
+        await ctx.emit("rewrite", {"prompt": "rewritten"})
+        await ctx.emit("retrieval", {"documents": 1})
+        if hang:
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                state["cancelled"] = True
+                raise
+        if fail:
+            raise ValueError("boom")
+        for token in ("Hello", " world"):
+            await ctx.emit("token", token)
+
+    def events(chunks):
+        return [chunk.split("\n")[0].removeprefix("event: ") for chunk in chunks]
+
+    async def consume(**kwargs):
+        ctx = RagContext("prompt")
+        slot = SimpleNamespace(release=lambda: state.update(released=state["released"] + 1))
+        response = stream_pipeline(ctx, pipeline(ctx, **kwargs), lambda: {"answer": "Hello world"},
+                                   slot=slot)
+        return [chunk async for chunk in response.body_iterator]
+
+    async def disconnect():
+        ctx = RagContext("prompt")
+        slot = SimpleNamespace(release=lambda: state.update(released=state["released"] + 1))
+        response = stream_pipeline(ctx, pipeline(ctx, hang=True), dict, slot=slot)
+        first = await response.body_iterator.__anext__()
+        await response.body_iterator.__anext__()
+        # The client goes away in the middle of the stream
+        await response.body_iterator.aclose()
+        await asyncio.sleep(0.01)
+        return first, dict(state)
+
+    state = {"released": 0, "cancelled": False}
+    chunks = asyncio.run(consume())
+    assert events(chunks) == ["rewrite", "retrieval", "token", "token", "done"]
+    assert json.loads(chunks[-1].split("data: ")[1]) == {"answer": "Hello world"}
+    assert state["released"] == 1
+
+    chunks = asyncio.run(consume(fail=True))
+    assert events(chunks) == ["rewrite", "retrieval", "error"]
+    assert state["released"] == 2
+
+    first, after = asyncio.run(disconnect())
+    assert events([first]) == ["rewrite"]
+    assert after == {"released": 3, "cancelled": True}
+
+
+def test_run_cancellable():
+    import openai
+
+    async def pipeline(error=None):
+        try:
+            if error is not None:
+                raise error
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def run(disconnected=False, timeout=5.0, error=None):
+        state["cancelled"] = False
+        request = SimpleNamespace(is_disconnected=lambda: asyncio.sleep(0, disconnected))
+        with pytest.raises(HTTPException) as e:
+            await run_cancellable(request, pipeline(error), timeout)
+        await asyncio.sleep(0.01)
+        # Neither the pipeline nor the disconnect watcher outlives the request
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+        return e.value.status_code, state["cancelled"]
+
+    state = {}
+    request = httpx.Request("POST", "https://example.com")
+    assert asyncio.run(run(disconnected=True)) == (499, True)
+    assert asyncio.run(run(timeout=0.05)) == (504, True)
+    assert asyncio.run(run(error=asyncio.TimeoutError())) == (504, False)
+    assert asyncio.run(run(error=openai.APITimeoutError(request=request))) == (504, False)
+    assert asyncio.run(run(error=httpx.ReadTimeout("timeout", request=request))) == (504, False)
+
+
+def test_response_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "GENERATION_CHECK_INTERVAL", 0)
+    checkpoint = IndexCheckpoint(str(tmp_path / "state.sqlite3"))
+    responses = cache.ResponseCache("naive", max_entries=2, ttl=60, similarity=0.95,
+                                    checkpoint=checkpoint, store=MemoryCacheStore())
+
+    responses.put(RagContext("Wer ist Siglinde?"), "Eine Person.", embedding=[1.0, 0.0])
+    assert responses.get(RagContext("wer ist  siglinde")) == "Eine Person."
+    assert responses.get(RagContext("Wer ist Siglinde?", top_k=3)) is None
+    assert responses.get(RagContext("Who is Siglinde?"), embedding=[0.99, 0.05]) == "Eine Person."
+    assert responses.get(RagContext("Something else"), embedding=[0.0, 1.0]) is None
+
+    responses.put(RagContext("a"), "A")
+    responses.put(RagContext("b"), "B")
+    assert responses.get(RagContext("Wer ist Siglinde?")) is None, "LRU entry must be evicted"
+
+    checkpoint.mark_indexed("text-embedding-3-small", "doc", "1-a", "sum", "config")
+    assert responses.get(RagContext("b")) is None, "Index changes must invalidate the cache"
+
+
+def test_sqlite_cache_store(tmp_path):
+    # Two instances on the same directory behave like two workers
+    first = SQLiteCacheStore(str(tmp_path), dimensions=2, capacity=2)
+    second = SQLiteCacheStore(str(tmp_path), dimensions=8, capacity=100)
+    assert (second.dimensions, second.capacity) == (2, 2), "The arena layout is fixed on creation"
+
+    first.put("response", "a", "A", vector=[1.0, 0.0], partition="de")
+    first.put("response", "b", "B", vector=[0.0, 2.0], partition="de")
+    assert second.get("response", "a") == "A"
+    assert second.nearest("response", [0.1, 1.0], "de")[:2] == ("b", "B")
+    assert second.nearest("response", [0.1, 1.0], "en") is None
+    assert second.nearest("response", [1.0, -1.0], "de", threshold=0.9) is None
+
+    second.get("response", "a")
+    second.put("embedding", "c", vector=[1.0, 1.0])
+    assert first.get("response", "b") is None, "The least recently used vector must be evicted"
+    assert first.get_vector("embedding", "c") == pytest.approx([0.7071, 0.7071], abs=1e-4)
+
+    first.put("llm", "x", "X", limit=1)
+    first.put("llm", "y", "Y", limit=1)
+    assert second.count("llm") == 1
+    second.clear("response")
+    assert first.count("response") == 0
+
+    # A slot which is being rewritten by another worker must not be matched
+    first.put("response", "d", "D", vector=[0.0, 1.0])
+    slot = second._connect().execute("SELECT slot FROM entries WHERE key = 'd'").fetchone()[0]
+    first.vectors[slot] = [1.0, 0.0]
+    assert second.nearest("response", [1.0, 0.0]) is None
+    assert second.get_vector("response", "d") is None
+    first.put("response", "d", "D", vector=[0.0, 1.0])
+    assert second.nearest("response", [0.0, 1.0])[:2] == ("d", "D")
+    assert first._connect().execute("SELECT COUNT(*) FROM free_slots").fetchone()[0] == 0
+    first.clear("embedding")
+    assert first._connect().execute("SELECT COUNT(*) FROM free_slots").fetchone()[0] == 1, \
+        "Slots of removed entries must be reused"
+
+
+def test_completion_memo(tmp_path, monkeypatch):
+    # The scheduler of the process publishes its signals into the job store
+    monkeypatch.setenv("INDEX_STATE_PATH", str(tmp_path / "jobs.sqlite3"))
+    shared_scheduler.cache_clear()
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+            content=f"answer {len(calls)}"
+        ))])
+
+    client = SimpleNamespace(base_url="https://example/gpt-4o", chat=SimpleNamespace(
+        completions=SimpleNamespace(create=create)
+    ))
+    memo = CompletionMemo(SQLiteCacheStore(str(tmp_path), dimensions=2), max_entries=2,
+                          stages="refine")
+
+    async def run():
+        messages = [{"role": "user", "content": "a"}]
+        assert await memo.create(client, "refine", model="gpt-4o", messages=messages,
+                                 temperature=0.1, timeout=10) == "answer 1"
+        assert await memo.create(client, "refine", model="gpt-4o", messages=messages,
+                                 temperature=0.1, timeout=30) == "answer 1"
+        assert await memo.create(client, "refine", model="gpt-4o", messages=messages,
+                                 temperature=0.3) == "answer 2"
+        for answer in ("answer 3", "answer 4"):
+            assert await memo.create(client, "refine", model="gpt-4o", messages=messages,
+                                     temperature=0.9) == answer, "Sampled completions must not be memoized"
+        assert await memo.create(client, "answer", model="gpt-4o", messages=messages,
+                                 temperature=0.1) == "answer 5", "Disabled stages must not be memoized"
+        await memo.create(client, "refine", model="gpt-4o", messages=[], temperature=0.1)
+
+    asyncio.run(run())
+    shared_scheduler.cache_clear()
+    stats = memo.stats()
+    assert stats["entries"] == 2
+    assert stats["stages"]["refine"] == {"hits": 1, "misses": 3, "hit_rate": 0.25, "enabled": True}
+
+
+def test_tracing():
+    async def search(ctx):
+        await asyncio.sleep(0.02)
+        record(chunks=3)
+
+    async def answer(ctx, _):
+        record(tokens_in=100, tokens_out=20)
+        record(tokens_out=5, cache_hits=1)
+
+    graph = StageGraph([
+        Module("search", search),
+        Module("speculative", search),
+        Module("answer", answer, requires=["search"]),
+    ])
+    ctx = RagContext(prompt="a", trace=Trace())
+    asyncio.run(graph.run(ctx))
+    summary = ctx.trace.summary()
+    stages = {stage["name"]: stage for stage in summary["stages"]}
+    assert [stage["name"] for stage in summary["stages"]] == ["search", "speculative", "answer"]
+    assert stages["search"]["chunks"] == 3 and stages["search"]["wall_ms"] >= 20
+    assert stages["answer"]["tokens_in"] == 100 and stages["answer"]["tokens_out"] == 25
+    assert summary["chunks"] == 6 and summary["cache_hits"] == 1
+
+    record(chunks=1)  # Outside of a span
+    assert RagContext(prompt="a").trace is NULL_TRACE
+    with NULL_TRACE.span("search") as span:
+        span.add(chunks=1)
+    assert NULL_TRACE.summary() is None
+
+
+def test_metrics_writer():
+    class FakeSink(MetricsSink):
+        def __init__(self):
+            self.batches = []
+
+        def write(self, records):
+            if records[0]["path"] == "/fail":
+                raise ConnectionError("Influx is down")
+            self.batches.append(records)
+
+    app = FastAPI()
+    sink = FakeSink()
+    writer = MetricsWriter(sink, batch_size=2, flush_interval=0.05, max_buffer=3, max_body=4)
+    app.middleware("http")(LoggingMiddleware(app, writer))
+
+    @app.post("/echo")
+    async def echo(body: dict):
+        return body
+
+    @app.get("/page")
+    async def page():
+        return HTMLResponse("<p>Not recorded</p>")
+
+    async def run():
+        writer.start()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                     base_url="http://test") as client:
+            for _ in range(3):
+                await client.post("/echo", json={"text": "a long body"})
+            await client.get("/page")
+            await asyncio.sleep(0.2)
+            assert sum(map(len, sink.batches)) == 3, "Records are flushed in the background"
+
+            for path in ("/fail", "/a", "/b", "/c", "/d"):
+                writer.add({"path": path})
+            assert writer.stats()["dropped"] == 2, "A full buffer drops new records"
+        await writer.aclose()
+
+    asyncio.run(run())
+    record = sink.batches[0][0]
+    assert record["method"] == "POST" and record["status_code"] == 200
+    assert record["request_body"] == '{"te…' and record["duration_ms"] > 0
+    assert record["response_size"] == len('{"text":"a long body"}')
+    assert writer.stats() == {"written": 4, "dropped": 2, "failed": 2, "sampled_out": 0,
+                              "buffered": 0}
+
+
+def test_prometheus_metrics(tmp_path):
+    registry = metrics.Registry()
+    latency = metrics.Histogram("latency_seconds", "Latency.", ["route"], buckets=(0.1, 1),
+                                registry=registry)
+    hits = metrics.Counter("hits_total", "Hits.", ["cache"], registry=registry)
+    for value in (0.05, 0.5, 5):
+        latency.observe(value, route="/a")
+    hits.inc(cache="llm")
+
+    # Snapshot of another living worker and a stale one of an exited worker
+    other = {"latency_seconds": {**latency.snapshot(), "values": [[["/a"], [1, 0, 0, 0.01]]]},
+             "hits_total": {**hits.snapshot(), "values": [[["llm"], 2]]}}
+    (tmp_path / f"{os.getppid()}.json").write_text(json.dumps(other))
+    (tmp_path / "9999999.json").write_text(json.dumps(other))
+
+    text = metrics.render(metrics.merge(metrics.collect(registry, str(tmp_path))))
+    assert not (tmp_path / "9999999.json").exists()
+    assert "# TYPE latency_seconds histogram" in text
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 3' in text
+    assert 'latency_seconds_bucket{route="/a",le="1"} 4' in text
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 5' in text
+    assert 'latency_seconds_count{route="/a"} 5' in text
+    assert 'hits_total{cache="llm"} 5' in text, "Counters of exited workers must be kept"
+
+    # Another worker exits, its values are added to the aggregate
+    (tmp_path / "9999998.json").write_text(json.dumps(other))
+    text = metrics.render(metrics.merge(metrics.collect(registry, str(tmp_path))))
+    assert not (tmp_path / "9999998.json").exists()
+    assert 'hits_total{cache="llm"} 7' in text
+    assert 'latency_seconds_count{route="/a"} 6' in text
+
+    metrics.write_snapshot(registry, str(tmp_path))
+    assert json.loads((tmp_path / f"{os.getpid()}.json").read_text())["hits_total"]["values"]
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_sampling_profiler():
+    with SamplingProfiler(interval=0.001) as profiler:
+        worker = threading.Thread(target=busy_loop, args=(0.2,), name="busy")
+        worker.start()
+        worker.join()
+    lines = profiler.collapsed().splitlines()
+    busy = [line for line in lines if line.startswith("busy;")]
+    assert busy and "busy_loop (main.py:" in busy[0]
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert not any("sampling-profiler" in line for line in lines)
+
+    # Only requests with the token are profiled
+    store = MemoryCacheStore()
+    app = FastAPI()
+    app.middleware("http")(ProfilingMiddleware("secret", store=store))
+    app.add_api_route("/work", lambda: busy_loop(0.05) or {}, methods=["GET"])
+
+    async def requests():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                     base_url="http://test") as client:
+            return (await client.get("/work"),
+                    await client.get("/work", headers={"X-Profile": "wrong"}),
+                    await client.get("/work?profile=secret"))
+
+    plain, wrong, profiled = asyncio.run(requests())
+    assert "X-Profile-Id" not in plain.headers and "X-Profile-Id" not in wrong.headers
+    assert "busy_loop" in store.get("profile", profiled.headers["X-Profile-Id"])
+
+
+def test_admission():
+    admission = Admission({"naive": ModeLimit(2, 1, priority=0, timeout=1),
+                           "advanced": ModeLimit(2, 1, priority=1, timeout=0.05)},
+                          max_concurrency=2)
+
+    async def run():
+        first = await admission.acquire("advanced")
+        second = await admission.acquire("advanced")
+        # Both global slots are taken: one waiter per mode, further requests are rejected
+        advanced = asyncio.ensure_future(admission.acquire("advanced"))
+        naive = asyncio.ensure_future(admission.acquire("naive"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as rejected:
+            await admission.acquire("naive")
+        assert rejected.value.status_code == 429
+        assert int(rejected.value.headers["Retry-After"]) >= 1
+
+        # The cheap mode is admitted first, the expensive one times out
+        first.release()
+        slot = await naive
+        assert slot.mode == "naive" and not advanced.done()
+        with pytest.raises(HTTPException) as timeout:
+            await advanced
+        assert timeout.value.status_code == 429
+        assert admission.stats()["advanced"]["waiting"] == 0
+
+        second.release()
+        async with admission.slot("naive"):
+            assert admission.active["naive"] == 2
+        slot.release()
+        slot.release()
+        assert admission.active == {"naive": 0, "advanced": 0}
+
+    asyncio.run(run())
+
+
+def test_azure_scheduler():
+    scheduler = AzureScheduler({"embedding": (6000, 0)}, background_concurrency=2,
+                               busy_concurrency=1, reserve=0, window=0.05)
+
+    async def call(order, name, tokens, priority=None):
+        async with scheduler.slot("embedding", tokens, priority):
+            order.append(name)
+
+    async def run():
+        # The budget is used up: the interactive call overtakes the earlier background call
+        order = []
+        await call(order, "drain", 6000)
+        with background():
+            waiting = asyncio.ensure_future(call(order, "background", 5))
+        await asyncio.sleep(0)
+        await call(order, "interactive", 5)
+        await waiting
+        assert order == ["drain", "interactive", "background"]
+
+        # Background calls are throttled while interactive calls are running
+        order = []
+        release = asyncio.Event()
+
+        async def interactive():
+            async with scheduler.slot("llm", priority=INTERACTIVE):
+                await release.wait()
+
+        async def indexing(name):
+            async with scheduler.slot("llm", priority=BACKGROUND):
+                order.append(name)
+                await release.wait()
+
+        running = asyncio.ensure_future(interactive())
+        await asyncio.sleep(0)
+        jobs = asyncio.ensure_future(asyncio.gather(indexing("a"), indexing("b")))
+        await asyncio.sleep(0.03)
+        assert order == ["a"]
+        release.set()
+        await asyncio.gather(running, jobs)
+        assert order == ["a", "b"]
+
+        # A 429 pauses the background calls of the service
+        class RateLimitError(Exception):
+            status_code = 429
+            response = SimpleNamespace(headers={"retry-after": "0.1"})
+
+        with pytest.raises(RateLimitError):
+            async with scheduler.slot("llm", priority=INTERACTIVE):
+                raise RateLimitError()
+        start = time.perf_counter()
+        async with scheduler.slot("llm", priority=BACKGROUND):
+            pass
+        assert time.perf_counter() - start >= 0.05
+        assert scheduler.stats()["running"] == {"interactive": 0, "background": 0}
+
+    asyncio.run(run())
+
+
+def test_azure_scheduler_shared_signals(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    # Two workers of the same host
+    query, indexer = (AzureScheduler({"llm": (0, 0)}, background_concurrency=2, busy_concurrency=1,
+                                     reserve=0, window=0.05, signal_interval=0.01,
+                                     signals=JobStore(path)) for _ in range(2))
+
+    async def run():
+        order = []
+        release = asyncio.Event()
+
+        async def indexing(name):
+            async with indexer.slot("llm", priority=BACKGROUND):
+                order.append(name)
+                await release.wait()
+
+        # An interactive call of the other worker throttles the background calls
+        async with query.slot("llm", priority=INTERACTIVE):
+            await asyncio.sleep(0.05)
+            await indexer.refresh()
+            jobs = asyncio.ensure_future(asyncio.gather(indexing("a"), indexing("b")))
+            await asyncio.sleep(0.05)
+            assert order == ["a"]
+        await asyncio.sleep(0.2)
+        assert order == ["a", "b"], "The other worker must see the end of the interactive load"
+        release.set()
+        await jobs
+
+        # A 429 of the other worker pauses the background calls as well
+        class RateLimitError(Exception):
+            status_code = 429
+            response = SimpleNamespace(headers={"retry-after": "0.2"})
+
+        with pytest.raises(RateLimitError):
+            async with query.slot("llm", priority=INTERACTIVE):
+                raise RateLimitError()
+        await asyncio.sleep(0.05)
+        await indexer.refresh()
+        start = time.perf_counter()
+        async with indexer.slot("llm", priority=BACKGROUND):
+            pass
+        assert time.perf_counter() - start >= 0.1
+
+    asyncio.run(run())
+
+
+def fake_deployment(name, latency, status=200):
+    """Deployment whose endpoint answers every completion after `latency` seconds."""
+    from openai import AsyncAzureOpenAI
+
+    state = {"latency": latency, "status": status, "calls": 0}
+
+    async def handler(request):
+        state["calls"] += 1
+        await asyncio.sleep(state["latency"])
+        if state["status"] != 200:
+            return httpx.Response(state["status"], json={"error": {"message": "unavailable"}})
+        return httpx.Response(200, json={
+            "id": "1", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": name}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        })
+
+    client = AsyncAzureOpenAI(azure_endpoint=f"https://{name}.test", api_key="x",
+                              api_version="2024-02-01", max_retries=0,
+                              http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return Deployment(name, client=client, model="gpt-4o"), state
+
+
+def test_deployment_pool(monkeypatch):
+    async def ask(client):
+        response = await client.chat.completions.create(
+            model="gpt-4o-sweden", messages=[{"role": "user", "content": "Hi"}])
+        return response.choices[0].message.content
+
+    async def run():
+        # Routing prefers the faster deployment once latencies are known
+        fast, fast_state = fake_deployment("fast", 0.005)
+        slow, slow_state = fake_deployment("slow", 0.1)
+        client = BalancedClient(DeploymentPool("llm", [fast, slow]))
+        for deployment in (fast, slow):
+            await ask(deployment.client)
+        answers = [await ask(client) for _ in range(10)]
+        assert answers.count("fast") >= 8
+
+        # Failing deployments are retried elsewhere and skipped once the breaker opens
+        fast_state["status"] = 503
+        fast.breaker.threshold = 2
+        assert [await ask(client) for _ in range(4)] == ["slow"] * 4
+        assert fast.breaker.state == "open" and fast_state["calls"] <= 11 + 2
+
+        # A hedged request is answered by the second deployment if the first one stalls
+        stalled, _ = fake_deployment("stalled", 1.0)
+        quick, _ = fake_deployment("quick", 0.005)
+        stalled.latency = 0.001
+        hedged = BalancedClient(DeploymentPool("llm", [stalled, quick], hedge=True,
+                                               hedge_delay=0.05))
+        start = time.perf_counter()
+        assert await ask(hedged) == "quick"
+        assert time.perf_counter() - start < 0.5
+        await asyncio.sleep(0.01)
+        assert stalled.in_flight == 0 and stalled.latency == 0.001
+        await client.close()
+        await hedged.close()
+
+    asyncio.run(run())
+
+    # Embedding deployments are only pooled with deployments of the same model
+    monkeypatch.setenv("AZURE_EMBEDDING_DEPLOYMENTS", json.dumps([
+        {"name": "sweden", "model": "text-embedding-ada-002-sweden"},
+        {"name": "east", "model": "ada-east", "embedding_model": "text-embedding-ada-002-sweden"},
+        {"name": "large", "model": "text-embedding-3-large"},
+    ]))
+    pool = DeploymentPool.from_env("embedding", "text-embedding-ada-002-sweden")
+    assert [deployment.name for deployment in pool.deployments] == ["sweden", "east"]
+    assert [deployment.name for deployment in
+            DeploymentPool.from_env("embedding", "text-embedding-3-large").deployments] == ["large"]
+    assert DeploymentPool.from_env("embedding", "text-embedding-3-small") is None
+
+
+def test_job_store(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    worker_1 = JobStore(path)
+    worker_2 = JobStore(path)
+    assert worker_1.acquire_lease(), "First worker must get the lease"
+    assert not worker_2.acquire_lease(), "Only one worker may index at a time"
+    assert not worker_1.acquire_lease(), "A worker must not start a second job"
+    assert worker_2.lease_active(), "Other workers must see the running job"
+
+    job_id = worker_1.create_job("full", [])
+    worker_1.add_documents(job_id, ["a", "b", "c"], {"last_seq": "1"})
+    worker_1.start_job(job_id)
+    worker_1.document_done(job_id, "a", chunks=10, tokens=3000)
+    job = worker_2.get_job(job_id)
+    assert job["done"] == 1 and job["total"] == 3 and job["status"] == "running"
+    assert job["chunks_per_second"] is not None and job["eta_seconds"] is not None
+
+    # Simulate a crash: the lease is gone, the job is still marked as running.
+    worker_1.release_lease()
+    assert not worker_2.lease_active()
+    assert [job["id"] for job in worker_2.unfinished_jobs()] == [job_id]
+    assert worker_2.acquire_lease(job_id)
+    assert sorted(worker_2.pending_documents(job_id)) == ["b", "c"], "Resume must skip finished documents"
+    worker_2.finish_job(job_id)
+    assert worker_2.latest_job()["status"] == "completed"
+
+
+def test_snapshot_roundtrip(tmp_path):
+    client = qdrant_client.QdrantClient(":memory:")
+    client.create_collection(
+        collection_name="source",
+        vectors_config=models.VectorParams(size=4, distance=models.Distance.COSINE),
+    )
+    client.upsert("source", [
+        models.PointStruct(id=i, vector=[1.0, i, 0.5, 0.25], payload={"text": f"chunk {i}", "chunk_index": i})
+        for i in range(1, 21)
+    ])
+
+    manifest = export_collection(client, "source", str(tmp_path), batch_size=6)
+    assert manifest["count"] == 20 and manifest["dimensions"] == 4
+
+    import_collection(client, str(tmp_path), "target", batch_size=8, parallel=1)
+    assert client.count("target", exact=True).count == 20, "Every point must be imported"
+    point = client.retrieve("target", [7])[0]
+    assert point.payload == {"text": "chunk 7", "chunk_index": 7}, "Payloads must survive the roundtrip"
+
+
+def test_collection_bulk_upload(monkeypatch):
+    client = qdrant_client.QdrantClient(":memory:")
+    collection = Collection(SimpleNamespace(client=client, dimensions=4), "bulk")
+    upsert = client.upsert
+    calls = {"failed": 0, "waited": 0}
+    lock = threading.Lock()  # The local in-memory client is not thread-safe, a server is.
+
+    def flaky_upsert(collection_name, points, wait=True, **kwargs):
+        with lock:
+            if calls["failed"] < 2:
+                calls["failed"] += 1
+                raise UnexpectedResponse(429, "Too Many Requests", b"", httpx.Headers({"Retry-After": "0"}))
+            calls["waited"] += wait
+            return upsert(collection_name, points=points, wait=wait, **kwargs)
+
+    monkeypatch.setattr(client, "upsert", flaky_upsert)
+    points = (models.PointStruct(id=i, vector=[1.0, i, 0.0, 1.0], payload={}) for i in range(1, 101))
+    assert collection.upload(points, batch_size=16, parallel=3) == 100
+    assert client.count("bulk", exact=True).count == 100, "Rate limited batches must be retried"
+    assert calls["waited"] == 1, "Only the final flush may wait for Qdrant"
+
+    calls.update(failed=0, waited=0)
+    added = [collection.add([models.PointStruct(id=i, vector=[1.0, i, 0.0, 1.0], payload={})
+                             for i in range(start, start + 10)], batch_size=16)
+             for start in (101, 111, 121)]
+    assert not added[2].done(), "Points of a partial batch must stay buffered"
+    collection.flush()
+    assert [future.result() for future in added] == [10, 10, 10]
+    assert client.count("bulk", exact=True).count == 130, "Flush must wait for retried batches"
+    assert calls["waited"] == 1
+    collection.close()
+
+
+def test_index_targets(tmp_path, monkeypatch):
+    assert collection_name("text-embedding-3-large-sweden") == "text-embedding-3-large"
+    assert collection_name("text-embedding-ada-002-sweden") == "text-embedding-3-small", \
+        "The ada-002 vectors must stay in their existing collection"
+    qdrant = qdrant_client.QdrantClient(":memory:")
+
+    def vectorstore(model):
+        vs = Vectorstore(model)
+        vs._client = qdrant
+        return vs
+
+    monkeypatch.setattr("pipeline.resources.resources.vectorstore", vectorstore)
+    monkeypatch.setattr("pipeline.resources.resources._balanced_clients", {})
+    monkeypatch.setenv("INDEX_TARGETS", "text-embedding-ada-002-sweden, text-embedding-3-large=large")
+    targets = IndexTarget.from_env()
+    assert all(target.vs._aoai is None for target in targets), "Targets are checked before indexing"
+    with pytest.raises(ValueError, match="No embedding client for text-embedding-3-large"):
+        targets[1].validate()
+    monkeypatch.setenv("AZURE_EMBEDDING_DEPLOYMENTS", json.dumps([
+        {"name": "large", "model": "text-embedding-3-large", "endpoint": "https://large.invalid"}]))
+    monkeypatch.setattr("pipeline.resources.resources._balanced_clients", {})
+    targets = IndexTarget.from_env()
+    assert [target.collection for target in targets] == ["text-embedding-3-small", "large"]
+    qdrant.create_collection("large", models.VectorParams(size=1536, distance=models.Distance.COSINE))
+    with pytest.raises(ValueError, match="size 1536"):
+        targets[1].validate()
+
+    calls = []
+
+    def fake_target(model, dimensions, fail=False):
+        async def create(model, input, **kwargs):
+            calls.append(model)
+            if fail:
+                raise httpx.ConnectError("unreachable")
+            return SimpleNamespace(usage=None, data=[SimpleNamespace(embedding=[1.0] * dimensions)
+                                                     for _ in input])
+
+        # The local in-memory client is not thread-safe, so every target gets its own
+        vs = SimpleNamespace(embedding_model=model, dimensions=dimensions,
+                             client=qdrant_client.QdrantClient(":memory:"),
+                             aoai=SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+        return IndexTarget(vs)
+
+    class FakeDB:
+        reads = 0
+
+        def get_document(self, file):
+            FakeDB.reads += 1
+            return {"_rev": "1-a", "checksum": "abc", "content": "Lorem ipsum dolor sit amet. " * 200}
+
+    monkeypatch.setenv("INDEX_STATE_PATH", str(tmp_path / "state.sqlite3"))
+    monkeypatch.setenv("EMBED_BATCH_SIZE", "4")
+    monkeypatch.setenv("UPSERT_PARALLEL", "1")
+    monkeypatch.setenv("UPSERT_BATCH_SIZE", "6")
+    monkeypatch.setattr(RagApi, "_tokenise_and_chunk", staticmethod(
+        lambda text, max_tokens: (text.split(". "), len(text) // 4)))
+    # A target which cannot be indexed into fails the job instead of the worker start
+    api = RagApi([targets[1]])
+    job_id = api.jobs.create_job("full", [])
+    asyncio.run(api._background_task(job_id))
+    assert "size 1536" in api.jobs.get_job(job_id)["error"]
+
+    small, large = fake_target("small", 4), fake_target("large", 8)
+    api = RagApi([small, large])
+    asyncio.run(api._run_pipeline(FakeDB(), ["doc"]))
+    assert FakeDB.reads == 1, "Every document must be read once for all targets"
+    assert calls.count("small") == calls.count("large") > 1, "Every batch must be embedded for every target"
+    assert (small.vs.client.count("small", exact=True).count
+            == large.vs.client.count("large", exact=True).count > 0)
+    assert api.checkpoint.get_document("small", "doc") and api.checkpoint.get_document("large", "doc")
+
+    # A target which fails is not checkpointed, so it is the only one redone
+    broken = fake_target("broken", 4, fail=True)
+    api = RagApi([small, broken])
+    asyncio.run(api._run_pipeline(FakeDB(), ["doc"], incremental=True))
+    assert api.checkpoint.get_document("broken", "doc") is None
+
+    # A job with failed documents must not move the change feed past them
+    monkeypatch.setattr(RagApi, "_document_db", staticmethod(FakeDB))
+    job_id = api.jobs.create_job("incremental", [])
+    feed = {"results": [{"id": "doc", "seq": "7", "rev": "2-b", "deleted": False}], "last_seq": "7"}
+    asyncio.run(api._background_task(job_id, feed))
+    assert api.jobs.get_job(job_id)["status"] == "failed"
+    assert api.checkpoint.get_sequence("small") != "7" and api.checkpoint.get_sequence("broken") != "7"
+    calls.clear()
+    api.targets[1] = fake_target("broken", 4)
+    asyncio.run(api._run_pipeline(FakeDB(), ["doc"], incremental=True))
+    assert calls and set(calls) == {"broken"}, "Current targets must be skipped"
+
+    # A stage which raises fails the document, so the change feed is not advanced past it
+    def failing_add(points, **kwargs):
+        raise RuntimeError("Qdrant is gone")
+
+    small.index.add = failing_add
+    api = RagApi([small])
+    job_id = api.jobs.create_job("incremental", [])
+    feed = {"results": [{"id": "other", "seq": "8", "rev": "1-a", "deleted": False}],
+            "last_seq": "8"}
+    asyncio.run(api._background_task(job_id, feed))
+    job = api.jobs.get_job(job_id)
+    assert job["status"] == "failed" and job["failed"] == 1
+    assert api.checkpoint.get_sequence("small") != "8"
+    assert api.checkpoint.get_document("small", "other") is None
+    del small.index.add
+
+    # Interrupted imports are imported again, or fail if their snapshot is gone
+    export_collection(small.vs.client, "small", str(tmp_path / "snapshot"))
+    small.vs.client.delete_collection("small")
+    resumed = api.jobs.create_job("import", [], {"snapshot": str(tmp_path / "snapshot")})
+    missing = api.jobs.create_job("import", [], {"snapshot": str(tmp_path / "missing")})
+    asyncio.run(api._resume_interrupted_jobs())
+    assert api.jobs.get_job(resumed)["status"] == "completed"
+    assert small.vs.client.count("small", exact=True).count > 0
+    assert api.jobs.get_job(missing)["status"] == "failed"
+    assert not api.jobs.lease_active()
+
+
+def test_lazy_imports(tmp_path):
+    import startup_benchmark
+
+    # A worker reads its CouchDB settings from ../.env
+    (tmp_path / ".env").write_text("COUCHDB_HOST=localhost\nCOUCHDB_PORT=5984\n"
+                                   "COUCH_DB_USER=user\nCOUCH_DB_SECRET=secret\n")
+    (tmp_path / "worker").mkdir()
+    assert startup_benchmark.eager_imports(str(tmp_path / "worker")) == [], \
+        "Heavy libraries must be imported on first use, not when a worker starts"
+
+
+def test_upload_spooling(tmp_path, monkeypatch):
+    writer = PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=72, height=72)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    data = pdf.getvalue()
+
+    async def run():
+        spooled = await upload.spool(UploadFile(io.BytesIO(data), filename="a report, v2.pdf"),
+                                     str(tmp_path))
+        assert spooled.size == len(data) and spooled.title == "a-report--v2.pdf"
+        assert spooled.checksum == hashlib.sha3_256(data).hexdigest(), "Checksum of the streamed bytes"
+        with open(spooled.path, "rb") as file:
+            assert file.read() == data
+        try:
+            return spooled, await upload.prepare(spooled)
+        finally:
+            spooled.close()
+
+    try:
+        spooled, document = asyncio.run(run())
+    finally:
+        asyncio.run(upload.resources.aclose())
+    assert not os.path.exists(spooled.path), "The temporary file must be removed"
+    assert document["checksum"] == spooled.checksum and document["title"] == spooled.title
+    assert zlib.decompress(base64.b64decode(document["content"])).decode("utf-8") == ""
+
+    jobs = JobStore(str(tmp_path / "state.sqlite3"))
+    index_job = jobs.create_job("full", [])
+    interrupted = jobs.create_job("upload", [spooled.document_id])
+    assert [job["id"] for job in jobs.unfinished_jobs(("full", "incremental"))] == [index_job], \
+        "Upload jobs must not be resumed as indexing jobs"
+    assert jobs.latest_job(("full", "incremental"))["id"] == index_job
+    assert jobs.latest_job()["kind"] == "upload"
+
+    # Restart: uploads of exited workers fail and their temporary files are removed
+    from app.database import DocumentDBRouter
+
+    stale = tmp_path / "upload-9999999-abc.pdf"
+    stale.write_bytes(data)
+    own = tmp_path / f"upload-{os.getpid()}-abc.pdf"
+    own.write_bytes(data)
+    running = jobs.create_job("upload", ["b"], {"pid": os.getpid()})
+    monkeypatch.setenv("UPLOAD_DIR", str(tmp_path))
+    DocumentDBRouter._recover_uploads(SimpleNamespace(rag=SimpleNamespace(jobs=jobs)))
+    assert [job["id"] for job in jobs.unfinished_jobs(["upload"])] == [running]
+    assert jobs.get_job(interrupted)["status"] == "failed"
+    assert not stale.exists() and own.exists()
+
+
 if __name__ == "__main__":
     pytest.main(["-vv", "-s"])
@@ -0,0 +1,78 @@
+"""Measure the cold start of a worker.
+
+Every run starts a fresh interpreter which imports the application and enters
+its lifespan, which is what a uvicorn worker does before it accepts requests.
+Before measuring, it is checked that importing the application does not load
+any of the heavy client libraries, which are imported on first use.
+
+Usage: python startup_benchmark.py [runs]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Libraries which must not be loaded by `import app.main`
+HEAVY_MODULES = ("numpy", "openai", "pypdf", "qdrant_client", "tiktoken")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORTS = f"""
+import json
+import sys
+
+import app.main
+
+print(json.dumps([module for module in {HEAVY_MODULES!r} if module in sys.modules]))
+"""
+
+STARTUP = """
+import asyncio
+import time
+
+start = time.perf_counter()
+from app.main import app
+
+
+async def main():
+    async with app.router.lifespan_context(app):
+        print(time.perf_counter() - start)
+
+
+asyncio.run(main())
+"""
+
+
+def _run(code: str, cwd: str | None = None) -> str:
+    """Run code in a fresh interpreter which can import the application, return its output."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(
+        path for path in (ROOT, os.environ.get("PYTHONPATH")) if path)}
+    return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                          check=True, cwd=cwd, env=env).stdout
+
+
+def eager_imports(cwd: str | None = None) -> list[str]:
+    """Return the heavy libraries which are loaded by importing the application."""
+    return json.loads(_run(IMPORTS, cwd).splitlines()[-1])
+
+
+def measure(runs: int) -> list[float]:
+    """Return the startup time in seconds of `runs` fresh workers."""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = _run(STARTUP)
+        timings.append((float(output.split()[-1]), time.perf_counter() - start))
+    return timings
+
+
+if __name__ == "__main__":
+    loaded = eager_imports()
+    assert not loaded, f"Importing the application loads {', '.join(loaded)}"
+    timings = measure(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
+    startup = [timing[0] for timing in timings]
+    process = [timing[1] for timing in timings]
+    print(f"import + lifespan: min {min(startup):.3f}s, median {statistics.median(startup):.3f}s")
+    print(f"whole process:     min {min(process):.3f}s, median {statistics.median(process):.3f}s")